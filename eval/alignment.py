@@ -1,90 +1,157 @@
 import logging
+import re
+from array import array
+from itertools import accumulate
+from sys import intern
+
+
+class LabelVocabulary():
+    """Maps entity labels to small integers.
+
+    Also memoizes the continuation label (see continue_entity_label)
+    of each label."""
+
+    __slots__ = ('labels', 'ids', 'continuations')
+
+    def __init__(self):
+        self.labels = []
+        self.ids = {}
+        self.continuations = []
+
+    def id(self, label):
+        try:
+            return self.ids[label]
+        except KeyError:
+            i = len(self.labels)
+            self.labels.append(label)
+            self.ids[label] = i
+            # Placeholder, the continuation label might be new, too
+            self.continuations.append(i)
+            self.continuations[i] = self.id(continue_entity_label(label))
+            return i
 
+    def continuation(self, i):
+        return self.continuations[i]
 
-def align_with_ground_truth(docid, predicted, ground_truth, max_look_ahead=9):
-    """Align the predicted tokens with the ground truth tokens.
 
-    This is a greedy heuristic: whenever there is a mismatch, it skips
-    over tokens until the sequences match again. This happens to work
-    on the turku-one test test but is in no way general. It might
-    throw lots of exceptions on another data set with different corner
-    cases."""
+label_vocabulary = LabelVocabulary()
 
-    # A proper sequence alignment algorithm might be a good idea. I
-    # tried python-alignment but it ended up with too deep recursion
-    # (maybe it's not suitable for large vocabulary?).
 
-    logging.debug(f'Aligning predicted with ground truth on document {docid}')
+class AlignedDocument():
+    """Ground truth tokens with ground truth and predicted labels.
 
-    i = 0 # ground truth index
-    j = 0 # predicted index
-    aligned = []
-    while i < len(ground_truth):
-        if j >= len(predicted):
-            # Probably this simple heuristic has failed. Try to
-            # recover by outputting the remaining ground truths with
-            # the latest predicted label.
-            k = len(ground_truth) - i
-
-            logging.warning(f'possible alignment heuristic mismatch '
-                            f'for the last {k} tokens on document {docid}')
-
-            continuation_label = continue_entity_label(predicted[-1][1])
-            for gt in ground_truth[i:]:
-                aligned.append([gt[0], continuation_label])
-
-            logging.debug(f'{[x[0] for x in ground_truth[i:]]} - <none>')
-
-            i += k
-
-        elif ground_truth[i][0] == predicted[j][0]:
-            logging.debug(f'{ground_truth[i][0]} - {predicted[j][0]}')
-            
-            aligned.append([ground_truth[i][0], predicted[j][1]])
-            i += 1
-            j += 1
+    The tokens are interned strings and the labels are stored as
+    arrays of LabelVocabulary ids. Iterating yields (token, ground
+    truth entity, predicted entity) tuples."""
+
+    __slots__ = ('tokens', 'ground_truth', 'predicted', 'labels')
+
+    def __init__(self, tokens, ground_truth, predicted, labels):
+        self.tokens = tokens
+        self.ground_truth = ground_truth
+        self.predicted = predicted
+        self.labels = labels
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def __getitem__(self, i):
+        labels = self.labels
+        return (self.tokens[i], labels[self.ground_truth[i]], labels[self.predicted[i]])
+
+    def __iter__(self):
+        labels = self.labels
+        for token, gt, pred in zip(self.tokens, self.ground_truth, self.predicted):
+            yield (token, labels[gt], labels[pred])
+
+
+def align_with_ground_truth(docid, predicted, ground_truth):
+    """Align the predicted tokens with the ground truth tokens.
+
+    Returns a list of (ground truth token, predicted label) pairs. See
+    align_label_ids for the details."""
 
-        elif predicted[j][0].startswith(ground_truth[i][0]):
-            # Let's assume the ground truth has multiple tokens
-            # corresponding to one predicted token.
-            k = consume_matches(predicted[j][0], [x[0] for x in ground_truth[i:]])
-            if k is None:
-                next_gt_tokens = [x[0] for x in ground_truth[i+2:i+max_look_ahead]]
-                if j >= len(predicted) - 1:
-                    k = len(ground_truth) - i
-                else:
-                    k = index_is_start_of(next_gt_tokens, predicted[j+1][0]) + 2
+    label_ids = align_label_ids(docid, predicted, ground_truth)
+    labels = label_vocabulary.labels
+    return [[gt[0], labels[i]] for gt, i in zip(ground_truth, label_ids)]
 
-            predicted_label = predicted[j][1]
-            continuation_label = continue_entity_label(predicted_label)
 
-            aligned.append([ground_truth[i][0], predicted_label])
-            for m in range(1, k):
-                aligned.append([ground_truth[i+m][0], continuation_label])
+def align_label_ids(docid, predicted, ground_truth, vocabulary=label_vocabulary):
+    """Align the predicted tokens with the ground truth tokens.
 
-            logging.debug(f'{[x[0] for x in ground_truth[i:i+k]]} - {predicted[j][0]}')
+    Both token sequences are projected onto their concatenated
+    character streams (whitespace removed) and the ground truth tokens
+    are mapped onto the predicted tokens covering the same characters
+    in a single linear pass.
+
+    A ground truth token that starts at the same character as a
+    predicted token gets the predicted label. A ground truth token
+    that starts in the middle of a predicted token (the ground truth
+    has split a predicted token) gets the continuation label of that
+    predicted token. Predicted tokens that start in the middle of a
+    ground truth token (the prediction has split a ground truth
+    token) are merged into it; a warning is logged if this discards
+    a new entity label.
+
+    If the character streams differ (for example, if the NER service
+    has normalized the text), the character offsets are mapped
+    position by position and a warning is logged.
+
+    Returns an array of the vocabulary ids of the predicted label of
+    each ground truth token."""
+
+    debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+    if debug:
+        logging.debug(f'Aligning predicted with ground truth on document {docid}')
+
+    gt_starts, gt_stream = character_offsets([x[0] for x in ground_truth])
+    pred_starts, pred_stream = character_offsets([x[0] for x in predicted])
+
+    if gt_stream != pred_stream:
+        logging.warning(f'Predicted and ground truth texts differ on document {docid} '
+                        f'starting at character {first_difference(gt_stream, pred_stream)}')
+
+    n = len(ground_truth)
+    m = len(predicted)
+    if m == 0:
+        return array('i', [vocabulary.id('O')])*n
+
+    pred_ids = array('i', [vocabulary.id(x[1]) for x in predicted])
+    continuations = vocabulary.continuations
+    aligned = array('i', [0])*n
+    j = 0 # predicted index
+    for i in range(n):
+        start = gt_starts[i]
+        end = gt_starts[i + 1]
 
-            i += k
+        # Move to the predicted token that covers the first character
+        # of the current ground truth token.
+        while j < m - 1 and pred_starts[j + 1] <= start:
             j += 1
 
+        if pred_starts[j] < start:
+            # The ground truth has multiple tokens corresponding to
+            # one predicted token.
+            label = continuations[pred_ids[j]]
         else:
-            # predicted has multiple tokens corresponding to one
-            # ground truth token.
-            next_predicted_tokens = [x[0] for x in predicted[j+2:j+max_look_ahead]]
-            k = index_is_start_of(next_predicted_tokens, ground_truth[i+1][0]) + 2
+            label = pred_ids[j]
 
-            predicted_label = predicted[j][1]
-            aligned.append([ground_truth[i][0], predicted_label])
+        aligned[i] = label
 
-            skipped = predicted[j+1:j+k]
-            if not label_continues_or_empty([x[1] for x in skipped], predicted_label):
+        # Predicted tokens starting inside the current ground truth
+        # token are merged into it.
+        k = j + 1
+        while k < m and pred_starts[k] < end:
+            k += 1
+        if k > j + 1:
+            if not label_ids_continue_or_empty(pred_ids, j + 1, k, label, vocabulary):
                 logging.warning(f'Discarding predicted entity labels on document {docid}')
-                logging.warning(skipped)
+                logging.warning(predicted[j+1:k])
 
-            logging.debug(f'{ground_truth[i][0]} - {[x[0] for x in predicted[j:j+k]]}')
+            if debug:
+                logging.debug(f'{ground_truth[i][0]} - {[x[0] for x in predicted[j:k]]}')
 
-            i += 1
-            j += k
+            j = k - 1
 
     # Checking the consistency of the entity labels (I-tag can only
     # follow the corresponding B-tag) in the output would be a good
@@ -93,65 +160,66 @@ def align_with_ground_truth(docid, predicted, ground_truth, max_look_ahead=9):
     return aligned
 
 
-def consume_matches(text, seq):
-    i = 0
-    textpos = 0
-    while i < len(seq) and textpos < len(text):
-        if text[textpos:].startswith(seq[i]):
-            textpos += len(seq[i])
-            i += 1
-        else:
-            break
+whitespace_re = re.compile(r'\s')
 
-    if textpos >= len(text) - 1:
-        return i
-    else:
-        return None
 
+def character_offsets(tokens):
+    """Start offsets of tokens in their concatenated character stream.
 
-def merge_ground_truth(docid, predicted, ground_truth):
-    """Merge predicted and ground truth labels into a combined array.
+    Whitespace inside the tokens is ignored. Returns the list of start
+    offsets, with the length of the stream appended as the last
+    element, and the stream itself."""
 
-    The columns of the output are: token, ground truth entity,
-    predicted entity."""
+    stream = ''.join(tokens)
+    if whitespace_re.search(stream) is None:
+        lengths = map(len, tokens)
+    else:
+        stream = ''.join(stream.split())
+        lengths = (len(t) - len(whitespace_re.findall(t)) for t in tokens)
 
-    predicted = align_with_ground_truth(docid, predicted, ground_truth)
-    assert len(predicted) == len(ground_truth)
+    return list(accumulate(lengths, initial=0)), stream
 
-    res = []
-    for pred, gt in zip(predicted, ground_truth):
-        assert pred[0] == gt[0]
 
-        res.append([gt[0], gt[1], pred[1]])
+def first_difference(a, b):
+    for i, (x, y) in enumerate(zip(a, b)):
+        if x != y:
+            return i
 
-    return res
+    return min(len(a), len(b))
 
 
-def index_is_start_of(arr, key):
-    for i, v in enumerate(arr):
-        if key.startswith(v):
-            return i
+def merge_ground_truth(docid, predicted, ground_truth, vocabulary=label_vocabulary):
+    """Merge predicted and ground truth labels into a combined array.
+
+    The columns of the output are: token, ground truth entity,
+    predicted entity. Returns an AlignedDocument."""
+
+    predicted_ids = align_label_ids(docid, predicted, ground_truth, vocabulary)
+    assert len(predicted_ids) == len(ground_truth)
 
-    raise ValueError(f"No prefix of '{key}' in list")
+    tokens = [intern(gt[0]) for gt in ground_truth]
+    ground_truth_ids = array('i', [vocabulary.id(gt[1]) for gt in ground_truth])
 
+    return AlignedDocument(tokens, ground_truth_ids, predicted_ids, vocabulary.labels)
 
-def label_continues_or_empty(seq, previous_label):
-    """Returns True if seq continues previous_label or 'O' (that is no new
-    tags starting)."""
 
-    seq = list(seq) # copy
+def label_ids_continue_or_empty(ids, start, end, previous_id, vocabulary=label_vocabulary):
+    """Returns True if the label ids[start:end] continue the label
+    previous_id or are 'O' (that is no new tags starting)."""
 
-    if previous_label.startswith('B-'):
-        continuation_label = 'I-' + previous_label[2:]
-    elif previous_label.startswith('I-'):
-        continuation_label = previous_label
+    labels = vocabulary.labels
+    previous_label = labels[previous_id]
+    if previous_label.startswith('B-') or previous_label.startswith('I-'):
+        continuation_id = vocabulary.continuation(previous_id)
     else:
-        continuation_label = 'O'
+        continuation_id = vocabulary.id('O')
 
-    while seq and seq[0] == continuation_label:
-        seq.pop(0)
+    o_id = vocabulary.id('O')
+    i = start
+    while i < end and ids[i] == continuation_id:
+        i += 1
 
-    return all(x == 'O' for x in seq)
+    return all(ids[k] == o_id for k in range(i, end))
 
 
 def continue_entity_label(entity_label):
@@ -0,0 +1,249 @@
+"""Parallel alignment of predictions with the ground truth.
+
+merge_ground_truth is pure CPU work on independent documents, so the
+alignments can be computed on worker processes. AlignmentPool sends
+the documents to the workers in chunks, so that the cost of the
+inter-process communication is paid once per chunk instead of once
+per document. A chunk is serialized compactly: each column (ground
+truth tokens and labels, predicted tokens and labels) is joined into
+a single string, and the workers return the label ids as packed int32
+arrays. The tokens of the aligned documents are taken from the ground
+truth in the main process, so they are never sent back.
+
+The workers capture the log messages of the alignment, and the main
+process logs them in the document order, as if the documents had been
+aligned sequentially.
+"""
+
+import logging
+import time
+from array import array
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from operator import itemgetter
+from sys import intern
+from .alignment import AlignedDocument, LabelVocabulary, align_label_ids, label_vocabulary
+from .functools import chunked
+from .instrumentation import instrumentation
+
+# Separates the values of a column in a serialized chunk
+separator = '\0'
+
+first = itemgetter(0)
+second = itemgetter(1)
+
+
+class AlignmentPool():
+    """Aligns documents on num_workers processes.
+
+    The alignments are returned in the input order. Label ids are
+    relative to vocabulary (the global label_vocabulary by default)."""
+
+    def __init__(self, num_workers, chunk_documents=32, vocabulary=label_vocabulary):
+        self.num_workers = num_workers
+        self.chunk_documents = chunk_documents
+        self.vocabulary = vocabulary
+        self.warnings = 0
+        self.documents_with_warnings = 0
+        self.executor = ProcessPoolExecutor(num_workers, initializer=init_worker,
+                                            initargs=(logging.getLogger().getEffectiveLevel(),))
+        # Start the workers now: they are forked, and forking after the
+        # caller has started threads could copy locks held by them.
+        self.executor.submit(int).result()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.executor.shutdown(cancel_futures=True)
+
+    def submit(self, items):
+        """Start aligning a chunk of (document ID, predicted tokens,
+        ground truth, tag) items. Returns a concurrent.futures.Future
+        for results()."""
+        labels = list(self.vocabulary.labels)
+        return self.executor.submit(align_chunk, labels, encode_chunk(items))
+
+    def results(self, items, response):
+        """Yield the (AlignedDocument, tag) pairs of a chunk from the
+        response of a worker. Logs the captured log messages."""
+        num_labels, new_labels, gold_bytes, pred_bytes, seconds_bytes, records = response
+
+        gold_ids = array('i')
+        gold_ids.frombytes(gold_bytes)
+        pred_ids = array('i')
+        pred_ids.frombytes(pred_bytes)
+        seconds = array('d')
+        seconds.frombytes(seconds_bytes)
+
+        # The workers only know the labels that were in the vocabulary
+        # when the chunk was submitted. Their new labels may have gotten
+        # different ids here.
+        remap = list(range(num_labels)) + [self.vocabulary.id(label) for label in new_labels]
+        if remap != list(range(len(remap))):
+            gold_ids = array('i', map(remap.__getitem__, gold_ids))
+            pred_ids = array('i', map(remap.__getitem__, pred_ids))
+
+        records = deque(records)
+        labels = self.vocabulary.labels
+        start = 0
+        for i, (docid, predicted, ground_truth, tag) in enumerate(items):
+            has_warnings = False
+            while records and records[0][0] == i:
+                _, level, message = records.popleft()
+                logging.log(level, message)
+                if level >= logging.WARNING:
+                    self.warnings += 1
+                    has_warnings = True
+            self.documents_with_warnings += has_warnings
+
+            end = start + len(ground_truth)
+            tokens = list(map(intern, map(first, ground_truth)))
+            aligned = AlignedDocument(tokens, gold_ids[start:end], pred_ids[start:end], labels)
+            start = end
+
+            instrumentation.observe('merge_ground_truth', seconds[i])
+            instrumentation.count('documents')
+            instrumentation.count('tokens', len(ground_truth))
+            yield aligned, tag
+
+    def imap(self, items):
+        """Align (document ID, predicted tokens, ground truth, tag)
+        items and yield (AlignedDocument, tag) pairs in the input
+        order.
+
+        At most two chunks per worker are in flight, so the items are
+        consumed only as fast as they are aligned."""
+        pending = deque()
+        for chunk in chunked(items, self.chunk_documents):
+            pending.append((chunk, self.submit(chunk)))
+            if len(pending) >= 2*self.num_workers:
+                chunk, future = pending.popleft()
+                yield from self.results(chunk, future.result())
+
+        while pending:
+            chunk, future = pending.popleft()
+            yield from self.results(chunk, future.result())
+
+    def log_summary(self):
+        if self.warnings:
+            logging.warning(f'{self.warnings} alignment warnings on '
+                            f'{self.documents_with_warnings} documents')
+
+
+def encode_chunk(items):
+    """Serialize the document IDs, predictions and ground truths of a
+    chunk into a few strings and arrays."""
+    docids = []
+    gt_lengths = array('i')
+    pred_lengths = array('i')
+    gt_tokens = []
+    gt_labels = []
+    pred_tokens = []
+    pred_labels = []
+    for docid, predicted, ground_truth, _ in items:
+        docids.append(docid)
+        gt_lengths.append(len(ground_truth))
+        pred_lengths.append(len(predicted))
+        gt_tokens.extend(map(first, ground_truth))
+        gt_labels.extend(map(second, ground_truth))
+        pred_tokens.extend(map(first, predicted))
+        pred_labels.extend(map(second, predicted))
+
+    return (docids, gt_lengths.tobytes(), pred_lengths.tobytes(),
+            encode_column(gt_tokens), encode_column(gt_labels),
+            encode_column(pred_tokens), encode_column(pred_labels))
+
+
+def encode_column(values):
+    """Join values with the separator. Falls back to the list itself
+    in the unlikely case that a value contains the separator."""
+    joined = separator.join(values)
+    if joined.count(separator) != max(len(values) - 1, 0):
+        return values
+    return (len(values), joined)
+
+
+def decode_column(column):
+    if isinstance(column, list):
+        return column
+
+    n, joined = column
+    return joined.split(separator) if n > 0 else []
+
+
+def decode_chunk(encoded):
+    """Yield the (document ID, predicted tokens, ground truth) of each
+    document in an encoded chunk."""
+    docids, gt_lengths_bytes, pred_lengths_bytes, *columns = encoded
+    gt_lengths = array('i')
+    gt_lengths.frombytes(gt_lengths_bytes)
+    pred_lengths = array('i')
+    pred_lengths.frombytes(pred_lengths_bytes)
+    gt_tokens, gt_labels, pred_tokens, pred_labels = map(decode_column, columns)
+
+    gt_start = 0
+    pred_start = 0
+    for docid, n, m in zip(docids, gt_lengths, pred_lengths):
+        ground_truth = list(zip(gt_tokens[gt_start:gt_start + n], gt_labels[gt_start:gt_start + n]))
+        predicted = list(zip(pred_tokens[pred_start:pred_start + m],
+                             pred_labels[pred_start:pred_start + m]))
+        gt_start += n
+        pred_start += m
+        yield docid, predicted, ground_truth
+
+
+class CapturingHandler(logging.Handler):
+    """Collects the log messages of a worker as (document index, level,
+    message) tuples."""
+
+    def __init__(self):
+        super().__init__()
+        self.document = 0
+        self.records = []
+
+    def emit(self, record):
+        self.records.append((self.document, record.levelno, record.getMessage()))
+
+
+capturing_handler = None
+
+
+def init_worker(level):
+    global capturing_handler
+
+    capturing_handler = CapturingHandler()
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(capturing_handler)
+    root.setLevel(level)
+
+
+def align_chunk(labels, encoded):
+    """Align the documents of an encoded chunk in a worker process.
+
+    The label ids are relative to a vocabulary that starts with
+    labels. Returns the number of the labels, the labels that were not
+    in it, the packed ground truth and predicted label ids, the
+    alignment time of each document and the captured log messages."""
+    vocabulary = LabelVocabulary()
+    for label in labels:
+        vocabulary.id(label)
+
+    capturing_handler.records = []
+    gold_ids = array('i')
+    pred_ids = array('i')
+    seconds = array('d')
+    for i, (docid, predicted, ground_truth) in enumerate(decode_chunk(encoded)):
+        capturing_handler.document = i
+        start = time.perf_counter()
+        pred_ids.extend(align_label_ids(docid, predicted, ground_truth, vocabulary))
+        gold_ids.extend([vocabulary.id(gt[1]) for gt in ground_truth])
+        seconds.append(time.perf_counter() - start)
+
+    return (len(labels), vocabulary.labels[len(labels):], gold_ids.tobytes(),
+            pred_ids.tobytes(), seconds.tobytes(), capturing_handler.records)
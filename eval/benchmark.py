@@ -0,0 +1,270 @@
+"""Benchmarks of the evaluation pipeline on synthetic corpora.
+
+Usage:
+python -m eval.benchmark --scale 10000 --scale 1000000 --output benchmark_results/new.json
+python -m eval.benchmark --scale 10000 --baseline benchmark_results/old.json
+
+Each benchmark is run --repeat times on a corpus generated by
+synthetic.py and the best time is reported. The NER services are
+replaced by mock predictions (the ground truth retokenized like
+turku-one with noisy tags), so the numbers measure only the code in
+this repository.
+
+With --baseline, the results are compared with an earlier result file
+and the benchmarks that are slower by more than --threshold are
+flagged as regressions (exit status 1). Baselines depend on the
+machine and are not committed to the repository.
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+from .alignment import align_with_ground_truth, merge_ground_truth
+from .alignment_pool import AlignmentPool
+from .conlleval import evaluate, parse_args as conlleval_args
+from .data import GroundTruthIndex, load_ground_truth
+from .docstore import DocumentStoreWriter
+from .offsets import TokenOffsetIndex
+from .runner import add_runner_arguments, run_evaluation
+from .synthetic import SyntheticCorpus
+from .ud_to_documents import read_documents
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(format='%(levelname)s: %(message)s', level=logging.WARNING)
+
+    names = args.benchmark or list(benchmarks)
+    results = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'seed': args.seed,
+        'repeat': args.repeat,
+        'corpus': {
+            'entity_density': args.entity_density,
+            'split_rate': args.split_rate,
+            'multiword_rate': args.multiword_rate,
+        },
+        'scales': {},
+    }
+
+    for scale in args.scale:
+        corpus = SyntheticCorpus(scale, seed=args.seed, entity_density=args.entity_density,
+                                 split_rate=args.split_rate, multiword_rate=args.multiword_rate)
+        print(f'{corpus.num_tokens} tokens, {len(corpus.documents)} documents')
+        scale_results = {}
+        for name in names:
+            res = run_benchmark(benchmarks[name], corpus, args.repeat)
+            scale_results[name] = res
+            print(f'{name:>24}: {res["best_s"]:8.3f} s  {res["tokens_per_s"]:12.0f} tokens/s')
+        results['scales'][str(scale)] = scale_results
+
+    if args.output:
+        args.output.parent.mkdir(parents=True, exist_ok=True)
+        with args.output.open('w') as f:
+            json.dump(results, f, indent=2)
+        print(f'Results saved to {args.output}')
+
+    if args.baseline:
+        with args.baseline.open() as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            sys.exit(1)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark the evaluation pipeline')
+    parser.add_argument('--scale', type=int, action='append',
+                        help='Corpus size in tokens (can be given several times, default: 10000)')
+    parser.add_argument('--benchmark', action='append', choices=list(benchmarks),
+                        help='Run only this benchmark (can be given several times)')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of runs of each benchmark')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the corpus generator')
+    parser.add_argument('--entity-density', type=float, default=0.1,
+                        help='Probability of an entity starting at a token')
+    parser.add_argument('--split-rate', type=float, default=0.02,
+                        help='Probability of a hyphenated or colon token')
+    parser.add_argument('--multiword-rate', type=float, default=0.02,
+                        help='Probability of a multi-word token')
+    parser.add_argument('--output', type=Path, help='Save the results as JSON into this file')
+    parser.add_argument('--baseline', type=Path,
+                        help='Compare with the results in this file')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='Relative slowdown flagged as a regression')
+    args = parser.parse_args()
+    if not args.scale:
+        args.scale = [10000]
+    return args
+
+
+def run_benchmark(benchmark, corpus, repeat):
+    setup, run = benchmark
+    times = []
+    with tempfile.TemporaryDirectory() as tmp:
+        state = setup(corpus, Path(tmp))
+        for _ in range(repeat):
+            start = time.perf_counter()
+            run(state)
+            times.append(time.perf_counter() - start)
+
+    best = min(times)
+    return {
+        'best_s': best,
+        'median_s': statistics.median(times),
+        'tokens_per_s': corpus.num_tokens / best if best > 0 else 0.0,
+        'documents_per_s': len(corpus.documents) / best if best > 0 else 0.0,
+    }
+
+
+def compare(results, baseline, threshold):
+    """Print the changes from baseline. Returns the list of
+    regressions."""
+    regressions = []
+    for scale, scale_results in results['scales'].items():
+        for name, res in scale_results.items():
+            old = baseline.get('scales', {}).get(scale, {}).get(name)
+            if old is None:
+                continue
+
+            ratio = res['best_s'] / old['best_s'] if old['best_s'] > 0 else 1.0
+            flag = ''
+            if ratio > 1 + threshold:
+                flag = '  REGRESSION'
+                regressions.append((scale, name, ratio))
+            print(f'{scale:>9} {name:>24}: {old["best_s"]:8.3f} s -> '
+                  f'{res["best_s"]:8.3f} s ({ratio - 1:+.1%}){flag}')
+
+    return regressions
+
+
+# Benchmarks: name -> (setup(corpus, tmp_dir) -> state, run(state))
+
+def setup_ud_to_documents(corpus, tmp):
+    return list(corpus.conllu_lines())
+
+
+def run_ud_to_documents(lines):
+    for _ in read_documents(lines):
+        pass
+
+
+def setup_load_ground_truth(corpus, tmp):
+    path = tmp / 'test.tsv'
+    with path.open('w') as f:
+        f.writelines(corpus.ground_truth_lines())
+    return path
+
+
+def run_load_ground_truth(path):
+    for _ in load_ground_truth(path):
+        pass
+
+
+def setup_alignment(corpus, tmp):
+    return list(zip([d[0] for d in corpus.documents], corpus.predictions(),
+                    corpus.ground_truth()))
+
+
+def run_align_with_ground_truth(state):
+    for docid, predicted, ground_truth in state:
+        align_with_ground_truth(docid, predicted, ground_truth)
+
+
+def run_merge_ground_truth(state):
+    for docid, predicted, ground_truth in state:
+        merge_ground_truth(docid, predicted, ground_truth)
+
+
+def run_merge_ground_truth_pool(state):
+    # Includes starting the worker processes
+    with AlignmentPool(os.cpu_count()) as pool:
+        for _ in pool.imap((docid, predicted, ground_truth, None)
+                           for docid, predicted, ground_truth in state):
+            pass
+
+
+def setup_conlleval(corpus, tmp):
+    return list(corpus.result_lines()), conlleval_args(['--boundary=-DOCSTART-', '--delimiter=\t'])
+
+
+def run_conlleval(state):
+    lines, options = state
+    evaluate(lines, options)
+
+
+def run_conlleval_numpy(state):
+    from .conlleval_numpy import evaluate as evaluate_numpy
+    lines, options = state
+    evaluate_numpy(lines, options)
+
+
+def setup_token_offset_index(corpus, tmp):
+    documents = corpus.input_documents()
+    return list(zip([d['spans'] for d in documents], corpus.entity_ranges(documents)))
+
+
+def run_token_offset_index(state):
+    for spans, ranges in state:
+        TokenOffsetIndex(spans).overlapping_all(ranges)
+
+
+def setup_runner(corpus, tmp):
+    documents_path = tmp / 'documents.bin'
+    with DocumentStoreWriter(documents_path) as writer:
+        for doc in corpus.input_documents():
+            writer.add(doc['id'], doc['text'], doc['spans'])
+
+    ground_truth_path = tmp / 'test.tsv'
+    with ground_truth_path.open('w') as f:
+        f.writelines(corpus.ground_truth_lines())
+    GroundTruthIndex(ground_truth_path)
+
+    parser = argparse.ArgumentParser()
+    add_runner_arguments(parser, str(tmp / 'mock.tsv'))
+    args = parser.parse_args(['--documents', str(documents_path),
+                              '--ground-truth', str(ground_truth_path),
+                              '--restart'])
+    predictions = dict(zip([d[0] for d in corpus.documents], corpus.predictions()))
+    return args, predictions
+
+
+def run_runner(state):
+    args, predictions = state
+
+    def predict_all(documents):
+        for doc in documents:
+            yield doc, predictions[doc['id']]
+
+    run_evaluation(predict_all, args, include_spans=False)
+
+
+def setup_runner_pipeline(corpus, tmp):
+    args, predictions = setup_runner(corpus, tmp)
+    args.pipeline = True
+    return args, predictions
+
+
+benchmarks = {
+    'ud_to_documents': (setup_ud_to_documents, run_ud_to_documents),
+    'load_ground_truth': (setup_load_ground_truth, run_load_ground_truth),
+    'align_with_ground_truth': (setup_alignment, run_align_with_ground_truth),
+    'merge_ground_truth': (setup_alignment, run_merge_ground_truth),
+    'merge_ground_truth_pool': (setup_alignment, run_merge_ground_truth_pool),
+    'conlleval': (setup_conlleval, run_conlleval),
+    'conlleval_numpy': (setup_conlleval, run_conlleval_numpy),
+    'token_offset_index': (setup_token_offset_index, run_token_offset_index),
+    'runner': (setup_runner, run_runner),
+    'runner_pipeline': (setup_runner_pipeline, run_runner),
+}
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,225 @@
+import hashlib
+import json
+import logging
+import sqlite3
+import time
+from collections import deque
+from pathlib import Path
+
+default_cache_path = Path('ner_results/prediction_cache.sqlite')
+
+# Number of cache hits whose access times are written in one transaction
+access_batch_size = 1000
+
+
+class PredictionCache():
+    """A content-addressed cache for NER predictions.
+
+    The predictions are stored as JSON in a single SQLite file, keyed
+    by a hash of the backend name, the backend configuration and the
+    input text. Changing any of them is a cache miss.
+
+    If max_size (in bytes) is given, the least recently used entries
+    are evicted when the total size of the cached predictions exceeds
+    it. The access times of cache hits are written in batches, together
+    with the next stored prediction or when the cache is closed.
+
+    A read-only cache never writes to the file. A missing cache file is
+    read as an empty cache."""
+
+    def __init__(self, path=default_cache_path, max_size=None, read_only=False):
+        self.path = Path(path)
+        self.max_size = max_size
+        self.read_only = read_only
+        self.hits = 0
+        self.misses = 0
+        # Access times of the cache hits not yet written, by key
+        self.accessed = {}
+
+        # The connection is used by one thread at a time, but not
+        # necessarily the one that opened it (see pipeline.py).
+        if read_only:
+            self.connection = connect_read_only(self.path)
+        else:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self.connection = sqlite3.connect(self.path, check_same_thread=False)
+            create_tables(self.connection)
+
+        self.total_size = self.connection.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM predictions').fetchone()[0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self.accessed:
+            self.write_access_times()
+            self.connection.commit()
+        self.connection.close()
+
+    def get(self, backend, config, text):
+        key = cache_key(backend, config, text)
+        row = self.connection.execute(
+            'SELECT value FROM predictions WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        if not self.read_only:
+            self.accessed[key] = time.time()
+            if len(self.accessed) >= access_batch_size:
+                self.write_access_times()
+                self.connection.commit()
+
+        return json.loads(row[0])
+
+    def put(self, backend, config, text, prediction):
+        if self.read_only:
+            return
+
+        # The eviction below needs up-to-date access times
+        self.write_access_times()
+
+        key = cache_key(backend, config, text)
+        value = json.dumps(prediction, ensure_ascii=False)
+        size = len(value.encode('utf-8'))
+        old = self.connection.execute(
+            'SELECT size FROM predictions WHERE key = ?', (key,)).fetchone()
+        if old is not None:
+            self.total_size -= old[0]
+
+        self.connection.execute(
+            'INSERT OR REPLACE INTO predictions (key, backend, value, size, last_access) '
+            'VALUES (?, ?, ?, ?, ?)',
+            (key, backend, value, size, time.time()))
+        self.total_size += size
+
+        if self.max_size is not None and self.total_size > self.max_size:
+            self.evict(self.max_size)
+
+        self.connection.commit()
+
+    def write_access_times(self):
+        """Write the pending access times. The caller commits."""
+        self.connection.executemany(
+            'UPDATE predictions SET last_access = ? WHERE key = ?',
+            [(t, key) for key, t in self.accessed.items()])
+        self.accessed = {}
+
+    def evict(self, target_size):
+        """Remove the least recently used entries until the total size
+        is at most target_size bytes."""
+        evicted = []
+        rows = self.connection.execute(
+            'SELECT key, size FROM predictions ORDER BY last_access')
+        for key, size in rows:
+            if self.total_size <= target_size:
+                break
+
+            evicted.append((key,))
+            self.total_size -= size
+
+        self.connection.executemany('DELETE FROM predictions WHERE key = ?', evicted)
+        logging.debug(f'Evicted {len(evicted)} predictions from the cache')
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': self.total_size,
+        }
+
+
+def create_tables(connection):
+    connection.execute(
+        'CREATE TABLE IF NOT EXISTS predictions ('
+        'key TEXT PRIMARY KEY, backend TEXT, value TEXT, '
+        'size INTEGER, last_access REAL)')
+    connection.execute(
+        'CREATE INDEX IF NOT EXISTS predictions_last_access '
+        'ON predictions (last_access)')
+    connection.commit()
+
+
+def connect_read_only(path):
+    """Open the cache file without writing to it. A missing file or
+    table is read as an empty in-memory cache."""
+    if path.exists():
+        connection = sqlite3.connect(f'file:{path}?mode=ro', uri=True,
+                                     check_same_thread=False)
+        has_table = connection.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'predictions'").fetchone()
+        if has_table:
+            return connection
+        connection.close()
+
+    connection = sqlite3.connect(':memory:', check_same_thread=False)
+    create_tables(connection)
+    return connection
+
+
+def cache_key(backend, config, text):
+    h = hashlib.sha256()
+    h.update(json.dumps([backend, config], sort_keys=True).encode('utf-8'))
+    h.update(b'\0')
+    h.update(text.encode('utf-8'))
+    return h.hexdigest()
+
+
+def predict_with_cache(cache, backend, config, documents, predict_all):
+    """Yield (document, prediction) pairs, predicting only cache misses.
+
+    predict_all is called with an iterable of the documents that are
+    not in the cache and must yield (document, prediction) pairs in
+    the same order. The output is in the order of the input
+    documents. If cache is None, this is the same as
+    predict_all(documents)."""
+
+    if cache is None:
+        yield from predict_all(documents)
+        return
+
+    # Documents in input order together with the cached prediction, or
+    # None if the document is waiting for predict_all.
+    pending = deque()
+
+    def uncached_documents():
+        for doc in documents:
+            prediction = cache.get(backend, config, doc['text'])
+            pending.append((doc, prediction))
+            if prediction is None:
+                yield doc
+
+    for doc, prediction in predict_all(uncached_documents()):
+        while pending[0][1] is not None:
+            yield pending.popleft()
+
+        pending.popleft()
+        cache.put(backend, config, doc['text'], prediction)
+        yield doc, prediction
+
+    while pending:
+        yield pending.popleft()
+
+
+def add_cache_arguments(parser):
+    parser.add_argument('--cache', type=Path, default=default_cache_path,
+                        help='Prediction cache file')
+    parser.add_argument('--no-cache', action='store_true', default=False,
+                        help='Do not use the prediction cache')
+    parser.add_argument('--cache-read-only', action='store_true', default=False,
+                        help='Use cached predictions but do not store new ones')
+    parser.add_argument('--cache-max-size', type=int,
+                        help='Maximum size of the prediction cache in megabytes')
+
+
+def open_cache(args):
+    if args.no_cache:
+        return None
+
+    max_size = args.cache_max_size * 1024 * 1024 if args.cache_max_size else None
+    return PredictionCache(args.cache, max_size, args.cache_read_only)
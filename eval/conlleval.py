@@ -13,6 +13,8 @@ import sys
 import re
 
 from collections import defaultdict, namedtuple
+from itertools import zip_longest
+from pathlib import Path
 
 ANY_SPACE = '<SPACE>'
 
@@ -47,50 +49,44 @@ def parse_args(argv):
         help='character delimiting items in input')
     arg('-o', '--otag', metavar='CHAR', default='O',
         help='alternative outside tag')
-    arg('file', nargs='?', default=None)
+    arg('--backend', choices=['python', 'numpy'], default='python',
+        help='scoring implementation for a single result file')
+    arg('files', metavar='file', nargs='*',
+        help='result files of one or more systems (default: STDIN)')
     return parser.parse_args(argv)
 
-def parse_tag(t):
-    m = re.match(r'^([^-]*)-(.*)$', t)
-    return m.groups() if m else (t, '')
-
-def evaluate(iterable, options=None):
-    if options is None:
-        options = parse_args([])    # use defaults
-
-    counts = EvalCounts()
-    num_features = None       # number of features per line
-    in_correct = False        # currently processed chunks is correct until now
-    last_correct = 'O'        # previous chunk tag in corpus
-    last_correct_type = ''    # type of previously identified chunk tag
-    last_guessed = 'O'        # previously identified chunk tag
-    last_guessed_type = ''    # type of previous chunk tag in corpus
+tag_re = re.compile(r'^([^-]*)-(.*)$')
+parsed_tags = {}
 
-    for line in iterable:
-        line = line.rstrip('\r\n')
-
-        if options.delimiter == ANY_SPACE:
-            features = line.split()
-        else:
-            features = line.split(options.delimiter)
-
-        if num_features is None:
-            num_features = len(features)
-        elif num_features != len(features) and len(features) != 0:
-            raise FormatError('unexpected number of features: %d (%d)' %
-                              (len(features), num_features))
+def parse_tag(t):
+    # The tag set is small, so the parsed tags are memoized
+    try:
+        return parsed_tags[t]
+    except KeyError:
+        m = tag_re.match(t)
+        parsed = m.groups() if m else (t, '')
+        parsed_tags[t] = parsed
+        return parsed
 
-        if len(features) == 0 or features[0] == options.boundary:
-            features = [options.boundary, 'O', 'O']
-        if len(features) < 3:
-            raise FormatError('unexpected number of features in line %s' % line)
+class ChunkCounter(object):
+    """Incremental chunk counting for one system.
 
-        guessed, guessed_type = parse_tag(features.pop())
-        correct, correct_type = parse_tag(features.pop())
-        first_item = features.pop(0)
+    Call update() for each line and finish() after the last line."""
 
-        if first_item == options.boundary:
-            guessed = 'O'
+    def __init__(self):
+        self.counts = EvalCounts()
+        self.in_correct = False        # currently processed chunks is correct until now
+        self.last_correct = 'O'        # previous chunk tag in corpus
+        self.last_correct_type = ''    # type of previously identified chunk tag
+        self.last_guessed = 'O'        # previously identified chunk tag
+        self.last_guessed_type = ''    # type of previous chunk tag in corpus
+
+    def update(self, correct, correct_type, guessed, guessed_type, is_boundary):
+        counts = self.counts
+        last_correct = self.last_correct
+        last_correct_type = self.last_correct_type
+        last_guessed = self.last_guessed
+        last_guessed_type = self.last_guessed_type
 
         end_correct = end_of_chunk(last_correct, correct,
                                    last_correct_type, correct_type)
@@ -101,17 +97,17 @@ def evaluate(iterable, options=None):
         start_guessed = start_of_chunk(last_guessed, guessed,
                                        last_guessed_type, guessed_type)
 
-        if in_correct:
+        if self.in_correct:
             if (end_correct and end_guessed and
                 last_guessed_type == last_correct_type):
-                in_correct = False
+                self.in_correct = False
                 counts.correct_chunk += 1
                 counts.t_correct_chunk[last_correct_type] += 1
             elif (end_correct != end_guessed or guessed_type != correct_type):
-                in_correct = False
+                self.in_correct = False
 
         if start_correct and start_guessed and guessed_type == correct_type:
-            in_correct = True
+            self.in_correct = True
 
         if start_correct:
             counts.found_correct += 1
@@ -119,21 +115,170 @@ def evaluate(iterable, options=None):
         if start_guessed:
             counts.found_guessed += 1
             counts.t_found_guessed[guessed_type] += 1
-        if first_item != options.boundary:
+        if not is_boundary:
             if correct == guessed and guessed_type == correct_type:
                 counts.correct_tags += 1
             counts.token_counter += 1
 
-        last_guessed = guessed
-        last_correct = correct
-        last_guessed_type = guessed_type
-        last_correct_type = correct_type
+        self.last_guessed = guessed
+        self.last_correct = correct
+        self.last_guessed_type = guessed_type
+        self.last_correct_type = correct_type
+
+    def finish(self):
+        if self.in_correct:
+            self.counts.correct_chunk += 1
+            self.counts.t_correct_chunk[self.last_correct_type] += 1
+            self.in_correct = False
+
+        return self.counts
+
+def split_features(line, options):
+    line = line.rstrip('\r\n')
+
+    if options.delimiter == ANY_SPACE:
+        return line.split()
+    else:
+        return line.split(options.delimiter)
+
+def evaluate(iterable, options=None):
+    if options is None:
+        options = parse_args([])    # use defaults
+
+    counter = ChunkCounter()
+    num_features = None       # number of features per line
+
+    for line in iterable:
+        features = split_features(line, options)
+
+        if num_features is None:
+            num_features = len(features)
+        elif num_features != len(features) and len(features) != 0:
+            raise FormatError('unexpected number of features: %d (%d)' %
+                              (len(features), num_features))
+
+        if len(features) == 0 or features[0] == options.boundary:
+            features = [options.boundary, 'O', 'O']
+        if len(features) < 3:
+            raise FormatError('unexpected number of features in line %s' % line)
+
+        guessed, guessed_type = parse_tag(features.pop())
+        correct, correct_type = parse_tag(features.pop())
+        first_item = features.pop(0)
+
+        if first_item == options.boundary:
+            guessed = 'O'
+
+        counter.update(correct, correct_type, guessed, guessed_type,
+                       first_item == options.boundary)
+
+    return counter.finish()
 
-    if in_correct:
-        counts.correct_chunk += 1
-        counts.t_correct_chunk[last_correct_type] += 1
+def evaluate_multi(iterable, options=None):
+    """Evaluate several systems in one pass.
 
-    return counts
+    The first column of each line is the token, the second is the
+    correct tag and the rest are the tags guessed by each system.
+    Returns a list of EvalCounts, one for each system."""
+
+    if options is None:
+        options = parse_args([])    # use defaults
+
+    counters = None
+    num_features = None       # number of features per line
+
+    for line in iterable:
+        features = split_features(line, options)
+
+        if num_features is None:
+            num_features = len(features)
+            if num_features < 3:
+                raise FormatError('unexpected number of features in line %s' % line)
+            counters = [ChunkCounter() for _ in range(num_features - 2)]
+        elif num_features != len(features) and len(features) != 0:
+            raise FormatError('unexpected number of features: %d (%d)' %
+                              (len(features), num_features))
+
+        if len(features) == 0 or features[0] == options.boundary:
+            for counter in counters:
+                counter.update('O', '', 'O', '', True)
+            continue
+
+        correct, correct_type = parse_tag(features[1])
+        for counter, guessed in zip(counters, features[2:]):
+            guessed, guessed_type = parse_tag(guessed)
+            counter.update(correct, correct_type, guessed, guessed_type, False)
+
+    return [counter.finish() for counter in (counters or [])]
+
+def zip_result_files(files, options=None):
+    """Combine result files of several systems line by line.
+
+    The files must contain the same tokens and correct tags, like the
+    result files written by the NER evaluation scripts. Yields lines
+    in the format expected by evaluate_multi()."""
+
+    if options is None:
+        options = parse_args([])    # use defaults
+
+    delimiter = ' ' if options.delimiter == ANY_SPACE else options.delimiter
+    for lines in zip_longest(*files):
+        if any(line is None for line in lines):
+            raise FormatError('result files have different number of lines')
+
+        rows = [split_features(line, options) for line in lines]
+        first = rows[0]
+        if any(row[:2] != first[:2] for row in rows[1:]):
+            raise FormatError('tokens or correct tags differ between result files: %s' %
+                              ' / '.join(line.rstrip('\r\n') for line in lines))
+
+        if len(first) == 0:
+            yield ''
+        else:
+            yield delimiter.join(first[:2] + [row[-1] for row in rows])
+
+def evaluate_columns(columns, options=None):
+    """Evaluate a columnar result sidecar (see results.py)."""
+
+    if options is None:
+        options = parse_args([])    # use defaults
+
+    counter = ChunkCounter()
+    tags = [parse_tag(t) for t in columns.tags]
+    boundary = columns.token_id(options.boundary)
+    for token, gold, pred in zip(columns.token_ids, columns.gold_ids, columns.pred_ids):
+        if token == boundary:
+            counter.update('O', '', 'O', '', True)
+        else:
+            correct, correct_type = tags[gold]
+            guessed, guessed_type = tags[pred]
+            counter.update(correct, correct_type, guessed, guessed_type, False)
+
+    return counter.finish()
+
+def evaluate_files(paths, options=None):
+    """Evaluate result files of several systems in one pass.
+
+    If all files have an up-to-date columnar sidecar, the sidecars are
+    evaluated instead of parsing the files. Returns a list of
+    EvalCounts, one for each path."""
+
+    if options is None:
+        options = parse_args([])    # use defaults
+
+    columns = [open_sidecar(Path(p)) for p in paths]
+    if all(c is not None for c in columns):
+        if any(len(c) != len(columns[0]) for c in columns):
+            raise FormatError('result files have different number of lines')
+        evaluate_sidecar = columns_evaluator(options)
+        return [evaluate_sidecar(c, options) for c in columns]
+
+    files = [open(p) for p in paths]
+    try:
+        return evaluate_multi(zip_result_files(files, options), options)
+    finally:
+        for f in files:
+            f.close()
 
 def uniq(iterable):
   seen = set()
@@ -231,15 +376,46 @@ def start_of_chunk(prev_tag, tag, prev_type, type_):
 
     return chunk_start
 
+def open_sidecar(path):
+    # The columnar sidecars (see results.py) are only read when run as
+    # part of the eval package, so that this file still works as a
+    # standalone script.
+    if not __package__:
+        return None
+
+    from .results import open_columns
+    return open_columns(path)
+
+def columns_evaluator(options):
+    if getattr(options, 'backend', 'python') == 'numpy':
+        from .conlleval_numpy import evaluate_columns as evaluate_numpy
+        return evaluate_numpy
+    else:
+        return evaluate_columns
+
 def main(argv):
     args = parse_args(argv[1:])
 
-    if args.file is None:
-        counts = evaluate(sys.stdin, args)
+    if args.backend == 'numpy':
+        from .conlleval_numpy import evaluate as evaluate_single
+    else:
+        evaluate_single = evaluate
+
+    if not args.files:
+        counts = evaluate_single(sys.stdin, args)
+        report(counts)
+    elif len(args.files) == 1:
+        columns = open_sidecar(Path(args.files[0]))
+        if columns is not None:
+            counts = columns_evaluator(args)(columns, args)
+        else:
+            with open(args.files[0]) as f:
+                counts = evaluate_single(f, args)
+        report(counts)
     else:
-        with open(args.file) as f:
-            counts = evaluate(f, args)
-    report(counts)
+        for path, counts in zip(args.files, evaluate_files(args.files, args)):
+            sys.stdout.write('%s:\n' % path)
+            report(counts)
 
 if __name__ == '__main__':
     sys.exit(main(sys.argv))
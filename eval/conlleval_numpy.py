@@ -0,0 +1,210 @@
+# Vectorized version of conlleval.evaluate
+#
+# The tags are encoded as integer arrays (chunk tag prefix and chunk
+# type) and the chunk boundaries are computed with array operations
+# instead of the token by token state machine. The results are
+# identical to conlleval.evaluate.
+
+from collections import defaultdict
+
+import numpy as np
+
+from .conlleval import EvalCounts, FormatError, parse_args, parse_tag, split_features
+
+
+class TagEncoder(object):
+    """Maps chunk tag prefixes and chunk types to small integers."""
+
+    def __init__(self):
+        self.prefixes = {}
+        self.types = {}
+        self.tags = {}
+        # The initial state before the first line
+        self.encode('O')
+
+    def encode(self, tag):
+        try:
+            return self.tags[tag]
+        except KeyError:
+            prefix, type_ = parse_tag(tag)
+            codes = (self.prefixes.setdefault(prefix, len(self.prefixes)),
+                     self.types.setdefault(type_, len(self.types)))
+            self.tags[tag] = codes
+            return codes
+
+    def prefix_codes(self, names):
+        return [self.prefixes[x] for x in names if x in self.prefixes]
+
+    def type_names(self):
+        names = [None]*len(self.types)
+        for name, code in self.types.items():
+            names[code] = name
+        return names
+
+def encode_lines(iterable, options=None, encoder=None):
+    """Parse result lines into tag code arrays.
+
+    Returns (correct_prefix, correct_type, guessed_prefix,
+    guessed_type, is_boundary, encoder)."""
+
+    if options is None:
+        options = parse_args([])    # use defaults
+    if encoder is None:
+        encoder = TagEncoder()
+
+    boundary_codes = encoder.encode('O')
+    correct_codes = []
+    guessed_codes = []
+    is_boundary = []
+    num_features = None
+
+    for line in iterable:
+        features = split_features(line, options)
+
+        if num_features is None:
+            num_features = len(features)
+        elif num_features != len(features) and len(features) != 0:
+            raise FormatError('unexpected number of features: %d (%d)' %
+                              (len(features), num_features))
+
+        if len(features) == 0 or features[0] == options.boundary:
+            correct_codes.append(boundary_codes)
+            guessed_codes.append(boundary_codes)
+            is_boundary.append(True)
+            continue
+        if len(features) < 3:
+            raise FormatError('unexpected number of features in line %s' % line)
+
+        correct_codes.append(encoder.encode(features[-2]))
+        guessed_codes.append(encoder.encode(features[-1]))
+        is_boundary.append(False)
+
+    correct = np.array(correct_codes, dtype=np.int32).reshape(-1, 2)
+    guessed = np.array(guessed_codes, dtype=np.int32).reshape(-1, 2)
+    return (correct[:, 0], correct[:, 1], guessed[:, 0], guessed[:, 1],
+            np.array(is_boundary, dtype=bool), encoder)
+
+def encode_columns(columns, options=None, encoder=None):
+    """Tag code arrays of a columnar result sidecar (see results.py).
+
+    Returns the same tuple as encode_lines."""
+
+    if options is None:
+        options = parse_args([])    # use defaults
+    if encoder is None:
+        encoder = TagEncoder()
+
+    boundary_codes = encoder.encode('O')
+    tag_codes = np.array([encoder.encode(t) for t in columns.tags],
+                         dtype=np.int32).reshape(-1, 2)
+    token_ids = np.frombuffer(columns.token_ids, dtype=np.int32)
+    is_boundary = token_ids == columns.token_id(options.boundary)
+
+    correct = tag_codes[np.frombuffer(columns.gold_ids, dtype=np.int32)]
+    guessed = tag_codes[np.frombuffer(columns.pred_ids, dtype=np.int32)]
+    correct[is_boundary] = boundary_codes
+    guessed[is_boundary] = boundary_codes
+    return (correct[:, 0], correct[:, 1], guessed[:, 0], guessed[:, 1],
+            is_boundary, encoder)
+
+def evaluate(iterable, options=None):
+    return count_chunks(*encode_lines(iterable, options))
+
+def evaluate_columns(columns, options=None):
+    return count_chunks(*encode_columns(columns, options))
+
+def count_chunks(correct_prefix, correct_type, guessed_prefix, guessed_type,
+                 is_boundary, encoder):
+    """Count chunks from tag code arrays. Returns an EvalCounts."""
+
+    counts = EvalCounts()
+    n = len(correct_prefix)
+    if n == 0:
+        return counts
+
+    o_prefix, empty_type = encoder.encode('O')
+    last_correct_prefix = shift(correct_prefix, o_prefix)
+    last_correct_type = shift(correct_type, empty_type)
+    last_guessed_prefix = shift(guessed_prefix, o_prefix)
+    last_guessed_type = shift(guessed_type, empty_type)
+
+    end_correct = end_of_chunk(encoder, last_correct_prefix, correct_prefix,
+                               last_correct_type, correct_type)
+    end_guessed = end_of_chunk(encoder, last_guessed_prefix, guessed_prefix,
+                               last_guessed_type, guessed_type)
+    start_correct = start_of_chunk(encoder, last_correct_prefix, correct_prefix,
+                                   last_correct_type, correct_type)
+    start_guessed = start_of_chunk(encoder, last_guessed_prefix, guessed_prefix,
+                                   last_guessed_type, guessed_type)
+
+    # in_correct of conlleval.evaluate after processing line u is
+    # in_correct[u] = starts[u] or (in_correct[u-1] and keeps[u]).
+    # It is true if the latest start is not older than the latest
+    # line that breaks the chunk.
+    closes = end_correct & end_guessed & (last_guessed_type == last_correct_type)
+    breaks = (end_correct != end_guessed) | (guessed_type != correct_type)
+    starts = start_correct & start_guessed & (guessed_type == correct_type)
+    keeps = ~closes & ~breaks
+
+    idx = np.arange(n)
+    latest_start = np.maximum.accumulate(np.where(starts, idx, -1))
+    latest_break = np.maximum.accumulate(np.where(keeps, -1, idx))
+    in_correct = (latest_start >= 0) & (latest_start >= latest_break)
+    was_in_correct = shift(in_correct, False)
+
+    correct_chunk_types = last_correct_type[was_in_correct & closes]
+    if in_correct[-1]:
+        correct_chunk_types = np.append(correct_chunk_types, correct_type[-1])
+
+    tokens = ~is_boundary
+    correct_tags = (tokens & (correct_prefix == guessed_prefix) &
+                    (correct_type == guessed_type))
+
+    counts.correct_chunk = len(correct_chunk_types)
+    counts.correct_tags = int(correct_tags.sum())
+    counts.found_correct = int(start_correct.sum())
+    counts.found_guessed = int(start_guessed.sum())
+    counts.token_counter = int(tokens.sum())
+
+    type_names = encoder.type_names()
+    counts.t_correct_chunk = counts_by_type(correct_chunk_types, type_names)
+    counts.t_found_correct = counts_by_type(correct_type[start_correct], type_names)
+    counts.t_found_guessed = counts_by_type(guessed_type[start_guessed], type_names)
+
+    return counts
+
+def shift(a, first):
+    """a shifted one step to the right, first as the first element."""
+    res = np.empty_like(a)
+    res[0] = first
+    res[1:] = a[:-1]
+    return res
+
+def counts_by_type(type_codes, type_names):
+    res = defaultdict(int)
+    for code, count in enumerate(np.bincount(type_codes, minlength=len(type_names))):
+        if count > 0:
+            res[type_names[code]] = int(count)
+    return res
+
+def end_of_chunk(encoder, prev_tag, tag, prev_type, type_):
+    # vectorized conlleval.end_of_chunk
+    def prev_is(*names):
+        return np.isin(prev_tag, encoder.prefix_codes(names))
+    def tag_is(*names):
+        return np.isin(tag, encoder.prefix_codes(names))
+
+    return (prev_is('E', 'S', '[', ']') |
+            (prev_is('B', 'I') & tag_is('B', 'S', 'O')) |
+            (~prev_is('O', '.') & (prev_type != type_)))
+
+def start_of_chunk(encoder, prev_tag, tag, prev_type, type_):
+    # vectorized conlleval.start_of_chunk
+    def prev_is(*names):
+        return np.isin(prev_tag, encoder.prefix_codes(names))
+    def tag_is(*names):
+        return np.isin(tag, encoder.prefix_codes(names))
+
+    return (tag_is('B', 'S', '[', ']') |
+            (prev_is('E', 'S', 'O') & tag_is('E', 'I')) |
+            (~tag_is('O', '.') & (prev_type != type_)))
@@ -1,51 +1,238 @@
+import hashlib
 import json
+import os
+import tempfile
+from .docstore import DocumentStore
 
 
 def load_documents(doc_dir, include_spans=True):
-    for p_txt in sorted(doc_dir.glob('*.txt')):
-        docid = p_txt.stem
+    """Load documents in the order of their IDs.
+
+    doc_dir is either a directory of .txt and .spans files or a packed
+    document store file (see docstore.py)."""
+    documents = open_documents(doc_dir)
+    for i in range(len(documents)):
+        yield documents.document(i, include_spans)
+
+
+def count_documents(doc_dir):
+    return len(open_documents(doc_dir))
+
+
+def open_documents(doc_dir):
+    """Random access to documents by their position or ID."""
+    if not doc_dir.exists():
+        raise FileNotFoundError(f'Documents not found at {doc_dir}')
+    elif doc_dir.is_file():
+        return DocumentStore(doc_dir)
+    else:
+        return DocumentDirectory(doc_dir)
+
+
+class DocumentDirectory():
+    """Documents stored as .txt and .spans files in a directory.
+
+    Has the same interface as docstore.DocumentStore."""
+
+    def __init__(self, doc_dir):
+        self.doc_dir = doc_dir
+        self.documents = [p.stem for p in sorted(doc_dir.glob('*.txt'))]
+        self.positions = {docid: i for i, docid in enumerate(self.documents)}
+
+    def __len__(self):
+        return len(self.documents)
+
+    def __iter__(self):
+        for i in range(len(self.documents)):
+            yield self.document(i)
+
+    def ids(self):
+        return list(self.documents)
+
+    def position(self, doc_id):
+        return self.positions[doc_id]
+
+    def document(self, i, include_spans=True):
+        docid = self.documents[i]
+        p_txt = self.doc_dir / f'{docid}.txt'
         p_spans = p_txt.with_suffix('.spans')
         if include_spans:
             with p_txt.open() as f_txt, p_spans.open() as f_spans:
-                yield {'id': docid, 'text': f_txt.read(), 'spans': json.load(f_spans)}
+                return {'id': docid, 'text': f_txt.read(), 'spans': json.load(f_spans)}
         else:
             with p_txt.open() as f_txt:
-                yield {'id': docid, 'text': f_txt.read()}
+                return {'id': docid, 'text': f_txt.read()}
 
 
-def count_documents(doc_dir):
-    return len(list(doc_dir.glob('*.txt')))
+def load_ground_truth(path):
+    with path.open() as f:
+        yield from parse_ground_truth(f)
 
 
-def load_ground_truth(path):
+def parse_ground_truth(lines):
     current_document = []
-    with path.open() as f:
-        for line in f:
-            line = line.strip()
-            if not line:
-                continue
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
 
-            features = line.split('\t')
-            if features[0] == '-DOCSTART-':
-                # new document starts
-                if current_document:
-                    yield current_document
+        features = line.split('\t')
+        if features[0] == '-DOCSTART-':
+            # new document starts
+            if current_document:
+                yield current_document
 
-                current_document = []
-            else:
-                current_document.append(features)
+            current_document = []
+        else:
+            current_document.append(features)
 
     if current_document:
         yield current_document
 
 
-def write_tsv2(tokens, fp):
-    fp.write('-DOCSTART-\tO\n')
-    for (text, entity) in tokens:
-        fp.write(f'{text}\t{entity}\n')
+class GroundTruthIndex():
+    """Random access to the documents of a ground truth file by their
+    position or ID.
+
+    The byte ranges and IDs of the documents are stored in an index file
+    next to the ground truth file (test.tsv.idx for test.tsv). The index
+    is rebuilt if the ground truth file has been modified. The document
+    ordinals are the same as in load_ground_truth(). The IDs are read
+    from the -DOCSTART- lines (see write_tsv2). They are None in files
+    written without them.
+
+    Every read opens the file separately, so several threads or
+    processes can read the same index in parallel."""
+
+    def __init__(self, path):
+        self.path = path
+        index = load_ground_truth_index(path)
+        self.ranges = index['ranges']
+        self.documents = index['ids']
+        self.positions = {docid: i for i, docid in enumerate(self.documents)
+                          if docid is not None}
+
+    def __len__(self):
+        return len(self.ranges)
+
+    def has_ids(self):
+        return len(self.positions) == len(self.documents)
+
+    def ids(self):
+        return list(self.documents)
+
+    def position(self, doc_id):
+        return self.positions[doc_id]
+
+    def __getitem__(self, i):
+        start, end = self.ranges[i]
+        with self.path.open('rb') as f:
+            f.seek(start)
+            data = f.read(end - start)
+
+        return next(parse_ground_truth(data.decode('utf-8').split('\n')))
+
+
+def ground_truth_index_path(path):
+    return path.with_name(path.name + '.idx')
+
+
+def load_ground_truth_index(path):
+    index_path = ground_truth_index_path(path)
+    stat = path.stat()
+    if index_path.exists():
+        with index_path.open() as f:
+            index = json.load(f)
+
+        # Indices written without the document IDs are rebuilt
+        same_size = 'ids' in index and index['size'] == stat.st_size
+        if same_size and index['mtime_ns'] == stat.st_mtime_ns:
+            return index
+
+        if same_size and index['sha256'] == file_sha256(path):
+            # Touched but not modified
+            index['mtime_ns'] = stat.st_mtime_ns
+            write_json_atomic(index, index_path)
+            return index
+
+    ranges, ids = build_ground_truth_index(path)
+    index = {
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+        'sha256': file_sha256(path),
+        'ranges': ranges,
+        'ids': ids,
+    }
+    write_json_atomic(index, index_path)
+    return index
+
+
+def build_ground_truth_index(path):
+    """Byte ranges and IDs of the non-empty documents in a ground truth
+    file."""
+    ranges = []
+    ids = []
+    start = 0
+    docid = None
+    has_tokens = False
+    pos = 0
+    with path.open('rb') as f:
+        for line in f:
+            features = line.strip().split(b'\t')
+            if features[0] == b'-DOCSTART-':
+                if has_tokens:
+                    ranges.append([start, pos])
+                    ids.append(docid)
+
+                start = pos
+                docid = features[2].decode('utf-8') if len(features) > 2 else None
+                has_tokens = False
+            elif features[0]:
+                has_tokens = True
+
+            pos += len(line)
+
+    if has_tokens:
+        ranges.append([start, pos])
+        ids.append(docid)
+
+    return ranges, ids
+
+
+def file_sha256(path):
+    h = hashlib.sha256()
+    with path.open('rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def write_json_atomic(obj, path):
+    """Write obj as JSON into path through a temporary file of its own,
+    so that several processes can write the same path at once."""
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=path.name + '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(obj, f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def write_tsv2(tokens, fp, docid=None):
+    """Write a ground truth document. The document ID, if given, is
+    stored in the third column of the -DOCSTART- line."""
+    if docid is None:
+        lines = ['-DOCSTART-\tO\n']
+    else:
+        lines = [f'-DOCSTART-\tO\t{docid}\n']
+    lines.extend([f'{text}\t{entity}\n' for (text, entity) in tokens])
+    fp.writelines(lines)
 
 
 def write_tsv3(tokens, fp):
-    fp.write('-DOCSTART-\tO\tO\n')
-    for (text, grount_truth_entity, predicted_entity) in tokens:
-        fp.write(f'{text}\t{grount_truth_entity}\t{predicted_entity}\n')
+    lines = ['-DOCSTART-\tO\tO\n']
+    lines.extend([f'{text}\t{grount_truth_entity}\t{predicted_entity}\n'
+                  for (text, grount_truth_entity, predicted_entity) in tokens])
+    fp.writelines(lines)
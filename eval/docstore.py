@@ -0,0 +1,163 @@
+"""A packed, memory-mapped store of documents and token spans.
+
+All documents of a corpus are stored in a single file:
+
+    magic
+    text blob       the UTF-8 encoded texts of all documents
+    span array      (offset, length) int32 pairs of all tokens, in
+                    characters from the start of the document
+    index           JSON: document IDs and their ranges in the text
+                    blob and the span array
+    footer          the byte offsets of the parts above and the magic
+
+The reader memory-maps the file. Text and span slices are returned as
+views into the mapping without copying, and several processes reading
+the same file share the page cache.
+"""
+
+import json
+import mmap
+import os
+import shutil
+import struct
+import sys
+import tempfile
+from array import array
+
+magic = b'FINERDOC'
+version = 1
+footer_format = '<QQQQQQ8s'
+footer_size = struct.calcsize(footer_format)
+
+
+class DocumentStoreWriter():
+    """Writes documents into a packed store one at a time."""
+
+    def __init__(self, path):
+        self.path = path
+        self.tmp_path = path.with_name(path.name + '.tmp')
+        self.file = open(self.tmp_path, 'wb')
+        self.file.write(magic)
+        self.text_start = self.file.tell()
+        self.spans_file = tempfile.TemporaryFile()
+        self.num_spans = 0
+        self.documents = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.file.close()
+            self.spans_file.close()
+            os.unlink(self.tmp_path)
+
+    def add(self, doc_id, text, spans):
+        """Add a document. spans is a list of {'token': str, 'offset':
+        int} dicts."""
+        text_start = self.file.tell() - self.text_start
+        self.file.write(text.encode('utf-8'))
+        text_end = self.file.tell() - self.text_start
+
+        pairs = array('i')
+        for span in spans:
+            pairs.append(span['offset'])
+            pairs.append(len(span['token']))
+        self.spans_file.write(pairs.tobytes())
+
+        self.documents.append([doc_id, text_start, text_end,
+                               self.num_spans, self.num_spans + len(spans)])
+        self.num_spans += len(spans)
+
+    def close(self):
+        text_end = self.file.tell()
+        self.file.write(b'\0' * (-text_end % 8))
+
+        spans_start = self.file.tell()
+        self.spans_file.seek(0)
+        shutil.copyfileobj(self.spans_file, self.file)
+        self.spans_file.close()
+        spans_end = self.file.tell()
+
+        index = {
+            'version': version,
+            'byteorder': sys.byteorder,
+            'documents': sorted(self.documents),
+        }
+        index_start = self.file.tell()
+        self.file.write(json.dumps(index, ensure_ascii=False).encode('utf-8'))
+        index_end = self.file.tell()
+
+        self.file.write(struct.pack(footer_format, self.text_start, text_end,
+                                    spans_start, spans_end, index_start,
+                                    index_end, magic))
+        self.file.close()
+        os.replace(self.tmp_path, self.path)
+
+
+class DocumentStore():
+    """Read-only access to a packed document store.
+
+    The documents are ordered by their IDs."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        (text_start, text_end, spans_start, spans_end, index_start,
+         index_end, footer_magic) = struct.unpack_from(
+             footer_format, self.mmap, len(self.mmap) - footer_size)
+        if self.mmap[:len(magic)] != magic or footer_magic != magic:
+            raise ValueError(f'{path} is not a document store')
+
+        index = json.loads(self.mmap[index_start:index_end].decode('utf-8'))
+        if index['byteorder'] != sys.byteorder:
+            raise ValueError(f'{path} was written on a machine with a different byte order')
+
+        view = memoryview(self.mmap)
+        self.texts = view[text_start:text_end]
+        self.spans = view[spans_start:spans_end].cast('i')
+        self.documents = index['documents']
+        self.positions = {d[0]: i for i, d in enumerate(self.documents)}
+
+    def __len__(self):
+        return len(self.documents)
+
+    def __iter__(self):
+        for i in range(len(self.documents)):
+            yield self.document(i)
+
+    def ids(self):
+        return [d[0] for d in self.documents]
+
+    def position(self, doc_id):
+        return self.positions[doc_id]
+
+    def text_bytes(self, i):
+        """The UTF-8 encoded text of the ith document as a memoryview."""
+        _, text_start, text_end, _, _ = self.documents[i]
+        return self.texts[text_start:text_end]
+
+    def text(self, i):
+        return str(self.text_bytes(i), 'utf-8')
+
+    def span_array(self, i):
+        """The (offset, length) pairs of the tokens of the ith document
+        as a flat int32 memoryview."""
+        _, _, _, span_start, span_end = self.documents[i]
+        return self.spans[2*span_start:2*span_end]
+
+    def document(self, i, include_spans=True):
+        """The ith document in the format of data.load_documents."""
+        doc_id = self.documents[i][0]
+        text = self.text(i)
+        if not include_spans:
+            return {'id': doc_id, 'text': text}
+
+        pairs = self.span_array(i)
+        spans = [{'token': text[offset:offset + length], 'offset': offset}
+                 for offset, length in zip(pairs[::2], pairs[1::2])]
+        return {'id': doc_id, 'text': text, 'spans': spans}
@@ -1,5 +1,18 @@
+from itertools import islice
+
+
 def flat_map(f, xs):
     ys = []
     for x in xs:
         ys.extend(f(x))
     return ys
+
+
+def chunked(xs, n):
+    """Split the iterable xs into lists of (at most) n items."""
+    it = iter(xs)
+    while True:
+        chunk = list(islice(it, n))
+        if not chunk:
+            return
+        yield chunk
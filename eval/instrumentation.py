@@ -0,0 +1,220 @@
+"""Stage timers, counters and latency histograms for evaluation runs.
+
+The pipeline code records its stages into the module-level
+instrumentation object:
+
+    with instrumentation.stage('merge_ground_truth'):
+        ...
+    instrumentation.count('tokens', len(tokens))
+
+Stages can be nested. For each stage, both the total (inclusive) time
+and the self time (excluding nested stages on the same thread) are
+reported. Durations measured elsewhere, for example of concurrent
+asyncio requests, can be recorded with observe().
+
+At the end of a run, report() summarizes the stages, counters and
+throughput, and write_json() exports the summary. profiling() adds
+optional cProfile and tracemalloc data.
+"""
+
+import cProfile
+import json
+import logging
+import math
+import threading
+import time
+import tracemalloc
+from collections import defaultdict
+from contextlib import contextmanager
+
+
+class LatencyHistogram():
+    """A histogram of durations in logarithmic buckets.
+
+    The percentiles are accurate to a relative error of growth - 1.
+    The memory use does not depend on the number of samples."""
+
+    def __init__(self, growth=1.02, minimum=1e-7):
+        self.growth = growth
+        self.log_growth = math.log(growth)
+        self.minimum = minimum
+        self.buckets = defaultdict(int)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        i = int(math.log(max(seconds, self.minimum) / self.minimum) / self.log_growth)
+        self.buckets[i] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, q):
+        """The duration under which q (0 < q <= 1) of the samples are."""
+        if self.count == 0:
+            return 0.0
+
+        rank = q * self.count
+        seen = 0
+        for i in sorted(self.buckets):
+            seen += self.buckets[i]
+            if seen >= rank:
+                return min(self.minimum * self.growth**(i + 1), self.max)
+
+        return self.max
+
+    def summary(self):
+        return {
+            'calls': self.count,
+            'total_s': self.total,
+            'mean_s': self.total / self.count if self.count else 0.0,
+            'p50_s': self.percentile(0.50),
+            'p95_s': self.percentile(0.95),
+            'p99_s': self.percentile(0.99),
+            'max_s': self.max,
+        }
+
+
+class Instrumentation():
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.reset()
+
+    def reset(self):
+        self.histograms = defaultdict(LatencyHistogram)
+        self.self_times = defaultdict(float)
+        self.counters = defaultdict(int)
+        self.started = time.perf_counter()
+        self.finished = None
+
+    def start(self):
+        self.reset()
+
+    def finish(self):
+        self.finished = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name):
+        """Time a stage on the current thread."""
+        stack = getattr(self.local, 'stack', None)
+        if stack is None:
+            stack = self.local.stack = []
+
+        # Time spent in nested stages
+        stack.append(0.0)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            nested = stack.pop()
+            if stack:
+                stack[-1] += elapsed
+            with self.lock:
+                self.histograms[name].add(elapsed)
+                self.self_times[name] += elapsed - nested
+
+    def timed(self, name, iterable):
+        """Iterate over iterable, timing each next() as the stage name."""
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def observe(self, name, seconds):
+        """Record a duration measured by the caller."""
+        with self.lock:
+            self.histograms[name].add(seconds)
+            self.self_times[name] += seconds
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+
+    def report(self):
+        end = self.finished if self.finished is not None else time.perf_counter()
+        wall = end - self.started
+        stages = {}
+        for name, histogram in self.histograms.items():
+            stages[name] = histogram.summary()
+            stages[name]['self_s'] = self.self_times[name]
+
+        return {
+            'wall_s': wall,
+            'stages': stages,
+            'counters': dict(self.counters),
+            'throughput': {
+                f'{name}_per_s': n / wall if wall > 0 else 0.0
+                for name, n in self.counters.items()
+            },
+        }
+
+    def log_summary(self, report=None):
+        if report is None:
+            report = self.report()
+
+        throughput = ', '.join(f'{v:.1f} {k.replace("_per_s", "/s")}'
+                               for k, v in report['throughput'].items())
+        logging.info(f'Finished in {report["wall_s"]:.1f} s: {throughput}')
+        stages = sorted(report['stages'].items(), key=lambda x: x[1]['self_s'], reverse=True)
+        for name, s in stages:
+            logging.info(f'{name:>20}: {s["calls"]} calls, total {s["total_s"]:.2f} s, '
+                         f'self {s["self_s"]:.2f} s, p50 {1000*s["p50_s"]:.1f} ms, '
+                         f'p95 {1000*s["p95_s"]:.1f} ms, p99 {1000*s["p99_s"]:.1f} ms')
+
+    def write_json(self, path, extra=None):
+        report = self.report()
+        if extra:
+            report.update(extra)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with path.open('w') as f:
+            json.dump(report, f, indent=2)
+        return report
+
+
+instrumentation = Instrumentation()
+
+
+@contextmanager
+def profiling(profile_path=None, trace_memory=False, top=20):
+    """Optionally run cProfile and tracemalloc.
+
+    The cProfile statistics of the current thread are written to
+    profile_path. Yields a dict that is filled with the tracemalloc
+    results (peak memory and the top allocation sites) on exit."""
+
+    results = {}
+    profiler = None
+    if profile_path is not None:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    if trace_memory:
+        tracemalloc.start()
+
+    try:
+        yield results
+    finally:
+        if trace_memory:
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            results['memory'] = {
+                'current_bytes': current,
+                'peak_bytes': peak,
+                'top_allocations': [
+                    {'location': str(stat.traceback), 'size_bytes': stat.size,
+                     'count': stat.count}
+                    for stat in snapshot.statistics('lineno')[:top]
+                ],
+            }
+        if profiler is not None:
+            profiler.disable()
+            profile_path.parent.mkdir(parents=True, exist_ok=True)
+            profiler.dump_stats(profile_path)
+            logging.info(f'Wrote profile to {profile_path}')
@@ -0,0 +1,87 @@
+"""A cache of conlleval counts of result files.
+
+The counts are stored in a JSON file, keyed by the SHA-256 hash of the
+result file and the scoring options. The hash of a file is recomputed
+only when its size or modification time changes, so loading the
+counts of unchanged result files does not read them at all. Only new
+or changed result files are scored, one file at a time.
+"""
+
+import json
+import logging
+import os
+from collections import defaultdict
+from pathlib import Path
+from .conlleval import EvalCounts, evaluate_files
+from .data import file_sha256, write_json_atomic
+
+default_cache_path = Path('ner_results/metrics_cache.json')
+
+# Increment when a change in the scoring invalidates the cached counts
+version = 1
+
+
+class MetricsCache():
+    def __init__(self, path=default_cache_path):
+        self.path = path
+        self.files = {}
+        self.counts = {}
+        if path.exists():
+            with path.open() as f:
+                cached = json.load(f)
+            if cached.get('version') == version:
+                self.files = cached['files']
+                self.counts = cached['counts']
+
+    def evaluate(self, paths, options):
+        """EvalCounts of each result file in paths.
+
+        The files are scored separately, so they don't need to have the
+        same tokens. Each file is cached as soon as it has been scored."""
+        keys = [self.key(p, options) for p in paths]
+        for p, k in zip(paths, keys):
+            if k not in self.counts:
+                logging.info(f'Scoring {p}')
+                self.counts[k] = counts_as_dict(evaluate_files([p], options)[0])
+                self.save()
+
+        self.save()
+        return [counts_from_dict(self.counts[k]) for k in keys]
+
+    def key(self, path, options):
+        stat = os.stat(path)
+        entry = self.files.get(str(path))
+        if (entry is None or entry['size'] != stat.st_size or
+                entry['mtime_ns'] != stat.st_mtime_ns):
+            entry = {
+                'size': stat.st_size,
+                'mtime_ns': stat.st_mtime_ns,
+                'sha256': file_sha256(path),
+            }
+            self.files[str(path)] = entry
+
+        return json.dumps([entry['sha256'], options.boundary, options.delimiter, options.otag])
+
+    def save(self):
+        # Forget the counts of result files that no longer exist
+        self.files = {p: entry for p, entry in self.files.items() if Path(p).exists()}
+        live_hashes = {entry['sha256'] for entry in self.files.values()}
+        self.counts = {k: c for k, c in self.counts.items() if json.loads(k)[0] in live_hashes}
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        write_json_atomic({'version': version, 'files': self.files, 'counts': self.counts},
+                          self.path)
+
+
+def counts_as_dict(counts):
+    return {key: dict(value) if isinstance(value, dict) else value
+            for key, value in vars(counts).items()}
+
+
+def counts_from_dict(d):
+    counts = EvalCounts()
+    for key, value in d.items():
+        if isinstance(value, dict):
+            value = defaultdict(int, value)
+        setattr(counts, key, value)
+    return counts
@@ -0,0 +1,447 @@
+"""Local stand-ins for the NER services and a load generator.
+
+Usage:
+python -m eval.mock_servers turku --port 8080
+python -m eval.mock_servers azure --port 5000
+python -m eval.mock_servers nertag --install /tmp/mock-tagtools
+python -m eval.mock_servers load turku --url http://localhost:8080 --concurrency 8
+
+The mock services tokenize the input text, tag every run of
+capitalized words (other than the first word of a line) as an entity
+and choose its type by a hash of the first word, so the same text
+always gets the same entities. Latency, the rate of failed requests
+and a request rate limit can be configured:
+
+turku   answers GET requests like the keras-bert-ner server on port
+        8080. Failed requests return 500, and requests over the rate
+        limit get 503 with a Retry-After header.
+azure   implements the entity recognition operation of the Text
+        Analytics API v3.1 used by azure-ai-textanalytics. Requests
+        over the rate limit get 429 with a Retry-After header.
+nertag  is a filter with the input and output format of
+        finnish-nertag. With --install, writes a finnish-nertag script
+        that runs it into the given directory, for ner-finer.py
+        --tagtools-dir. The installed filters share the rate limit
+        through a state file in that directory: processes over the
+        limit wait for their turn.
+
+The load generator runs the client code of a backend (ner-turku.py,
+ner-azure.py or ner-finer.py) against a server (by default, the mock
+server on its default port) or tagtools directory and reports the
+throughput and latency percentiles (see instrumentation.py).
+"""
+
+import argparse
+import fcntl
+import importlib
+import json
+import math
+import random
+import re
+import stat
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlparse
+from .instrumentation import instrumentation
+from .synthetic import SyntheticCorpus, entity_types
+
+token_re = re.compile(r'\w+|[^\w\s]')
+
+default_ports = {
+    'turku': 8080,
+    'azure': 5000,
+}
+
+azure_categories = {
+    'PERSON': ('Person', None),
+    'ORG': ('Organization', None),
+    'GPE': ('Location', 'GPE'),
+    'LOC': ('Location', None),
+    'EVENT': ('Event', None),
+    'PRODUCT': ('Product', None),
+}
+
+finer_tags = {
+    'PERSON': 'EnamexPrsHum',
+    'ORG': 'EnamexOrgCrp',
+    'GPE': 'EnamexLocPpl',
+    'LOC': 'EnamexLocGpl',
+    'EVENT': 'EnamexEvtXxx',
+    'PRODUCT': 'EnamexProXxx',
+}
+
+
+def main():
+    args = parse_args()
+    args.func(args)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Mock NER services and a load generator')
+    subparsers = parser.add_subparsers(required=True)
+
+    def add_behaviour_arguments(p):
+        p.add_argument('--latency', type=float, default=0.0,
+                       help='Mean response time in seconds')
+        p.add_argument('--jitter', type=float, default=0.0,
+                       help='Standard deviation of the response time in seconds')
+        p.add_argument('--error-rate', type=float, default=0.0,
+                       help='Fraction of requests that fail')
+        p.add_argument('--requests-per-second', type=float,
+                       help='Rate limit of the service')
+        p.add_argument('--seed', type=int, default=0,
+                       help='Seed of the latency and error generator')
+
+    p = subparsers.add_parser('turku', help='Mock keras-bert-ner server')
+    p.add_argument('--port', type=int, default=default_ports['turku'])
+    add_behaviour_arguments(p)
+    p.set_defaults(func=lambda args: serve(TurkuHandler, args))
+
+    p = subparsers.add_parser('azure', help='Mock Azure Text Analytics endpoint')
+    p.add_argument('--port', type=int, default=default_ports['azure'])
+    add_behaviour_arguments(p)
+    p.set_defaults(func=lambda args: serve(AzureHandler, args))
+
+    p = subparsers.add_parser('nertag', help='Mock finnish-nertag filter')
+    p.add_argument('--install', type=Path,
+                   help='Write a finnish-nertag script running this filter into this directory')
+    p.add_argument('--rate-state', type=Path,
+                   help='File in which the filter processes share the rate limit')
+    add_behaviour_arguments(p)
+    p.set_defaults(func=run_nertag)
+
+    p = subparsers.add_parser('load', help='Measure client throughput and latency')
+    p.add_argument('backend', choices=['turku', 'azure', 'finer'])
+    p.add_argument('--url', help='URL of the turku or azure server '
+                   '(default: the mock server on its default port)')
+    p.add_argument('--tagtools-dir', help='Directory of the (mock) finnish-nertag')
+    p.add_argument('--concurrency', type=int, default=4,
+                   help='Requests in flight (FiNER: parallel processes)')
+    p.add_argument('--tokens', type=int, default=100000,
+                   help='Size of the synthetic corpus sent to the service')
+    p.add_argument('--output', type=Path, help='Write the measurements as JSON into this file')
+    p.set_defaults(func=run_load)
+
+    return parser.parse_args()
+
+
+class MockBehaviour():
+    """Latency, random failures and a rate limit of a mock service."""
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0,
+                 requests_per_second=None, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.requests_per_second = requests_per_second
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        # Token bucket of the rate limit
+        self.tokens = requests_per_second or 0.0
+        self.updated = time.monotonic()
+
+    @classmethod
+    def from_args(cls, args):
+        return cls(args.latency, args.jitter, args.error_rate, args.requests_per_second, args.seed)
+
+    def throttle(self):
+        """Returns 0 if the request is allowed, otherwise the number
+        of seconds until the next request is allowed."""
+        if not self.requests_per_second:
+            return 0.0
+
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.requests_per_second,
+                              self.tokens + (now - self.updated) * self.requests_per_second)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0.0
+            else:
+                return (1 - self.tokens) / self.requests_per_second
+
+    def respond(self):
+        """Sleep for the response time. Returns False if the request
+        should fail."""
+        with self.lock:
+            delay = max(0.0, self.rng.gauss(self.latency, self.jitter)) if self.jitter else self.latency
+            failed = self.rng.random() < self.error_rate
+        if delay:
+            time.sleep(delay)
+        return not failed
+
+
+def tokenize(text):
+    """(token, offset) pairs of the tokens of text."""
+    return [(m.group(), m.start()) for m in token_re.finditer(text)]
+
+
+def mock_entities(text):
+    """(start token index, end token index, type) of the mock entities
+    and the (token, offset) pairs of each line of text.
+
+    Returns a list of (tokens, entities) pairs, one for each line."""
+    res = []
+    offset = 0
+    for line in text.split('\n'):
+        tokens = [(t, offset + i) for t, i in tokenize(line)]
+        entities = []
+        i = 1
+        while i < len(tokens):
+            if tokens[i][0][0].isupper():
+                j = i + 1
+                while j < len(tokens) and tokens[j][0][0].isupper():
+                    j += 1
+                entity_type = entity_types[zlib.crc32(tokens[i][0].encode('utf-8')) % len(entity_types)]
+                entities.append((i, j, entity_type))
+                i = j
+            else:
+                i += 1
+        res.append((tokens, entities))
+        offset += len(line) + 1
+    return res
+
+
+def turku_response(text):
+    lines = []
+    for tokens, entities in mock_entities(text):
+        tags = ['O'] * len(tokens)
+        for start, end, entity_type in entities:
+            tags[start] = 'B-' + entity_type
+            for k in range(start + 1, end):
+                tags[k] = 'I-' + entity_type
+        lines.extend(f'{token}\t{tag}\n' for (token, _), tag in zip(tokens, tags))
+    return ''.join(lines)
+
+
+def azure_entities(text):
+    res = []
+    for tokens, entities in mock_entities(text):
+        for start, end, entity_type in entities:
+            offset = tokens[start][1]
+            length = tokens[end - 1][1] + len(tokens[end - 1][0]) - offset
+            category, subcategory = azure_categories[entity_type]
+            entity = {
+                'text': text[offset:offset + length],
+                'category': category,
+                'offset': offset,
+                'length': length,
+                'confidenceScore': 0.9,
+            }
+            if subcategory:
+                entity['subcategory'] = subcategory
+            res.append(entity)
+    return res
+
+
+def nertag_output(text):
+    lines = []
+    for tokens, entities in mock_entities(text):
+        tags = [''] * len(tokens)
+        for start, end, entity_type in entities:
+            name = finer_tags[entity_type]
+            if end - start == 1:
+                tags[start] = f'<{name}/>'
+            else:
+                tags[start] = f'<{name}>'
+                tags[end - 1] = f'</{name}>'
+        lines.extend(f'{token}\t{tag}\n' for (token, _), tag in zip(tokens, tags))
+        if tokens:
+            lines.append('\n')
+    return ''.join(lines)
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    behaviour = None
+    protocol_version = 'HTTP/1.1'
+
+    def send_body(self, status, body, content_type, headers=None):
+        data = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TurkuHandler(MockHandler):
+    def do_GET(self):
+        query = parse_qs(urlparse(self.path).query)
+        text = query.get('text', [''])[0]
+
+        retry_after = self.behaviour.throttle()
+        if retry_after:
+            self.send_body(503, 'Too many requests\n', 'text/plain',
+                           {'Retry-After': str(math.ceil(retry_after))})
+        elif not self.behaviour.respond():
+            self.send_body(500, 'Mock failure\n', 'text/plain')
+        else:
+            self.send_body(200, turku_response(text), 'text/plain; charset=utf-8')
+
+
+class AzureHandler(MockHandler):
+    path_re = re.compile(r'^/text/analytics/v3\.[01]/entities/recognition/general$')
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length)
+        if not self.path_re.match(urlparse(self.path).path):
+            self.send_error_json(404, 'NotFound', f'Unknown path {self.path}')
+            return
+
+        retry_after = self.behaviour.throttle()
+        if retry_after:
+            self.send_error_json(429, '429', 'Rate limit is exceeded.',
+                                 {'Retry-After': str(math.ceil(retry_after))})
+            return
+        if not self.behaviour.respond():
+            self.send_error_json(500, 'InternalServerError', 'Mock failure')
+            return
+
+        documents = json.loads(body)['documents']
+        result = {
+            'documents': [{'id': doc['id'], 'entities': azure_entities(doc['text']),
+                           'warnings': []}
+                          for doc in documents],
+            'errors': [],
+            'modelVersion': '2021-06-01',
+        }
+        self.send_body(200, json.dumps(result, ensure_ascii=False), 'application/json; charset=utf-8')
+
+    def send_error_json(self, status, code, message, headers=None):
+        body = json.dumps({'error': {'code': code, 'message': message}})
+        self.send_body(status, body, 'application/json', headers)
+
+
+def make_server(handler, port, behaviour):
+    """A mock server on localhost. Port 0 picks a free port."""
+    handler_class = type(handler.__name__, (handler,), {'behaviour': behaviour})
+    return ThreadingHTTPServer(('localhost', port), handler_class)
+
+
+def serve(handler, args):
+    server = make_server(handler, args.port, MockBehaviour.from_args(args))
+    print(f'Listening on http://localhost:{server.server_address[1]}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+def run_nertag(args):
+    if args.install:
+        install_nertag(args.install, args)
+        return
+
+    behaviour = MockBehaviour.from_args(args)
+    text = sys.stdin.read()
+    if args.requests_per_second and args.rate_state:
+        wait_for_turn(args.rate_state, args.requests_per_second)
+    if not behaviour.respond():
+        sys.stderr.write('Mock failure\n')
+        sys.exit(1)
+    sys.stdout.write(nertag_output(text))
+
+
+def install_nertag(directory, args):
+    """Write a finnish-nertag script that runs the mock filter."""
+    directory.mkdir(parents=True, exist_ok=True)
+    repo_root = Path(__file__).resolve().parent.parent
+    options = (f'--latency {args.latency} --jitter {args.jitter} '
+               f'--error-rate {args.error_rate} --seed {args.seed}')
+    if args.requests_per_second:
+        rate_state = (directory / 'rate-state').resolve()
+        options += f' --requests-per-second {args.requests_per_second} --rate-state "{rate_state}"'
+    path = directory / 'finnish-nertag'
+    path.write_text('#!/bin/sh\n'
+                    f'PYTHONPATH="{repo_root}" exec "{sys.executable}" -m eval.mock_servers '
+                    f'nertag {options}\n')
+    path.chmod(path.stat().st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    print(f'Wrote {path}')
+
+
+def wait_for_turn(state_path, requests_per_second):
+    """Sleep until this process may start under the rate limit shared
+    by all processes using state_path.
+
+    The state file holds the earliest start time of the next process."""
+    with open(state_path, 'a+') as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            f.seek(0)
+            content = f.read().strip()
+            now = time.time()
+            start = max(now, float(content)) if content else now
+            f.seek(0)
+            f.truncate()
+            f.write(str(start + 1/requests_per_second))
+            f.flush()
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    if start > now:
+        time.sleep(start - now)
+
+
+def run_load(args):
+    corpus = SyntheticCorpus(args.tokens)
+    documents = corpus.input_documents()
+
+    instrumentation.start()
+    if args.backend == 'turku':
+        turku = importlib.import_module('eval.ner-turku')
+        session = turku.ner_session(args.concurrency)
+        url = args.url or f'http://localhost:{default_ports["turku"]}'
+        predictions = turku.predict_all(session, documents, url, args.concurrency)
+        stage = 'turku_request'
+    elif args.backend == 'azure':
+        azure = importlib.import_module('eval.ner-azure')
+        # Keep the debugging copies of the responses out of ner_results
+        azure.cache_dir = Path(tempfile.mkdtemp(prefix='mock-azure-'))
+        url = args.url or f'http://localhost:{default_ports["azure"]}'
+        secrets = {'azure_ner': {'endpoint': url, 'api_key': 'mock'}}
+        predictions = azure.predict_all(secrets, documents, args.concurrency)
+        stage = 'azure_request'
+    else:
+        finer = importlib.import_module('eval.ner-finer')
+        predictions = finer.predict_all(documents, args.concurrency, tagtools_dir=args.tagtools_dir)
+        stage = 'finer_process'
+
+    for _ in predictions:
+        instrumentation.count('documents')
+    instrumentation.count('tokens', corpus.num_tokens)
+    instrumentation.finish()
+
+    report = instrumentation.report()
+    latency = report['stages'].get(stage, {})
+    print(f'{report["counters"]["documents"]} documents in {report["wall_s"]:.2f} s: '
+          f'{report["throughput"]["documents_per_s"]:.1f} documents/s, '
+          f'{report["throughput"]["tokens_per_s"]:.0f} tokens/s')
+    if latency:
+        print(f'{latency["calls"]} requests: p50 {1000*latency["p50_s"]:.1f} ms, '
+              f'p95 {1000*latency["p95_s"]:.1f} ms, p99 {1000*latency["p99_s"]:.1f} ms, '
+              f'max {1000*latency["max_s"]:.1f} ms')
+    if report['counters'].get('azure_throttled'):
+        print(f'{report["counters"]["azure_throttled"]} requests were throttled')
+    if report['counters'].get('azure_retried'):
+        print(f'{report["counters"]["azure_retried"]} failed requests were retried')
+
+    if args.output:
+        args.output.parent.mkdir(parents=True, exist_ok=True)
+        with args.output.open('w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
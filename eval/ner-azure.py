@@ -1,16 +1,24 @@
 import argparse
-import copy
+import asyncio
 import json
 import logging
+import threading
+import time
 from azure.core.credentials import AzureKeyCredential
-from azure.ai.textanalytics import TextAnalyticsClient
+from azure.core.exceptions import HttpResponseError, ServiceRequestError, ServiceResponseError
+from azure.ai.textanalytics.aio import TextAnalyticsClient
+from collections import deque
 from pathlib import Path
-from tqdm import tqdm
-from .alignment import merge_ground_truth
-from .data import load_documents, count_documents, load_ground_truth, write_tsv3
+from .cache import add_cache_arguments, open_cache, predict_with_cache
+from .instrumentation import instrumentation
+from .offsets import TokenOffsetIndex
+from .runner import add_runner_arguments, run_evaluation
 
 cache_dir = Path('ner_results/azure/responses')
 
+# The maximum number of documents in one entity recognition request
+max_documents_per_request = 5
+
 
 def main():
     args = parse_args()
@@ -19,32 +27,32 @@ def main():
                         level=getattr(logging, args.loglevel.upper()))
     logging.getLogger('azure.core.pipeline.policies.http_logging_policy').setLevel(logging.WARNING)
 
-    doc_dir = Path('data/preprocessed/documents')
-    ground_truth_file = Path('data/preprocessed/turku-one/test.tsv')
-    output_path = Path('ner_results/azure.tsv')
-
-    secrets = load_secrets()
-    text_analytics_client = ner_client(secrets)
+    cache = open_cache(args)
+    if args.cached_response:
+        def predict_responses(documents):
+            return ((doc, predict_cached(doc)) for doc in documents)
+    else:
+        secrets = load_secrets()
+        rate_limiter = RequestRateLimiter(args.requests_per_minute)
+        cache_config = {'endpoint': secrets['azure_ner']['endpoint'], 'language': 'fi'}
 
-    documents = load_documents(doc_dir)
-    num_documents = count_documents(doc_dir)
-    ground_truth_by_documents = load_ground_truth(ground_truth_file)
-    with open(output_path, 'w') as output_f:
-        for doc, ground_truth in tqdm(zip(documents, ground_truth_by_documents), total=num_documents):
-            if args.cached_response:
-                response = predict_cached(doc)
-            else:
-                response = predict(text_analytics_client, doc)
+        def predict_responses(documents):
+            return predict_with_cache(
+                cache, 'azure', cache_config, documents,
+                lambda docs: predict_all(secrets, docs, args.concurrency, rate_limiter))
 
-            # First, align entities with the input tokens using the
-            # known offsets
-            predicted = align_with_input(doc, response)
+    def predict_documents(documents):
+        # Align entities with the input tokens using the known offsets
+        for doc, response in predict_responses(documents):
+            with instrumentation.stage('align_with_input'):
+                predicted = align_with_input(doc, response)
+            yield doc, predicted
 
-            # Next, sequence align the input tokens with the ground
-            # truth tokens
-            features = merge_ground_truth(doc['id'], predicted, ground_truth)
+    run_evaluation(predict_documents, args)
 
-            write_tsv3(features, output_f)
+    if cache:
+        logging.info(f'Prediction cache: {cache.stats()}')
+        cache.close()
 
 
 def parse_args():
@@ -52,7 +60,13 @@ def parse_args():
     parser.add_argument('--cached-response', action='store_true',
                         default=False,
                         help='Use cached results instead of calling the Azure cloud API')
+    parser.add_argument('--concurrency', type=int, default=4,
+                        help='Maximum number of Azure requests in flight')
+    parser.add_argument('--requests-per-minute', type=int,
+                        help='Request quota of the Azure text analytics resource')
     parser.add_argument('--loglevel', default='INFO', help='Set the log level')
+    add_cache_arguments(parser)
+    add_runner_arguments(parser, 'ner_results/azure.tsv')
     return parser.parse_args()
 
 
@@ -62,19 +76,230 @@ def load_secrets():
 
 
 def ner_client(secrets):
+    """Create an async text analytics client.
+
+    The client does not retry failed requests by itself. recognize_batch
+    retries throttled requests through the RequestRateLimiter and
+    server and connection errors with an exponential backoff."""
     credential = AzureKeyCredential(secrets['azure_ner']['api_key'])
     endpoint = secrets['azure_ner']['endpoint']
-    return TextAnalyticsClient(endpoint, credential)
-
-
-def predict(client, doc):
-    parts = split_long_document(doc)
-    response = client.recognize_entities(parts, language="fi")
+    return TextAnalyticsClient(endpoint, credential, retry_total=0)
+
+
+def predict_all(secrets, documents, concurrency=4, rate_limiter=None, max_pending=200):
+    """Recognize entities on documents in batched, concurrent requests.
+
+    The parts (see split_long_document) of the documents are packed into
+    requests of max_documents_per_request parts, and up to concurrency
+    requests are in flight at the same time. The requests are sent on an
+    event loop in a background thread. Up to max_pending documents are
+    read ahead of the one being yielded, so that requests keep running
+    while the caller processes the results.
+
+    Yields (document, response) pairs in the same order as the input
+    documents. The response is a list of result objects, one for each
+    part of the document. The character offset of the part in the
+    document is stored in the 'offset' key of each result object."""
+
+    if rate_limiter is None:
+        rate_limiter = RequestRateLimiter()
+
+    # (document, parts, futures of the requests containing the parts)
+    # in input order
+    pending = deque()
+    # The parts not yet sent and the pending entries they belong to
+    batch = []
+    batch_entries = []
+    doc_iter = iter(documents)
+    exhausted = False
+
+    with EntityRecognizer(secrets, concurrency, rate_limiter) as recognizer:
+        def send_batch():
+            if batch:
+                future = recognizer.submit(list(batch))
+                for entry in batch_entries:
+                    entry[2].append(future)
+                batch.clear()
+                batch_entries.clear()
+
+        def read_ahead():
+            nonlocal exhausted
+            while not exhausted and len(pending) < max_pending:
+                doc = next(doc_iter, None)
+                if doc is None:
+                    exhausted = True
+                    break
+
+                parts = split_long_document(doc)
+                entry = (doc, parts, [])
+                pending.append(entry)
+                for p in parts:
+                    if not batch_entries or batch_entries[-1] is not entry:
+                        batch_entries.append(entry)
+                    batch.append({'id': p['id'], 'text': p['text']})
+                    if len(batch) >= max_documents_per_request:
+                        send_batch()
+
+        read_ahead()
+        while pending:
+            doc, parts, futures = pending[0]
+            if batch_entries and batch_entries[0] is pending[0]:
+                # The oldest document is waiting for a partial request
+                send_batch()
+
+            results_by_id = {res['id']: res for future in futures for res in future.result()}
+            pending.popleft()
+
+            # Send the next requests before the caller gets the response
+            read_ahead()
+
+            response = []
+            for p in parts:
+                res = results_by_id[p['id']]
+                res['offset'] = p['offset']
+                response.append(res)
+            yield doc, response
+
+
+class EntityRecognizer():
+    """Sends entity recognition requests on an event loop running in a
+    background thread.
+
+    submit() can be called from any thread and returns a
+    concurrent.futures.Future of the results of the request."""
+
+    def __init__(self, secrets, concurrency, rate_limiter):
+        self.rate_limiter = rate_limiter
+        self.futures = set()
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        self.run(self.open(secrets, concurrency))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    async def open(self, secrets, concurrency):
+        # Created on the loop, since asyncio objects are bound to the
+        # loop that created them before Python 3.10
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.client = ner_client(secrets)
+        await self.client.__aenter__()
+
+    def submit(self, batch):
+        coro = recognize_batch(self.client, batch, self.semaphore, self.rate_limiter)
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        self.futures.add(future)
+        future.add_done_callback(self.futures.discard)
+        return future
+
+    def run(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def close(self):
+        """Cancel the requests in flight and stop the event loop."""
+        for future in list(self.futures):
+            future.cancel()
+
+        try:
+            self.run(self.client.__aexit__(None, None, None))
+        finally:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+            self.loop.close()
+
+
+async def recognize_batch(client, batch, semaphore, rate_limiter, max_retries=8):
+    async with semaphore:
+        attempt = 0
+        while True:
+            await rate_limiter.acquire()
+            start = time.perf_counter()
+            try:
+                response = await client.recognize_entities(batch, language='fi')
+                instrumentation.observe('azure_request', time.perf_counter() - start)
+                break
+            except HttpResponseError as e:
+                instrumentation.observe('azure_request', time.perf_counter() - start)
+                if attempt >= max_retries or not is_retriable(e):
+                    raise
+
+                if e.status_code == 429:
+                    instrumentation.count('azure_throttled')
+
+                    delay = retry_after(e, default=2**attempt)
+                    logging.info(f'Azure request throttled, retrying in {delay} seconds')
+                    rate_limiter.pause(delay)
+                else:
+                    instrumentation.count('azure_retried')
+
+                    delay = 2**attempt
+                    logging.info(f'Azure request failed ({e.status_code}), '
+                                 f'retrying in {delay} seconds')
+                    await asyncio.sleep(delay)
+                attempt += 1
+            except (ServiceRequestError, ServiceResponseError) as e:
+                instrumentation.observe('azure_request', time.perf_counter() - start)
+                if attempt >= max_retries:
+                    raise
+
+                instrumentation.count('azure_retried')
+
+                delay = 2**attempt
+                logging.info(f'Azure request failed ({e}), retrying in {delay} seconds')
+                await asyncio.sleep(delay)
+                attempt += 1
 
     # cache the response for debugging purposes
     save_response(response)
 
-    return response
+    return [entities_result_as_py_object(res) for res in response]
+
+
+def is_retriable(error):
+    """Throttled requests and server errors are retried."""
+    return error.status_code is None or error.status_code == 429 or error.status_code >= 500
+
+
+def retry_after(error, default):
+    try:
+        return float(error.response.headers['Retry-After'])
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return default
+
+
+class RequestRateLimiter():
+    """Keeps the request rate under a per-minute quota.
+
+    Also pauses all requests when the service asks to retry later."""
+
+    def __init__(self, requests_per_minute=None):
+        self.requests_per_minute = requests_per_minute
+        self.request_times = deque()
+        self.paused_until = 0.0
+
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            if now < self.paused_until:
+                await asyncio.sleep(self.paused_until - now)
+                continue
+
+            while self.request_times and now - self.request_times[0] >= 60:
+                self.request_times.popleft()
+
+            if self.requests_per_minute and len(self.request_times) >= self.requests_per_minute:
+                await asyncio.sleep(60 - (now - self.request_times[0]))
+                continue
+
+            self.request_times.append(now)
+            return
 
 
 def predict_cached(doc):
@@ -86,28 +311,34 @@ def predict_cached(doc):
 
 
 def split_long_document(doc):
+    """Split doc into parts that fit into one Azure request.
+
+    Returns a list of {'id': str, 'text': str, 'offset': int} dicts.
+    The offset is the position of the part in the text of doc."""
     max_azure_document_length = 5120
 
     text = doc['text']
+    parts = []
+    offset = 0
     if len(text) > max_azure_document_length:
-        parts = []
-        while len(text) > max_azure_document_length:
-            i = text[:max_azure_document_length].rfind('\n')
+        while len(text) - offset > max_azure_document_length:
+            i = text.rfind('\n', offset, offset + max_azure_document_length)
             if i >= 0:
-                prefix = text[:i+1]
+                end = i + 1
             else:
-                prefix = text[:max_azure_document_length]
+                end = offset + max_azure_document_length
 
             docid = f'{doc["id"]}.{len(parts) + 1}'
-            parts.append({'id': docid, 'text': prefix})
+            parts.append({'id': docid, 'text': text[offset:end], 'offset': offset})
 
-            text = text[len(prefix):]
+            offset = end
 
         docid = f'{doc["id"]}.{len(parts) + 1}'
-        parts.append({'id': docid, 'text': text})
-        return parts
     else:
-        return [doc]
+        docid = doc['id']
+
+    parts.append({'id': docid, 'text': text[offset:], 'offset': offset})
+    return parts
 
 
 def save_response(response):
@@ -172,73 +403,64 @@ def ontonotes_entity_name(entity):
         return category
 
 
-def find_matching_tokens(tokens, entity_offset, entity_length):
-    matches = []
-    for i, token in enumerate(tokens):
-        one_past_token_end = token['offset'] + len(token['token'])
-        one_past_entity_end = entity_offset + entity_length
-        if (entity_offset >= token['offset']
-            and (entity_offset < one_past_token_end)):
-            matches.append(i)
-        elif ((entity_offset < token['offset'])
-              and (one_past_entity_end >= one_past_token_end)):
-            matches.append(i)
-
-    return matches
+def align_with_input(input_document, response):
+    labels = entity_labels(input_document, response)
+    return [(t['token'], label) for t, label in zip(input_document['spans'], labels)]
 
 
-def align_with_input(input_document, response):
-    tokens = tokens_with_entity_codes(input_document, response)
-    return tokens_as_conllu_features(tokens)
+def entity_labels(input_document, response, threshold=0.5):
+    """Project the entities in response onto the tokens of input_document.
 
+    Returns a list of entity labels, one for each token in
+    input_document['spans']. The input document is not modified."""
 
-def tokens_with_entity_codes(input_document, response, threshold=0.5):
-    parts = split_long_document(input_document)
-    merged_response = merge_response_parts(response, parts)
-    tokens = copy.copy(input_document['spans'])
-    for ent in merged_response['entities']:
+    tokens = input_document['spans']
+    labels = [None]*len(tokens)
+    entities = []
+    for part_offset, ent in response_entities(input_document, response):
         if ent.get('confidence_score') is None:
             logging.warning(f'confidence_score missing on entity "{ent.get("text")}", '
                             f'document {input_document["id"]}')
 
         if ent.get('confidence_score', 0.0) > threshold:
-            idx = find_matching_tokens(tokens, ent['offset'], ent['length'])
+            entities.append((part_offset + ent.get('offset', 0), ent))
 
-            prefix = 'B-'
-            for i in idx:
-                entity_code = prefix + ontonotes_entity_name(ent)
+    index = TokenOffsetIndex(tokens)
+    matches = index.overlapping_all((offset, ent['length']) for offset, ent in entities)
+    for (offset, ent), idx in zip(entities, matches):
+        prefix = 'B-'
+        for i in idx:
+            entity_code = prefix + ontonotes_entity_name(ent)
 
-                if 'entity' in tokens[i] and tokens[i]['entity'] != entity_code:
-                    logging.warning(f'Duplicate entity for token "{tokens[i]["token"]}" '
-                                    f'at offset {ent["offset"]} of document {input_document["id"]}, '
-                                    f'previous = {tokens[i]["entity"]}, new = {entity_code}')
+            if labels[i] is not None and labels[i] != entity_code:
+                logging.warning(f'Duplicate entity for token "{tokens[i]["token"]}" '
+                                f'at offset {offset} of document {input_document["id"]}, '
+                                f'previous = {labels[i]}, new = {entity_code}')
 
-                tokens[i]['entity'] = entity_code
+            labels[i] = entity_code
 
-                prefix = 'I-'
+            prefix = 'I-'
 
-    return tokens
+    return [label or 'O' for label in labels]
 
 
-def tokens_as_conllu_features(tokens):
-    return [(t['token'], t.get('entity', 'O')) for t in tokens]
+def response_entities(input_document, response):
+    """Yields (part offset, entity) pairs of all parts of a response.
 
+    The entity offsets are relative to the start of their part. Part
+    offsets are taken from the response (see predict_all). Responses
+    cached without them are split again to find the offsets."""
+
+    if all('offset' in part for part in response):
+        part_offsets = [part['offset'] for part in response]
+    else:
+        part_offsets = [p['offset'] for p in split_long_document(input_document)]
 
-def merge_response_parts(response, parts):
-    merged_entities = []
-    part_offsets = [0] + [len(x['text']) for x in parts][:-1]
     for response_part, part_offset in zip(response, part_offsets):
         assert not response_part['is_error']
 
         for ent in response_part['entities']:
-            ent_corrected = copy.copy(ent)
-            ent_corrected['offset'] = part_offset + ent.get('offset', 0)
-            merged_entities.append(ent_corrected)
-
-    return {
-        'id': response[0]['id'],
-        'entities': merged_entities
-    }
+            yield part_offset, ent
 
 
 if __name__ == '__main__':
@@ -1,10 +1,19 @@
 import argparse
 import logging
+import os
 import subprocess
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from tqdm import tqdm
-from .alignment import merge_ground_truth
-from .data import load_documents, load_ground_truth, count_documents, write_tsv3
+from .cache import add_cache_arguments, open_cache, predict_with_cache
+from .functools import chunked
+from .instrumentation import instrumentation
+from .runner import add_runner_arguments, run_evaluation
+
+default_tagtools_dir = 'finnish-tagtools-1.5.1'
+
+# Marks a document boundary in the input and output of finnish-nertag
+document_separator = 'xxdokumenttirajaxx'
 
 
 def main():
@@ -14,33 +23,97 @@ def main():
     logging.basicConfig(format='%(levelname)s: %(message)s',
                         level=getattr(logging, args.loglevel.upper()))
 
-    doc_dir = Path('data/preprocessed/documents')
-    ground_truth_file = Path('data/preprocessed/turku-one/test.tsv')
-    output_path = Path('ner_results/finer.tsv')
+    cache = open_cache(args)
+    cache_config = {'tagtools': Path(args.tagtools_dir).name}
+
+    def predict_documents(documents):
+        return predict_with_cache(
+            cache, 'finer', cache_config, documents,
+            lambda docs: predict_all(docs, args.workers, args.shard_size, args.tagtools_dir))
 
-    documents = load_documents(doc_dir, include_spans=False)
-    num_documents = count_documents(doc_dir)
-    ground_truth_by_documents = load_ground_truth(ground_truth_file)
+    run_evaluation(predict_documents, args, include_spans=False)
 
-    with open(output_path, 'w') as output_f:
-        for doc, ground_truth in tqdm(zip(documents, ground_truth_by_documents), total=num_documents):
-            predicted = predict(doc['text'])
-            features = merge_ground_truth(doc['id'], predicted, ground_truth)
-            write_tsv3(features, output_f)
+    if cache:
+        logging.info(f'Prediction cache: {cache.stats()}')
+        cache.close()
 
 
 def parse_args():
     parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='Number of finnish-nertag processes to run in parallel')
+    parser.add_argument('--shard-size', type=int, default=100,
+                        help='Number of documents tagged by one finnish-nertag process')
+    parser.add_argument('--tagtools-dir', default=default_tagtools_dir,
+                        help='Directory where finnish-tagtools has been extracted')
     parser.add_argument('--loglevel', default='INFO', help='Set the log level')
+    add_cache_arguments(parser)
+    add_runner_arguments(parser, 'ner_results/finer.tsv')
     return parser.parse_args()
 
 
-def predict(text):
-    p = subprocess.run('./finnish-nertag', input=text, text=True, capture_output=True,
-                       check=True, cwd='finnish-tagtools-1.5.1')
+def predict_all(documents, num_workers=1, shard_size=100, tagtools_dir=default_tagtools_dir):
+    """Predict NER tags on documents using parallel FiNER processes.
+
+    The documents are split into shards of shard_size documents. Each
+    shard is fed through the stdin of one finnish-nertag process, so
+    that the transducers are loaded once per shard instead of once per
+    document. Up to num_workers shards are tagged at the same time.
+
+    Yields (document, predicted tokens) pairs in the same order as the
+    input documents."""
+
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        pending = deque()
+        for shard in chunked(documents, shard_size):
+            texts = [doc['text'] for doc in shard]
+            future = executor.submit(tag_documents, texts, tagtools_dir)
+            pending.append((shard, future))
+
+            if len(pending) > num_workers:
+                shard, future = pending.popleft()
+                yield from zip(shard, future.result())
+
+        while pending:
+            shard, future = pending.popleft()
+            yield from zip(shard, future.result())
+
+
+def predict(text, tagtools_dir=default_tagtools_dir):
+    return tag_documents([text], tagtools_dir)[0]
+
+
+def tag_documents(texts, tagtools_dir=default_tagtools_dir):
+    """Tag several documents with one finnish-nertag process.
+
+    The documents are separated by a sentinel token on a paragraph of
+    its own. Returns a list of predicted tokens for each document."""
+
+    separator = f'\n\n{document_separator}\n\n'
+    input_text = ''.join(text + separator for text in texts)
+    with instrumentation.stage('finer_process'):
+        p = subprocess.run('./finnish-nertag', input=input_text, text=True, capture_output=True,
+                           check=True, cwd=tagtools_dir)
+
     res = []
-    active_chunk = None
+    lines = []
     for line in p.stdout.split('\n'):
+        if line.split('\t')[0] == document_separator:
+            res.append(parse_finer_output(lines))
+            lines = []
+        else:
+            lines.append(line)
+
+    if len(res) != len(texts):
+        raise ValueError(f'Expected FiNER output for {len(texts)} documents, got {len(res)}')
+
+    return res
+
+
+def parse_finer_output(lines):
+    res = []
+    active_chunk = None
+    for line in lines:
         if line:
             text, finer_tag = line.split('\t')
 
@@ -1,54 +1,123 @@
+import argparse
 import logging
 import requests
 import sys
-from pathlib import Path
-from tqdm import tqdm
-from .alignment import merge_ground_truth
-from .data import load_documents, load_ground_truth, count_documents, write_tsv3
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from .cache import add_cache_arguments, open_cache, predict_with_cache
+from .instrumentation import instrumentation
+from .runner import add_runner_arguments, run_evaluation
+
+default_endpoint = 'http://localhost:8080'
 
 
 def main():
     """Predict NER labels on the test set.
 
-    Saves the output in ner_results/turku.conllu"""
-    
-    exit_if_not_connected()
+    Saves the output in ner_results/turku.tsv"""
+
+    args = parse_args()
+
+    logging.basicConfig(format='%(levelname)s: %(message)s',
+                        level=getattr(logging, args.loglevel.upper()))
+
+    session = ner_session(args.concurrency, args.retries, args.backoff)
+    exit_if_not_connected(session, args.endpoint)
+
+    cache = open_cache(args)
+    cache_config = {'endpoint': args.endpoint}
+
+    def predict_documents(documents):
+        return predict_with_cache(
+            cache, 'turku', cache_config, documents,
+            lambda docs: predict_all(session, docs, args.endpoint, args.concurrency))
+
+    run_evaluation(predict_documents, args, include_spans=False)
+
+    if cache:
+        logging.info(f'Prediction cache: {cache.stats()}')
+        cache.close()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--endpoint', default=default_endpoint,
+                        help='URL of the keras-bert-ner server')
+    parser.add_argument('--concurrency', type=int, default=4,
+                        help='Maximum number of requests in flight')
+    parser.add_argument('--retries', type=int, default=3,
+                        help='Number of times to retry a failed request')
+    parser.add_argument('--backoff', type=float, default=0.5,
+                        help='Backoff factor (in seconds) between retries')
+    parser.add_argument('--loglevel', default='INFO', help='Set the log level')
+    add_cache_arguments(parser)
+    add_runner_arguments(parser, 'ner_results/turku.tsv')
+    return parser.parse_args()
 
-    doc_dir = Path('data/preprocessed/documents')
-    ground_truth_file = Path('data/preprocessed/turku-one/test.tsv')
-    output_path = Path('ner_results/turku.tsv')
 
-    documents = load_documents(doc_dir, include_spans=False)
-    num_documents = count_documents(doc_dir)
-    ground_truth_by_documents = load_ground_truth(ground_truth_file)
-    
-    with open(output_path, 'w') as output_f:
-        for doc, ground_truth in tqdm(zip(documents, ground_truth_by_documents), total=num_documents):
-            predicted = predict(doc['text'])
-            features = merge_ground_truth(doc['id'], predicted, ground_truth)
-            write_tsv3(features, output_f)
+def ner_session(pool_size=1, retries=3, backoff=0.5):
+    """A keep-alive HTTP session with a connection pool and retries."""
 
+    retry = Retry(total=retries, backoff_factor=backoff,
+                  status_forcelist=[500, 502, 503, 504])
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size,
+                          max_retries=retry)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
 
-def predict(text):
+
+def predict_all(session, documents, endpoint=default_endpoint, max_in_flight=4):
+    """Predict NER labels on documents concurrently.
+
+    Keeps up to max_in_flight requests running in the background while
+    the caller consumes the results. Yields (document, predicted
+    tokens) pairs in the same order as the input documents."""
+
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        doc_iter = iter(documents)
+        pending = deque()
+
+        def submit_next():
+            doc = next(doc_iter, None)
+            if doc is not None:
+                pending.append((doc, executor.submit(predict, doc['text'], session, endpoint)))
+
+        for _ in range(max_in_flight):
+            submit_next()
+
+        while pending:
+            doc, future = pending.popleft()
+            predicted = future.result()
+            # Replace the finished request before the caller gets the
+            # result, so that max_in_flight requests keep running
+            submit_next()
+            yield doc, predicted
+
+
+def predict(text, session=requests, endpoint=default_endpoint):
     """Predict NER labels with the keras-bert-ner.
 
     The server must have been started beforehand on port 8080."""
 
-    endpoint = 'http://localhost:8080'
     data = {'text': text.strip()}
-    
-    r = requests.get(endpoint, params=data)
+
+    with instrumentation.stage('turku_request'):
+        r = session.get(endpoint, params=data)
     r.raise_for_status()
 
     tokens = [x.split('\t') for x in r.text.strip('\n').split('\n')]
     return tokens
 
 
-def exit_if_not_connected():
+def exit_if_not_connected(session=requests, endpoint=default_endpoint):
     try:
-        predict('Suomi')
+        predict('Suomi', session, endpoint)
     except requests.exceptions.ConnectionError:
-        logging.error('Failed to connect to the turku-ner-model. Have you started it on port 8080?')
+        logging.error(f'Failed to connect to the turku-ner-model. Have you started it on {endpoint}?')
         sys.exit(1)
 
 
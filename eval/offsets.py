@@ -0,0 +1,58 @@
+from bisect import bisect_right
+
+
+class TokenOffsetIndex():
+    """An index for finding tokens that overlap a character range.
+
+    spans is a list of {'token': str, 'offset': int} dicts sorted by
+    the offset with non-overlapping tokens, like the .spans files
+    written by ud_to_documents.
+
+    A token matches a range if the range starts inside the token or if
+    the token is completely inside the range. A token that overlaps
+    only the end of the range does not match."""
+
+    def __init__(self, spans):
+        self.starts = [t['offset'] for t in spans]
+        self.ends = [t['offset'] + len(t['token']) for t in spans]
+
+        if any(self.ends[i] > self.starts[i + 1] for i in range(len(self.starts) - 1)):
+            raise ValueError('Token spans must be sorted and non-overlapping')
+
+    def __len__(self):
+        return len(self.starts)
+
+    def overlapping(self, offset, length):
+        """Indices of the tokens matching the range [offset, offset + length)."""
+        i = bisect_right(self.starts, offset)
+        return self._matches(i, offset, offset + length)
+
+    def overlapping_all(self, ranges):
+        """Find the matching tokens for many (offset, length) ranges.
+
+        The ranges are processed in a single sweep in the order of
+        their offsets. Returns a list of token indices for each range,
+        in the order of the input."""
+
+        ranges = list(ranges)
+        res = [None]*len(ranges)
+        i = 0
+        n = len(self.starts)
+        for k in sorted(range(len(ranges)), key=lambda k: ranges[k][0]):
+            offset, length = ranges[k]
+            while i < n and self.starts[i] <= offset:
+                i += 1
+
+            res[k] = self._matches(i, offset, offset + length)
+
+        return res
+
+    def _matches(self, i, start, end):
+        # i is the index of the first token starting after start
+        matches = []
+        if i > 0 and start < self.ends[i - 1]:
+            matches.append(i - 1)
+
+        j = bisect_right(self.ends, end, lo=i)
+        matches.extend(range(i, j))
+        return matches
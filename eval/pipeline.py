@@ -0,0 +1,182 @@
+"""Asynchronous evaluation pipeline.
+
+With --pipeline, the runner overlaps the stages of the evaluation
+instead of running them one document at a time:
+
+    loader -> predictor -> aligner -> writer
+
+The stages are connected by bounded queues of --queue-size documents,
+so that a slow stage makes the earlier stages wait instead of
+buffering the whole corpus in memory:
+
+loader     reads the documents and the ground truth in a thread.
+predictor  runs the predict_all function of the backend in a thread
+           of its own. Its concurrency is set by the options of the
+           backend (--workers or --concurrency).
+aligner    aligns the predictions on --align-workers processes (see
+           alignment_pool.py), so that alignment does not compete with
+           the predictor for the GIL. The documents that are waiting
+           are sent to the workers in chunks of up to
+           --align-chunk-size documents.
+writer     writes the aligned documents in the input order in a thread.
+
+The network backends are thus kept busy while the previous documents
+are aligned and written.
+"""
+
+import asyncio
+import concurrent.futures
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from .alignment_pool import AlignmentPool
+from .instrumentation import instrumentation
+
+# Marks the end of the items in a queue
+end_of_items = object()
+
+
+class PipelineStopped(Exception):
+    """Raised in a stage thread when another stage has failed."""
+
+
+class Pipeline():
+    """Predicts, aligns and writes the documents in items.
+
+    items is an iterable of (document, ground truth, tag) triples.
+    predict_all is called with an iterable of the documents and must
+    yield (document, predicted tokens) pairs in the same order. For
+    each document, write(document, aligned document, tag) is called in
+    the order of items."""
+
+    def __init__(self, predict_all, write, align_workers, queue_size=64, align_chunk_size=32):
+        self.predict_all = predict_all
+        self.write = write
+        self.align_workers = align_workers
+        self.queue_size = queue_size
+        self.align_chunk_size = align_chunk_size
+        self.stopped = threading.Event()
+        self.loop = None
+
+    def run(self, items):
+        asyncio.run(self.run_stages(items))
+
+    async def run_stages(self, items):
+        self.loop = asyncio.get_running_loop()
+        documents = asyncio.Queue(self.queue_size)
+        predictions = asyncio.Queue(self.queue_size)
+        # Chunks being aligned, at most two per worker
+        alignments = asyncio.Queue(2*self.align_workers)
+
+        # The alignment processes are started before the stage threads
+        with AlignmentPool(self.align_workers, self.align_chunk_size) as align_pool, \
+                ThreadPoolExecutor(3, thread_name_prefix='pipeline') as threads:
+            tasks = [
+                self.loop.run_in_executor(threads, self.load, items, documents),
+                self.loop.run_in_executor(threads, self.predict, documents, predictions),
+                asyncio.create_task(self.align(align_pool, predictions, alignments)),
+                asyncio.create_task(self.write_all(align_pool, threads, alignments)),
+            ]
+            try:
+                await asyncio.gather(*tasks)
+            except BaseException:
+                self.stop(tasks)
+                await asyncio.gather(*tasks, return_exceptions=True)
+                raise
+
+            align_pool.log_summary()
+
+    def stop(self, tasks):
+        self.stopped.set()
+        for task in tasks:
+            if isinstance(task, asyncio.Task):
+                task.cancel()
+
+    def load(self, items, documents):
+        """Loader stage, runs in a thread."""
+        try:
+            for item in items:
+                self.put(documents, item)
+        finally:
+            if not self.stopped.is_set():
+                self.put(documents, end_of_items)
+
+    def predict(self, documents, predictions):
+        """Predictor stage, runs in a thread."""
+        # (ground truth, tag) of the documents given to predict_all
+        pending = deque()
+
+        def queued_documents():
+            while True:
+                item = self.get(documents)
+                if item is end_of_items:
+                    return
+                doc, ground_truth, tag = item
+                pending.append((ground_truth, tag))
+                yield doc
+
+        try:
+            for doc, predicted in instrumentation.timed('predict',
+                                                        self.predict_all(queued_documents())):
+                ground_truth, tag = pending.popleft()
+                self.put(predictions, (doc, predicted, ground_truth, tag))
+        finally:
+            if not self.stopped.is_set():
+                self.put(predictions, end_of_items)
+
+    async def align(self, align_pool, predictions, alignments):
+        """Aligner stage. The futures of the chunks are queued in the
+        input order, so that the writer gets the results in order even
+        though the worker processes finish them in any order."""
+        done = False
+        while not done:
+            # A chunk is the next prediction and the ones already waiting
+            chunk = []
+            item = await predictions.get()
+            while item is not end_of_items:
+                doc, predicted, ground_truth, tag = item
+                chunk.append((doc['id'], predicted, ground_truth, (doc, tag)))
+                if len(chunk) >= self.align_chunk_size or predictions.empty():
+                    break
+                item = predictions.get_nowait()
+            done = item is end_of_items
+
+            if chunk:
+                future = asyncio.wrap_future(align_pool.submit(chunk))
+                await alignments.put((chunk, future))
+
+        await alignments.put(end_of_items)
+
+    async def write_all(self, align_pool, threads, alignments):
+        """Writer stage."""
+        while True:
+            item = await alignments.get()
+            if item is end_of_items:
+                return
+
+            chunk, future = item
+            results = list(align_pool.results(chunk, await future))
+            await self.loop.run_in_executor(threads, self.write_chunk, results)
+
+    def write_chunk(self, results):
+        for features, (doc, tag) in results:
+            self.write(doc, features, tag)
+
+    def put(self, queue, item):
+        """Put an item into an asyncio queue from a stage thread. Blocks
+        while the queue is full."""
+        self.wait(asyncio.run_coroutine_threadsafe(queue.put(item), self.loop))
+
+    def get(self, queue):
+        """Get an item from an asyncio queue in a stage thread."""
+        return self.wait(asyncio.run_coroutine_threadsafe(queue.get(), self.loop))
+
+    def wait(self, future):
+        while True:
+            try:
+                return future.result(timeout=0.5)
+            except concurrent.futures.TimeoutError:
+                if self.stopped.is_set():
+                    future.cancel()
+                    raise PipelineStopped()
+
@@ -2,9 +2,10 @@ import matplotlib
 import matplotlib.pyplot as plt
 import pandas as pd
 import seaborn as sns
-from pathlib import Path
-from .conlleval import evaluate, metrics, parse_args
+from .conlleval import metrics, parse_args
 from .functools import flat_map
+from .metrics_cache import MetricsCache
+from .services import discover_services
 
 entity_plot_order = ['Product', 'Event', 'Organization', 'Person', 'GPE', 'Location']
 
@@ -61,11 +62,7 @@ def plot_f1(df):
 
 
 def load_ner_results():
-    services = [
-        ('Azure','azure.tsv'),
-        ('FiNER', 'finer.tsv'),
-        ('Turku NER', 'turku.tsv')
-    ]
+    services = discover_services()
     interesting_types = ['PERSON', 'ORG', 'GPE', 'LOC', 'PRODUCT', 'EVENT']
     entity_name = {
         'PERSON': 'Person',
@@ -77,10 +74,10 @@ def load_ner_results():
     }
 
     eval_args = parse_args(['--boundary=-DOCSTART-', '--delimiter=\t'])
+    result_paths = [result_path for _, result_path in services]
+    counts_by_service = MetricsCache().evaluate(result_paths, eval_args)
     data = []
-    for service_name, result_file in services:
-        with open(Path('ner_results') / result_file) as f:
-            counts = evaluate(f, eval_args)
+    for (service_name, _), counts in zip(services, counts_by_service):
         overall, by_type = metrics(counts)
 
         for ne_type in interesting_types:
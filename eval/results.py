@@ -0,0 +1,210 @@
+"""Result files and their columnar sidecars.
+
+A result file is a TSV file with the columns token, ground truth
+entity and predicted entity, and a -DOCSTART- line before each document
+(see data.write_tsv3). ResultWriter writes it one document at a time
+and, optionally, a columnar sidecar (<result file>.cols) next to it:
+
+    magic
+    token ids       int32, one for each line of the result file
+    gold tag ids    int32, one for each line
+    guessed tag ids int32, one for each line
+    index           JSON: the token and tag vocabularies and the size
+                    and modification time of the result file
+    footer          the byte offsets of the parts above and the magic
+
+The scorers read the sidecar instead of parsing the TSV file. A
+sidecar is ignored if the result file has changed after the sidecar
+was written.
+"""
+
+import json
+import logging
+import mmap
+import os
+import struct
+import sys
+from array import array
+from .data import write_tsv3
+
+magic = b'FINERRES'
+version = 1
+footer_format = '<QQQQ8s'
+footer_size = struct.calcsize(footer_format)
+document_start = '-DOCSTART-'
+
+
+def columns_path(path):
+    return path.with_name(path.name + '.cols')
+
+
+class ResultWriter():
+    """Writes a result file into a temporary file and renames it into
+    place on commit.
+
+    If columns is True, also writes the columnar sidecar."""
+
+    def __init__(self, path, columns=False, sync=False):
+        self.path = path
+        self.tmp_path = path.with_name(path.name + '.tmp')
+        self.sync = sync
+        self.file = open(self.tmp_path, 'w')
+        self.columns = ColumnBuilder() if columns else None
+
+    def write(self, features):
+        """Write a document. features is a sequence of (token, ground
+        truth entity, predicted entity) triples."""
+        write_tsv3(features, self.file)
+        if self.columns is not None:
+            self.columns.add(features)
+
+    def commit(self):
+        if self.sync:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+        self.file.close()
+        os.replace(self.tmp_path, self.path)
+
+        sidecar = columns_path(self.path)
+        if self.columns is not None:
+            self.columns.write(sidecar, self.path)
+        elif sidecar.exists():
+            sidecar.unlink()
+
+
+class ColumnBuilder():
+    """Collects the columns of a result file in memory."""
+
+    def __init__(self):
+        self.token_vocabulary = {}
+        self.tag_vocabulary = {}
+        self.token_ids = array('i')
+        self.gold_ids = array('i')
+        self.pred_ids = array('i')
+
+    def add(self, features):
+        tokens = self.token_vocabulary
+        tags = self.tag_vocabulary
+        token_ids = [tokens.setdefault(document_start, len(tokens))]
+        gold_ids = [tags.setdefault('O', len(tags))]
+        pred_ids = [gold_ids[0]]
+        for token, gold, pred in features:
+            token_ids.append(tokens.setdefault(token, len(tokens)))
+            gold_ids.append(tags.setdefault(gold, len(tags)))
+            pred_ids.append(tags.setdefault(pred, len(tags)))
+
+        self.token_ids.extend(token_ids)
+        self.gold_ids.extend(gold_ids)
+        self.pred_ids.extend(pred_ids)
+
+    def extend(self, columns):
+        """Append the rows of a ResultColumns."""
+        token_map = [self.token_vocabulary.setdefault(t, len(self.token_vocabulary))
+                     for t in columns.tokens]
+        tag_map = [self.tag_vocabulary.setdefault(t, len(self.tag_vocabulary))
+                   for t in columns.tags]
+        self.token_ids.extend(map(token_map.__getitem__, columns.token_ids))
+        self.gold_ids.extend(map(tag_map.__getitem__, columns.gold_ids))
+        self.pred_ids.extend(map(tag_map.__getitem__, columns.pred_ids))
+
+    def write(self, path, result_path):
+        """Write the sidecar of the result file at result_path."""
+        stat = os.stat(result_path)
+        index = {
+            'version': version,
+            'byteorder': sys.byteorder,
+            'tokens': list(self.token_vocabulary),
+            'tags': list(self.tag_vocabulary),
+            'result_size': stat.st_size,
+            'result_mtime_ns': stat.st_mtime_ns,
+        }
+
+        tmp_path = path.with_name(path.name + '.tmp')
+        with open(tmp_path, 'wb') as f:
+            f.write(magic)
+            arrays_start = f.tell()
+            for column in (self.token_ids, self.gold_ids, self.pred_ids):
+                column.tofile(f)
+
+            index_start = f.tell()
+            f.write(json.dumps(index, ensure_ascii=False).encode('utf-8'))
+            index_end = f.tell()
+            f.write(struct.pack(footer_format, arrays_start, len(self.token_ids),
+                                index_start, index_end, magic))
+        os.replace(tmp_path, path)
+
+
+class ResultColumns():
+    """Read-only, memory-mapped access to a columnar sidecar.
+
+    token_ids, gold_ids and pred_ids are int32 memoryviews with one
+    element for each line of the result file. tokens and tags map the
+    ids back to strings."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        arrays_start, n, index_start, index_end, footer_magic = struct.unpack_from(
+            footer_format, self.mmap, len(self.mmap) - footer_size)
+        if self.mmap[:len(magic)] != magic or footer_magic != magic:
+            raise ValueError(f'{path} is not a result sidecar')
+
+        self.index = json.loads(self.mmap[index_start:index_end].decode('utf-8'))
+        if self.index['byteorder'] != sys.byteorder:
+            raise ValueError(f'{path} was written on a machine with a different byte order')
+
+        self.tokens = self.index['tokens']
+        self.tags = self.index['tags']
+        itemsize = array('i').itemsize
+        view = memoryview(self.mmap)
+        self.token_ids = view[arrays_start:arrays_start + n*itemsize].cast('i')
+        self.gold_ids = view[arrays_start + n*itemsize:arrays_start + 2*n*itemsize].cast('i')
+        self.pred_ids = view[arrays_start + 2*n*itemsize:arrays_start + 3*n*itemsize].cast('i')
+
+    def __len__(self):
+        return len(self.token_ids)
+
+    def token_id(self, token):
+        """The id of token or -1 if it does not occur in the result."""
+        try:
+            return self.tokens.index(token)
+        except ValueError:
+            return -1
+
+    def is_current(self, result_path):
+        stat = os.stat(result_path)
+        return (stat.st_size == self.index['result_size'] and
+                stat.st_mtime_ns == self.index['result_mtime_ns'])
+
+    def rows(self):
+        """Yields the (token, gold tag, guessed tag) rows."""
+        tokens = self.tokens
+        tags = self.tags
+        for token, gold, pred in zip(self.token_ids, self.gold_ids, self.pred_ids):
+            yield (tokens[token], tags[gold], tags[pred])
+
+
+def open_columns(result_path):
+    """The sidecar of the result file at result_path, or None if it
+    doesn't exist or is out of date."""
+    path = columns_path(result_path)
+    if not path.exists():
+        return None
+
+    columns = ResultColumns(path)
+    if not columns.is_current(result_path):
+        logging.info(f'Ignoring {path}, because {result_path} has changed after it was written')
+        return None
+
+    return columns
+
+
+def merge_columns(paths, output_path, result_path):
+    """Concatenate the sidecars at paths into one sidecar for the
+    result file at result_path."""
+    builder = ColumnBuilder()
+    for path in paths:
+        builder.extend(ResultColumns(path))
+    builder.write(output_path, result_path)
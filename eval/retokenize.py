@@ -0,0 +1,105 @@
+"""Table-driven retokenization.
+
+A Retokenizer splits tokens into smaller tokens according to a list of
+rules. The first rule that applies to a token decides how it is split.
+The rules are plain JSON-compatible dicts:
+
+    {'type': 'split', 'separator': ' '}
+        Split at the separator.
+    {'type': 'split_keep', 'characters': '-/:'}
+        Split at any of the characters and keep them as tokens.
+    {'type': 'trailing', 'characters': '.:'}
+        Split a trailing run of the same character (one of the
+        characters) into one-character tokens.
+    {'type': 'exceptions', 'tokens': {'token': ['to', 'ken']}}
+        Split the listed tokens as given.
+
+The results are memoized per surface token, since most tokens of a
+corpus are repetitions of a small vocabulary.
+"""
+
+import re
+from functools import lru_cache
+
+# How turku-one has been tokenized compared to UD Finnish-TDT
+turku_one_rules = [
+    {'type': 'split', 'separator': ' '},
+    {'type': 'split_keep', 'characters': '-/:'},
+    {'type': 'trailing', 'characters': '.:'},
+    {'type': 'exceptions', 'tokens': {'Первома́йск': ['Первома', '́', 'йск']}},
+]
+
+
+class Retokenizer():
+    def __init__(self, rules, cache_size=1 << 16):
+        self.rules = [compile_rule(rule) for rule in rules]
+        self.retokenize = lru_cache(maxsize=cache_size)(self._retokenize)
+
+    def __call__(self, w):
+        """Retokenize w. Returns a tuple of tokens."""
+        return self.retokenize(w)
+
+    def _retokenize(self, w):
+        for rule in self.rules:
+            res = rule(w)
+            if res is not None:
+                return tuple(res)
+
+        return (w,)
+
+    def retokenize_all(self, tokens):
+        """Retokenize a sequence of tokens.
+
+        Returns the list of new tokens and, for each new token, the
+        index of the input token it came from."""
+        res = []
+        origins = []
+        for i, w in enumerate(tokens):
+            parts = self.retokenize(w)
+            res.extend(parts)
+            origins.extend([i]*len(parts))
+        return res, origins
+
+    def cache_info(self):
+        return self.retokenize.cache_info()
+
+
+def compile_rule(rule):
+    rule_type = rule['type']
+    if rule_type == 'split':
+        separator = rule['separator']
+
+        def split(w):
+            if separator in w:
+                return w.split(separator)
+
+        return split
+
+    elif rule_type == 'split_keep':
+        pattern = re.compile('([' + re.escape(rule['characters']) + '])')
+
+        def split_keep(w):
+            if pattern.search(w):
+                return [x for x in pattern.split(w) if x]
+
+        return split_keep
+
+    elif rule_type == 'trailing':
+        characters = rule['characters']
+
+        def trailing(w):
+            if w and w[-1] in characters:
+                c = w[-1]
+                stripped = w.rstrip(c)
+                res = [stripped] if stripped else []
+                res.extend([c]*(len(w) - len(stripped)))
+                return res
+
+        return trailing
+
+    elif rule_type == 'exceptions':
+        tokens = rule['tokens']
+        return tokens.get
+
+    else:
+        raise ValueError(f'Unknown retokenization rule type {rule_type}')
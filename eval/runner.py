@@ -0,0 +1,427 @@
+"""Sharded, resumable evaluation runner shared by the NER backends.
+
+The corpus is split into shards of consecutive documents. Each
+completed shard is written atomically into a work directory and
+recorded in a manifest, so that an interrupted run continues from the
+first incomplete shard. When all shards are complete, they are merged
+into the final result file.
+
+The shards can be divided between several processes or machines with
+--num-shards and --shard-index. The process that completes the last
+shard (or a later run with --merge-only) merges the results and
+removes the work directory, so that the next run starts from scratch.
+The processes re-read the manifest under a file lock before deciding
+whether to merge, so that exactly one of them writes the result file.
+
+With --align-workers, the predictions are aligned with the ground
+truth on worker processes (see alignment_pool.py). With --pipeline,
+loading, prediction, alignment and writing run concurrently (see
+pipeline.py).
+"""
+
+import fcntl
+import json
+import logging
+import math
+import os
+import shutil
+import sys
+from collections import deque
+from contextlib import contextmanager
+from pathlib import Path
+from tqdm import tqdm
+from .alignment import merge_ground_truth
+from .alignment_pool import AlignmentPool
+from .data import GroundTruthIndex, open_documents
+from .instrumentation import instrumentation, profiling
+from .pipeline import Pipeline
+from .results import ResultWriter, columns_path, merge_columns
+
+
+def add_runner_arguments(parser, output_path):
+    parser.add_argument('--documents', type=Path, default=Path('data/preprocessed/documents.bin'),
+                        help='Document store or directory of the input documents')
+    parser.add_argument('--ground-truth', type=Path,
+                        default=Path('data/preprocessed/turku-one/test.tsv'),
+                        help='Ground truth file')
+    parser.add_argument('--output', type=Path,
+                        help=f'Output file (default: {output_path}). Required with --document-id.')
+    parser.set_defaults(default_output=Path(output_path))
+    parser.add_argument('--shard-documents', type=int, default=50,
+                        help='Number of documents in a shard')
+    parser.add_argument('--num-shards', type=int, default=1,
+                        help='Number of processes sharing the evaluation')
+    parser.add_argument('--shard-index', type=int, default=0,
+                        help='Index (0, ..., num-shards - 1) of this process')
+    parser.add_argument('--restart', action='store_true', default=False,
+                        help='Discard the completed shards of a previous run')
+    parser.add_argument('--merge-only', action='store_true', default=False,
+                        help='Only merge the completed shards into the output file')
+    parser.add_argument('--document-id', action='append',
+                        help='Evaluate only this document (can be given several times). '
+                        'Writes the output directly into --output without shards.')
+    parser.add_argument('--columns', action='store_true', default=False,
+                        help='Also write a binary columnar copy of the output '
+                        '(<output>.cols) for faster scoring')
+    parser.add_argument('--pipeline', action='store_true', default=False,
+                        help='Run loading, prediction, alignment and writing concurrently')
+    parser.add_argument('--align-workers', type=int,
+                        help='Number of alignment processes (default: align in the main '
+                        'process, or one process per CPU with --pipeline)')
+    parser.add_argument('--align-chunk-size', type=int, default=32,
+                        help='Number of documents sent to an alignment process at a time')
+    parser.add_argument('--queue-size', type=int, default=64,
+                        help='Number of documents buffered between the stages with --pipeline')
+    parser.add_argument('--metrics', type=Path,
+                        help='Write stage timings and throughput as JSON into this file '
+                        '(default: <output>.metrics.json)')
+    parser.add_argument('--profile', type=Path,
+                        help='Write cProfile statistics of the main thread into this file')
+    parser.add_argument('--trace-memory', action='store_true', default=False,
+                        help='Trace memory allocations with tracemalloc (slow)')
+
+
+def run_evaluation(predict_all, args, include_spans=True):
+    """Predict, align with the ground truth and write the results.
+
+    predict_all is called with an iterable of documents and must yield
+    (document, predicted tokens) pairs in the same order. The
+    predicted tokens are (token, entity label) pairs.
+
+    The stage timings are logged and written into a JSON file at the
+    end (see instrumentation.py)."""
+
+    if args.output is None:
+        if args.document_id:
+            # Don't overwrite the complete results with a subset
+            sys.exit(f'--document-id requires --output (the default {args.default_output} '
+                     f'is reserved for complete runs)')
+        args.output = args.default_output
+
+    instrumentation.start()
+    with profiling(args.profile, args.trace_memory) as profile:
+        evaluate(predict_all, args, include_spans)
+
+    instrumentation.finish()
+    path = args.metrics or metrics_path(args.output, args.num_shards, args.shard_index)
+    report = instrumentation.write_json(path, profile)
+    instrumentation.log_summary(report)
+
+
+def evaluate(predict_all, args, include_spans):
+    documents = open_documents(args.documents)
+    ground_truth = GroundTruthIndex(args.ground_truth)
+    if len(documents) != len(ground_truth):
+        # The documents are paired with the ground truth by position
+        raise ValueError(f'{args.documents} has {len(documents)} documents but '
+                         f'{args.ground_truth} has {len(ground_truth)}')
+    check_document_ids(documents, ground_truth)
+
+    if args.document_id:
+        evaluate_selected(predict_all, documents, ground_truth, args.document_id,
+                          include_spans, args.output, args.columns)
+        return
+
+    work_dir = shard_dir(args.output)
+    num_documents = len(documents)
+    num_shards = math.ceil(num_documents / args.shard_documents)
+    if args.restart:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    manifest = Manifest(work_dir / 'manifest.jsonl', args.shard_documents, documents.ids())
+
+    if not args.merge_only:
+        todo_shards = [k for k in range(num_shards)
+                       if k % args.num_shards == args.shard_index and k not in manifest.completed]
+        shard_ranges = [range(k*args.shard_documents, min((k + 1)*args.shard_documents, num_documents))
+                        for k in todo_shards]
+        num_todo = sum(len(r) for r in shard_ranges)
+        if num_todo < num_documents:
+            logging.info(f'Skipping {num_documents - num_todo} documents in completed '
+                         f'or other processes\' shards')
+
+        todo = ((k, load_shard(documents, ground_truth, r, include_spans))
+                for k, r in zip(todo_shards, shard_ranges))
+        writer = ShardCommitter(work_dir, manifest, args.columns)
+        if args.pipeline:
+            evaluate_pipelined(predict_all, todo, num_todo, writer,
+                               args.align_workers or os.cpu_count(), args.queue_size,
+                               args.align_chunk_size)
+        elif args.align_workers:
+            with AlignmentPool(args.align_workers, args.align_chunk_size) as align_pool:
+                evaluate_shards(predict_all, todo, num_todo, writer, align_pool)
+            align_pool.log_summary()
+        else:
+            evaluate_shards(predict_all, todo, num_todo, writer)
+
+    # Other processes may have completed shards since the manifest was
+    # loaded
+    with locked(work_dir):
+        if manifest.completed and not manifest.path.exists():
+            logging.info(f'{args.output} was already merged by another process')
+            return
+
+        manifest.reload()
+        missing = [k for k in range(num_shards) if k not in manifest.completed]
+        if missing:
+            logging.info(f'{len(missing)} of {num_shards} shards are not yet complete, '
+                         f'not writing {args.output}')
+            if args.merge_only:
+                sys.exit(1)
+        else:
+            with instrumentation.stage('merge_shards'):
+                merge_shards(work_dir, num_shards, args.output, args.columns)
+            shutil.rmtree(work_dir, ignore_errors=True)
+            logging.info(f'Wrote {args.output}')
+
+
+def evaluate_selected(predict_all, documents, ground_truth, document_ids, include_spans,
+                      output_path, columns=False):
+    """Evaluate only the documents with the given IDs.
+
+    The ground truth is looked up by the document ID, or by the position
+    of the document if the ground truth file has no IDs."""
+    with instrumentation.stage('load_documents'):
+        selected = [documents.document(documents.position(docid), include_spans)
+                    for docid in document_ids]
+    if ground_truth.has_ids():
+        ground_truth_position = ground_truth.position
+    else:
+        ground_truth_position = documents.position
+
+    writer = ResultWriter(output_path, columns)
+    predictions = instrumentation.timed('predict', predict_all(selected))
+    for doc, predicted in tqdm(predictions, total=len(selected)):
+        with instrumentation.stage('load_ground_truth'):
+            gt = ground_truth[ground_truth_position(doc['id'])]
+        features = align(doc, predicted, gt)
+        with instrumentation.stage('write_results'):
+            writer.write(features)
+
+    writer.commit()
+    logging.info(f'Wrote {len(selected)} documents into {output_path}')
+
+
+def evaluate_shards(predict_all, shards, num_documents, writer, align_pool=None):
+    # The documents in the order they are given to predict_all: (shard
+    # number, ground truth, is last document of the shard)
+    queue = deque()
+
+    def documents():
+        for k, shard in shards:
+            for i, (doc, ground_truth) in enumerate(shard):
+                queue.append((k, ground_truth, i == len(shard) - 1))
+                yield doc
+
+    predictions = instrumentation.timed('predict', predict_all(documents()))
+    if align_pool is None:
+        for doc, predicted in tqdm(predictions, total=num_documents):
+            k, ground_truth, last_in_shard = queue.popleft()
+            features = align(doc, predicted, ground_truth)
+            writer.write(k, doc['id'], features, last_in_shard)
+    else:
+        def items():
+            for doc, predicted in predictions:
+                k, ground_truth, last_in_shard = queue.popleft()
+                yield doc['id'], predicted, ground_truth, (doc['id'], k, last_in_shard)
+
+        for features, (docid, k, last_in_shard) in tqdm(align_pool.imap(items()),
+                                                        total=num_documents):
+            writer.write(k, docid, features, last_in_shard)
+
+
+def evaluate_pipelined(predict_all, shards, num_documents, writer, align_workers, queue_size,
+                       align_chunk_size):
+    def items():
+        for k, shard in shards:
+            for i, (doc, ground_truth) in enumerate(shard):
+                yield doc, ground_truth, (k, i == len(shard) - 1)
+
+    progress = tqdm(total=num_documents)
+
+    def write(doc, features, tag):
+        k, last_in_shard = tag
+        writer.write(k, doc['id'], features, last_in_shard)
+        progress.update()
+
+    try:
+        Pipeline(predict_all, write, align_workers, queue_size, align_chunk_size).run(items())
+    finally:
+        progress.close()
+
+
+def check_document_ids(documents, ground_truth):
+    """Check that the documents and the ground truth are in the same
+    order. Ground truth files written without IDs can't be checked."""
+    if not ground_truth.has_ids():
+        logging.warning(f'{ground_truth.path} has no document IDs. Run '
+                        f'eval.turku_one_extract_ud again to add them.')
+        return
+
+    for i, (docid, gt_docid) in enumerate(zip(documents.ids(), ground_truth.ids())):
+        if docid != gt_docid:
+            raise ValueError(f'Document {i} is {docid} but its ground truth is {gt_docid}')
+
+
+def load_shard(documents, ground_truth, positions, include_spans):
+    shard = []
+    for i in positions:
+        with instrumentation.stage('load_documents'):
+            doc = documents.document(i, include_spans)
+        with instrumentation.stage('load_ground_truth'):
+            gt = ground_truth[i]
+        shard.append((doc, gt))
+    return shard
+
+
+def align(doc, predicted, ground_truth):
+    with instrumentation.stage('merge_ground_truth'):
+        features = merge_ground_truth(doc['id'], predicted, ground_truth)
+    instrumentation.count('documents')
+    instrumentation.count('tokens', len(ground_truth))
+    return features
+
+
+def metrics_path(output_path, num_shards=1, shard_index=0):
+    if num_shards == 1:
+        return output_path.with_name(output_path.name + '.metrics.json')
+    else:
+        return output_path.with_name(output_path.name + f'.metrics-{shard_index}.json')
+
+
+def shard_dir(output_path):
+    return output_path.with_name(output_path.name + '.shards')
+
+
+def shard_path(work_dir, k):
+    return work_dir / f'shard-{k:05d}.tsv'
+
+
+class ShardWriter():
+    """Writes one shard into a temporary file and renames it into place
+    when the shard is complete."""
+
+    def __init__(self, work_dir, k, columns=False):
+        work_dir.mkdir(parents=True, exist_ok=True)
+        self.writer = ResultWriter(shard_path(work_dir, k), columns, sync=True)
+        self.document_ids = []
+
+    def write(self, docid, features):
+        self.writer.write(features)
+        self.document_ids.append(docid)
+
+    def commit(self):
+        self.writer.commit()
+
+
+class ShardCommitter():
+    """Writes the aligned documents into shards and records each
+    completed shard in the manifest."""
+
+    def __init__(self, work_dir, manifest, columns=False):
+        self.work_dir = work_dir
+        self.manifest = manifest
+        self.columns = columns
+        self.shard = None
+
+    def write(self, k, docid, features, last_in_shard):
+        if self.shard is None:
+            self.shard = ShardWriter(self.work_dir, k, self.columns)
+
+        with instrumentation.stage('write_results'):
+            self.shard.write(docid, features)
+
+        if last_in_shard:
+            with instrumentation.stage('commit_shard'):
+                self.shard.commit()
+                self.manifest.add(k, self.shard.document_ids)
+            self.shard = None
+
+
+class Manifest():
+    """A log of completed shards and their document IDs.
+
+    The document IDs of the completed shards are checked against
+    document_ids, the IDs of the current input documents, so that
+    shards of a different version of the corpus are not merged."""
+
+    def __init__(self, path, shard_documents, document_ids):
+        self.path = path
+        self.shard_documents = shard_documents
+        self.document_ids = document_ids
+        self.completed = {}
+        self.reload()
+
+    def reload(self):
+        """Read the shards completed by all processes from the disk."""
+        completed = {}
+        if self.path.exists():
+            with self.path.open() as f:
+                for line in f:
+                    record = json.loads(line)
+                    if record['shard_documents'] != self.shard_documents:
+                        raise ValueError(f'{self.path} was created with a different number of '
+                                         f'documents per shard. Use --restart to start over.')
+
+                    k = record['shard']
+                    expected = self.document_ids[k*self.shard_documents:(k + 1)*self.shard_documents]
+                    if record['documents'] != expected:
+                        raise ValueError(f'The documents of shard {k} in {self.path} have '
+                                         f'changed. Use --restart to start over.')
+
+                    completed[k] = record['documents']
+
+        self.completed = completed
+
+    def add(self, k, document_ids):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        record = {
+            'shard': k,
+            'shard_documents': self.shard_documents,
+            'documents': document_ids
+        }
+        with self.path.open('a') as f:
+            f.write(json.dumps(record, ensure_ascii=False) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+        self.completed[k] = document_ids
+
+
+@contextmanager
+def locked(directory):
+    """Hold an exclusive lock on directory. Does nothing if the
+    directory does not exist, so that it is not created again after
+    the merging process has removed it."""
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except FileNotFoundError:
+        yield
+        return
+
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)
+
+
+def merge_shards(work_dir, num_shards, output_path, columns=False):
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = output_path.with_name(output_path.name + '.tmp')
+    with open(tmp_path, 'w') as output_f:
+        for k in range(num_shards):
+            with open(shard_path(work_dir, k)) as shard_f:
+                for chunk in iter(lambda: shard_f.read(1 << 20), ''):
+                    output_f.write(chunk)
+
+    os.replace(tmp_path, output_path)
+
+    sidecar = columns_path(output_path)
+    shard_sidecars = [columns_path(shard_path(work_dir, k)) for k in range(num_shards)]
+    if columns and all(p.exists() for p in shard_sidecars):
+        merge_columns(shard_sidecars, sidecar, output_path)
+    else:
+        if columns:
+            logging.warning(f'Some shards were written without --columns, not writing {sidecar}')
+        if sidecar.exists():
+            sidecar.unlink()
@@ -0,0 +1,39 @@
+"""The registry of evaluated NER services.
+
+Each service writes its results into ner_results/<result file>. The
+registered services are listed in this order in plots and tables.
+Result files of unregistered services found in the result directory
+are included after them, named by the file name."""
+
+from pathlib import Path
+
+default_result_dir = Path('ner_results')
+
+# (display name, result file name)
+registered_services = [
+    ('Azure', 'azure.tsv'),
+    ('FiNER', 'finer.tsv'),
+    ('Turku NER', 'turku.tsv'),
+]
+
+
+def register_service(name, result_file):
+    registered_services.append((name, result_file))
+
+
+def discover_services(result_dir=default_result_dir):
+    """(display name, result path) of the services with a result file
+    in result_dir."""
+    services = []
+    known = set()
+    for name, result_file in registered_services:
+        known.add(result_file)
+        path = result_dir / result_file
+        if path.exists():
+            services.append((name, path))
+
+    for path in sorted(result_dir.glob('*.tsv')):
+        if path.name not in known:
+            services.append((path.stem, path))
+
+    return services
@@ -1,42 +1,273 @@
+"""List the most common entity span errors of one or more systems.
+
+The result files are processed one document at a time. The errors are
+counted in bounded per-type counters (see TopCounter), so the memory
+use does not grow with the size of the corpus. The counts are exact
+unless a counter overflows, in which case the maximum overestimate is
+shown next to the count.
+"""
+
+import argparse
+import heapq
 import sys
-from collections import Counter
+from bisect import bisect_right
+from collections import namedtuple
+from itertools import zip_longest
+from pathlib import Path
+from .conlleval import end_of_chunk, parse_tag, start_of_chunk
+from .results import open_columns
 
+default_types = ['PERSON', 'LOC', 'GPE', 'ORG', 'EVENT', 'PRODUCT']
 
-class ErrorInstances():
-    def __init__(self):
-        self.fp_by_type = {}
-        self.fn_by_type = {}
+Span = namedtuple('Span', 'start end type')
 
 
 def main():
-    interesting_types = ['PERSON', 'LOC', 'GPE', 'ORG', 'EVENT', 'PRODUCT']
-    errors = ErrorInstances()
-    
-    tokens = load_ner_results(sys.stdin)
-    for features in tokens:
-        text = features[0]
-        correct = features[1]
-        predicted = features[2]
-
-        if entity_type(correct) != entity_type(predicted):
-            for t in interesting_types:
-                if entity_type(correct) == t:
-                    errors.fn_by_type.setdefault(t, []).append((text, entity_type(predicted)))
-                elif entity_type(predicted) == t:
-                    errors.fp_by_type.setdefault(t, []).append((text, entity_type(correct)))
-
-
-    for t in interesting_types:
+    args = parse_args()
+    types = args.type or default_types
+
+    if args.files:
+        names = [p.stem for p in args.files]
+        sources = [load_result_file(p) for p in args.files]
+    else:
+        names = ['stdin']
+        sources = [load_ner_results(sys.stdin)]
+
+    index = SpanErrorIndex(len(sources), types, args.capacity)
+    for tokens, gold, predicted in documents(zip_results(sources)):
+        index.add_document(tokens, gold, predicted)
+
+    print_errors(index, names, types, args.top)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='List the most common NER errors')
+    parser.add_argument('--type', action='append',
+                        help='Show errors of this entity type (can be given several times)')
+    parser.add_argument('--top', type=int, default=25,
+                        help='Number of errors to show for each entity type')
+    parser.add_argument('--capacity', type=int, default=10000,
+                        help='Number of distinct errors counted for each entity type')
+    parser.add_argument('files', nargs='*', type=Path,
+                        help='Result files of one or more systems (default: STDIN)')
+    return parser.parse_args()
+
+
+def print_errors(index, names, types, top):
+    multiple = len(names) > 1
+    for t in types:
         print(f'----- {t} -----\n')
-        print(f'Correct type is {t} but was predicted as something else:')
-        for (text, predicted), freq in sorted(Counter(errors.fn_by_type.get(t, [])).items(), key=lambda x: x[1]):
-            print(f'{freq:<3} {text} {predicted}')
-        print()
-
-        print(f'Predicted {t} but should have been something else:')
-        for (text, correct), freq in sorted(Counter(errors.fp_by_type.get(t, [])).items(), key=lambda x: x[1]):
-            print(f'{freq:<3} {text} {correct}')
-        print()
+        for kind, header in [('fn', f'Correct type is {t} but was predicted as something else:'),
+                             ('fp', f'Predicted {t} but should have been something else:')]:
+            print(header)
+            if multiple:
+                print(' '.join(f'{name:<10}' for name in names))
+
+            for (text, other), counts in index.most_common(kind, t, top):
+                freqs = ' '.join(f'{format_count(*c):<10}' if multiple else f'{format_count(*c):<3}'
+                                 for c in counts)
+                print(f'{freqs} {text} {other}')
+            print()
+
+
+def format_count(count, error):
+    if error:
+        return f'{count}±{error}'
+    else:
+        return str(count)
+
+
+class TopCounter():
+    """Approximate counts of the most frequent keys in a stream.
+
+    The Space-Saving algorithm: at most capacity keys are counted.
+    When a new key arrives and the counter is full, the key with the
+    lowest count is replaced and the new key inherits its count. The
+    count of a key is then overestimated by at most its error."""
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.counts = {}
+        self.errors = {}
+        # (count, key) pairs. Entries whose count is out of date are
+        # skipped when popped.
+        self.heap = []
+
+    def add(self, key):
+        counts = self.counts
+        if key in counts:
+            counts[key] += 1
+        elif len(counts) < self.capacity:
+            counts[key] = 1
+            self.errors[key] = 0
+        else:
+            min_key, min_count = self._pop_min()
+            del counts[min_key]
+            del self.errors[min_key]
+            counts[key] = min_count + 1
+            self.errors[key] = min_count
+
+        heapq.heappush(self.heap, (counts[key], key))
+        if len(self.heap) > 4*self.capacity:
+            self.heap = [(c, k) for k, c in counts.items()]
+            heapq.heapify(self.heap)
+
+    def _pop_min(self):
+        while True:
+            count, key = heapq.heappop(self.heap)
+            if self.counts.get(key) == count:
+                return key, count
+
+    def get(self, key):
+        """(count, error) of key. (0, 0) if the key is not counted."""
+        return self.counts.get(key, 0), self.errors.get(key, 0)
+
+    def most_common(self, n):
+        return heapq.nlargest(n, self.counts, key=self.counts.get)
+
+
+class SpanErrorIndex():
+    """Counts entity span errors by system, error kind and entity type.
+
+    The errors of a gold span that the system did not find (kind 'fn')
+    are keyed by the surface form of the span and a description of the
+    overlapping predicted spans. The errors of a predicted span that is
+    not in the ground truth (kind 'fp') are keyed by the surface form
+    and a description of the overlapping gold spans."""
+
+    def __init__(self, num_systems, types, capacity=10000):
+        self.num_systems = num_systems
+        self.counters = {(s, kind, t): TopCounter(capacity)
+                         for s in range(num_systems) for kind in ('fn', 'fp') for t in types}
+
+    def add_document(self, tokens, gold_tags, predicted_tags):
+        """predicted_tags is a list of tag sequences, one for each system."""
+        gold_spans = chunks(gold_tags)
+        for system, tags in enumerate(predicted_tags):
+            pred_spans = chunks(tags)
+            self.add_errors(system, 'fn', tokens, gold_spans, pred_spans)
+            self.add_errors(system, 'fp', tokens, pred_spans, gold_spans)
+
+    def add_errors(self, system, kind, tokens, spans, other_spans):
+        others = set(other_spans)
+        other_ends = [s.end for s in other_spans]
+        for span in spans:
+            counter = self.counters.get((system, kind, span.type))
+            if counter is None or span in others:
+                continue
+
+            text = ' '.join(tokens[span.start:span.end])
+            counter.add((text, describe_overlap(span, other_spans, other_ends)))
+
+    def most_common(self, kind, entity_type, n):
+        """The n most common errors of a kind and entity type.
+
+        Returns a list of (key, counts) pairs, where counts has a
+        (count, error) pair for each system. With several systems, the
+        errors with the largest difference between the systems are
+        listed first."""
+        counters = [self.counters[(s, kind, entity_type)] for s in range(self.num_systems)]
+        keys = set()
+        for counter in counters:
+            keys.update(counter.most_common(n))
+
+        rows = [(key, [c.get(key) for c in counters]) for key in keys]
+
+        def order(row):
+            counts = [c for c, _ in row[1]]
+            return (max(counts) - min(counts), sum(counts), row[0])
+
+        return sorted(rows, key=order, reverse=True)[:n]
+
+
+def describe_overlap(span, others, other_ends):
+    """Describe the spans in others overlapping span.
+
+    others is a sorted list of non-overlapping spans and other_ends
+    their end positions."""
+    overlapping = []
+    i = bisect_right(other_ends, span.start)
+    while i < len(others) and others[i].start < span.end:
+        overlapping.append(others[i])
+        i += 1
+
+    if not overlapping:
+        return 'O'
+    elif len(overlapping) == 1 and overlapping[0][:2] == span[:2]:
+        return overlapping[0].type
+    else:
+        return 'partial ' + '+'.join(s.type for s in overlapping)
+
+
+def chunks(tags):
+    """The entity spans in a tag sequence using the conlleval chunk
+    rules."""
+    res = []
+    start = None
+    prev_tag, prev_type = 'O', ''
+    for i, t in enumerate(tags):
+        tag, type_ = parse_tag(t)
+        if start is not None and end_of_chunk(prev_tag, tag, prev_type, type_):
+            res.append(Span(start, i, prev_type))
+            start = None
+        if start_of_chunk(prev_tag, tag, prev_type, type_):
+            if start is not None:
+                res.append(Span(start, i, prev_type))
+            start = i
+        prev_tag, prev_type = tag, type_
+
+    if start is not None:
+        res.append(Span(start, len(tags), prev_type))
+
+    return res
+
+
+def documents(rows):
+    """Group zipped result rows (see zip_results) into documents.
+
+    Yields (tokens, gold tags, [predicted tags of each system])."""
+    tokens, gold, predicted = [], [], None
+    for row in rows:
+        if row[0] == '-DOCSTART-':
+            if tokens:
+                yield tokens, gold, predicted
+            tokens, gold, predicted = [], [], None
+            continue
+
+        if predicted is None:
+            predicted = [[] for _ in row[2:]]
+        tokens.append(row[0])
+        gold.append(row[1])
+        for tags, tag in zip(predicted, row[2:]):
+            tags.append(tag)
+
+    if tokens:
+        yield tokens, gold, predicted
+
+
+def zip_results(sources):
+    """Combine the rows of result files of several systems.
+
+    Yields (token, gold tag, predicted tag of each system) rows."""
+    for rows in zip_longest(*sources):
+        if any(row is None for row in rows):
+            raise ValueError('result files have different number of lines')
+
+        first = rows[0]
+        if any(row[0] != first[0] or row[1] != first[1] for row in rows[1:]):
+            raise ValueError('tokens or correct tags differ between result files: ' +
+                             ' / '.join('\t'.join(row) for row in rows))
+
+        yield (first[0], first[1], *(row[2] for row in rows))
+
+
+def load_result_file(path):
+    columns = open_columns(path)
+    if columns is not None:
+        yield from columns.rows()
+    else:
+        with open(path) as fp:
+            yield from load_ner_results(fp)
 
 
 def load_ner_results(fp):
@@ -0,0 +1,176 @@
+"""Confidence intervals and significance tests for NER results.
+
+Usage:
+python -m eval.significance ner_results/azure.tsv ner_results/finer.tsv ner_results/turku.tsv
+
+The chunk counts are computed once for each document. A bootstrap
+resample or a randomized permutation is then just a weighted sum of
+the per-document counts.
+"""
+
+import argparse
+import itertools
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+from .conlleval import evaluate_multi, parse_args as conlleval_args, zip_result_files
+
+
+def main():
+    args = parse_args()
+    eval_args = conlleval_args(['--boundary=-DOCSTART-', '--delimiter=\t'])
+
+    counts = document_counts(args.files, eval_args, args.type)
+    names = [Path(p).stem for p in args.files]
+
+    print(f'Bootstrap {args.confidence:.0%} confidence intervals '
+          f'({args.resamples} resamples of {counts.shape[1]} documents)')
+    for name, c in zip(names, counts):
+        f1 = f1_score(c.sum(axis=0))
+        low, high = bootstrap_interval(c, args.resamples, args.confidence,
+                                       args.seed, args.workers)
+        print(f'{name:>12}: F1 {f1:.4f} [{low:.4f}, {high:.4f}]')
+
+    if len(names) > 1:
+        print()
+        print(f'Approximate randomization test ({args.resamples} permutations)')
+        for (i, a), (j, b) in itertools.combinations(enumerate(names), 2):
+            diff = f1_score(counts[i].sum(axis=0)) - f1_score(counts[j].sum(axis=0))
+            p = randomization_test(counts[i], counts[j], args.resamples,
+                                   args.seed, args.workers)
+            print(f'{a} vs. {b}: F1 difference {diff:+.4f}, p = {p:.4f}')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Bootstrap confidence intervals and significance tests')
+    parser.add_argument('--resamples', type=int, default=10000,
+                        help='Number of bootstrap resamples and permutations')
+    parser.add_argument('--confidence', type=float, default=0.95,
+                        help='Confidence level of the bootstrap intervals')
+    parser.add_argument('--type', help='Evaluate only this entity type (e.g. ORG)')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='Number of worker processes')
+    parser.add_argument('files', nargs='+', help='Result files of one or more systems')
+    return parser.parse_args()
+
+
+def document_counts(paths, options, entity_type=None):
+    """Per-document chunk counts of each system.
+
+    Returns an array of shape (systems, documents, 3). The last axis
+    is (correct chunks, guessed chunks, correct chunks in the ground
+    truth). If entity_type is given, only chunks of that type are
+    counted."""
+
+    files = [open(p) for p in paths]
+    try:
+        res = [counts_as_array(c, entity_type)
+               for c in evaluate_by_document(zip_result_files(files, options), options)]
+    finally:
+        for f in files:
+            f.close()
+
+    return np.array(res, dtype=np.int64).reshape(-1, len(paths), 3).transpose(1, 0, 2)
+
+
+def evaluate_by_document(lines, options):
+    document = []
+    for line in lines:
+        if line.split(None, 1)[:1] == [options.boundary] and document:
+            yield from evaluate_multi(document, options)
+            document = []
+
+        document.append(line)
+
+    if document:
+        yield from evaluate_multi(document, options)
+
+
+def counts_as_array(counts, entity_type=None):
+    if entity_type is None:
+        return [counts.correct_chunk, counts.found_guessed, counts.found_correct]
+    else:
+        return [counts.t_correct_chunk.get(entity_type, 0),
+                counts.t_found_guessed.get(entity_type, 0),
+                counts.t_found_correct.get(entity_type, 0)]
+
+
+def f1_score(counts):
+    """F1 scores from (..., 3) arrays of summed chunk counts."""
+    counts = np.asarray(counts, dtype=np.float64)
+    correct = counts[..., 0]
+    guessed = counts[..., 1]
+    total = counts[..., 2]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        prec = np.where(guessed > 0, correct / guessed, 0.0)
+        rec = np.where(total > 0, correct / total, 0.0)
+        f1 = np.where(prec + rec > 0, 2 * prec * rec / (prec + rec), 0.0)
+    return f1
+
+
+def bootstrap_interval(counts, resamples=10000, confidence=0.95, seed=0, workers=None):
+    """Bootstrap confidence interval of the F1 score.
+
+    counts is an array of per-document counts of one system (see
+    document_counts). The documents are resampled with replacement."""
+
+    scores = np.concatenate(run_chunks(bootstrap_f1_scores, (counts,),
+                                       resamples, seed, workers))
+    alpha = (1 - confidence) / 2
+    low, high = np.quantile(scores, [alpha, 1 - alpha])
+    return low, high
+
+
+def bootstrap_f1_scores(counts, n, seed):
+    rng = np.random.default_rng(seed)
+    num_documents = counts.shape[0]
+    weights = rng.multinomial(num_documents, np.full(num_documents, 1 / num_documents), size=n)
+    return f1_score(weights @ counts)
+
+
+def randomization_test(counts_a, counts_b, resamples=10000, seed=0, workers=None):
+    """Approximate randomization test for the difference in F1 scores.
+
+    The systems' counts are swapped on a random half of the documents
+    in each permutation. Returns the two-sided p-value."""
+
+    observed = abs(f1_score(counts_a.sum(axis=0)) - f1_score(counts_b.sum(axis=0)))
+    at_least_as_extreme = sum(run_chunks(randomized_differences, (counts_a, counts_b, observed),
+                                         resamples, seed, workers))
+    return (at_least_as_extreme + 1) / (resamples + 1)
+
+
+def randomized_differences(counts_a, counts_b, observed, n, seed):
+    rng = np.random.default_rng(seed)
+    swap = rng.random((n, counts_a.shape[0])) < 0.5
+    delta = swap @ (counts_b - counts_a)
+    f1_a = f1_score(counts_a.sum(axis=0) + delta)
+    f1_b = f1_score(counts_b.sum(axis=0) - delta)
+    # Tolerance for floating point noise in the differences
+    return int(np.count_nonzero(np.abs(f1_a - f1_b) >= observed - 1e-12))
+
+
+def run_chunks(f, args, n, seed, workers=None, chunk_size=1000):
+    """Run f(*args, chunk_n, chunk_seed) on n items split into chunks.
+
+    The chunks are run on a process pool. The seeds are derived from
+    seed and the chunk index, so the results do not depend on the
+    number of workers."""
+
+    sizes = [min(chunk_size, n - i) for i in range(0, n, chunk_size)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    if workers == 1 or len(sizes) == 1:
+        return [f(*args, size, s) for size, s in zip(sizes, seeds)]
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(f, *args, size, s) for size, s in zip(sizes, seeds)]
+        return [future.result() for future in futures]
+
+
+if __name__ == '__main__':
+    main()
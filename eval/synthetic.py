@@ -0,0 +1,218 @@
+"""Synthetic Finnish-like corpora for benchmarks and load tests.
+
+The words are built from Finnish syllables. The corpus has named
+entities with a configurable density, multi-word tokens (a word and a
+clitic, as in the UD treebanks), and hyphenated and colon tokens that
+the turku-one tokenization splits (see retokenize.py). The same seed
+always generates the same corpus.
+"""
+
+import random
+from collections import namedtuple
+from .alignment import continue_entity_label
+from .retokenize import Retokenizer, turku_one_rules
+
+# form: surface token, tag: IOB2 entity tag, space_after: followed by a
+# space, parts: the component words of a multi-word token or None
+Word = namedtuple('Word', 'form tag space_after parts')
+
+syllables = [
+    'ka', 'ta', 'la', 'sa', 'pa', 'va', 'ma', 'na', 'ra', 'ja', 'ko', 'to',
+    'lo', 'so', 'po', 'vo', 'mi', 'ni', 'ri', 'ki', 'ti', 'li', 'si', 'hel',
+    'sin', 'tam', 'pe', 'tur', 'ku', 'ou', 'lu', 'jy', 'vä', 'pää', 'tä',
+    'mä', 'nen', 'sen', 'lla', 'llä', 'ssa', 'ssä', 'sta', 'stä', 'ksi',
+    'ään', 'uu', 'ei', 'ai', 'öy', 'yö', 'ie', 'uo', 'aa', 'ee', 'ii',
+]
+clitics = ['kin', 'kaan', 'hän', 'ko', 'kö', 'pa', 'han']
+abbreviations = ['EU', 'YK', 'HKL', 'VR', 'SDP', 'KOK', 'HS', 'YLE', 'TV', 'IT']
+entity_types = ['PERSON', 'ORG', 'GPE', 'LOC', 'EVENT', 'PRODUCT']
+
+
+class SyntheticCorpus():
+    """A generated corpus of num_tokens tokens.
+
+    entity_density is the probability that an entity starts at a
+    token, split_rate the probability of a hyphenated or colon token
+    and multiword_rate the probability of a multi-word token."""
+
+    def __init__(self, num_tokens, seed=0, entity_density=0.1, split_rate=0.02,
+                 multiword_rate=0.02, document_tokens=300, sentence_tokens=15,
+                 vocabulary_size=20000):
+        self.rng = random.Random(seed)
+        self.seed = seed
+        self.entity_density = entity_density
+        self.split_rate = split_rate
+        self.multiword_rate = multiword_rate
+        self.vocabulary = [self.random_word() for _ in range(vocabulary_size)]
+
+        # (document ID, [sentence, ...]), a sentence is a list of Words
+        self.documents = []
+        self.num_tokens = 0
+        while self.num_tokens < num_tokens:
+            doc_id = f'x{len(self.documents):06d}'
+            sentences = []
+            doc_tokens = 0
+            while doc_tokens < document_tokens and self.num_tokens + doc_tokens < num_tokens:
+                sentence = self.random_sentence(self.rng.randint(sentence_tokens // 2,
+                                                                 sentence_tokens * 3 // 2))
+                sentences.append(sentence)
+                doc_tokens += len(sentence)
+            self.documents.append((doc_id, sentences))
+            self.num_tokens += doc_tokens
+
+    def random_word(self):
+        return ''.join(self.rng.choice(syllables) for _ in range(self.rng.randint(1, 4)))
+
+    def random_sentence(self, length):
+        rng = self.rng
+        words = []
+        while len(words) < length - 1:
+            r = rng.random()
+            if r < self.entity_density:
+                entity_type = rng.choice(entity_types)
+                for j in range(rng.choice([1, 1, 1, 2, 2, 3])):
+                    prefix = 'B-' if j == 0 else 'I-'
+                    words.append(Word(rng.choice(self.vocabulary).capitalize(),
+                                      prefix + entity_type, True, None))
+            elif r < self.entity_density + self.split_rate:
+                words.append(Word(self.random_split_token(), 'O', True, None))
+            elif r < self.entity_density + self.split_rate + self.multiword_rate:
+                word = rng.choice(self.vocabulary)
+                clitic = rng.choice(clitics)
+                words.append(Word(word + clitic, 'O', True, (word, clitic)))
+            else:
+                words.append(Word(rng.choice(self.vocabulary), 'O', True, None))
+
+        if words:
+            words[-1] = words[-1]._replace(space_after=False)
+        words.append(Word('.', 'O', True, None))
+        return words
+
+    def random_split_token(self):
+        rng = self.rng
+        kind = rng.randrange(4)
+        if kind == 0:
+            return f'{rng.choice(abbreviations)}-{rng.choice(self.vocabulary)}'
+        elif kind == 1:
+            return f'{rng.randint(0, 23)}:{rng.randint(0, 59):02d}'
+        elif kind == 2:
+            return f'{rng.choice(abbreviations)}:n'
+        else:
+            return f'{rng.choice(self.vocabulary)}/{rng.choice(self.vocabulary)}'
+
+    def words(self, sentences):
+        return [w for sentence in sentences for w in sentence]
+
+    def conllu_lines(self):
+        """The corpus in the CoNLL-U format of the UD treebanks."""
+        for doc_id, sentences in self.documents:
+            for n, sentence in enumerate(sentences, start=1):
+                yield f'# sent_id = {doc_id}.{n}\n'
+                yield f'# text = {sentence_text(sentence)}\n'
+                i = 1
+                for w in sentence:
+                    misc = '_' if w.space_after else 'SpaceAfter=No'
+                    if w.parts is None:
+                        yield f'{i}\t{w.form}\t{w.form}\tX\t_\t_\t0\tdep\t_\t{misc}\n'
+                        i += 1
+                    else:
+                        yield f'{i}-{i + len(w.parts) - 1}\t{w.form}\t_\t_\t_\t_\t_\t_\t_\t{misc}\n'
+                        for part in w.parts:
+                            yield f'{i}\t{part}\t{part}\tX\t_\t_\t0\tdep\t_\t_\n'
+                            i += 1
+                yield '\n'
+
+    def input_documents(self):
+        """The documents in the format of data.load_documents."""
+        res = []
+        for doc_id, sentences in self.documents:
+            text = []
+            spans = []
+            i = 0
+            for sentence in sentences:
+                for w in sentence:
+                    spans.append({'token': w.form, 'offset': i})
+                    text.append(w.form)
+                    i += len(w.form)
+                    if w.space_after and w is not sentence[-1]:
+                        text.append(' ')
+                        i += 1
+                text.append('\n')
+                i += 1
+            res.append({'id': doc_id, 'text': ''.join(text), 'spans': spans})
+        return res
+
+    def ground_truth(self):
+        """The ground truth documents in the format of
+        data.load_ground_truth."""
+        return [[[w.form, w.tag] for w in self.words(sentences)]
+                for _, sentences in self.documents]
+
+    def ground_truth_lines(self):
+        for (doc_id, _), doc in zip(self.documents, self.ground_truth()):
+            yield f'-DOCSTART-\tO\t{doc_id}\n'
+            for token, tag in doc:
+                yield f'{token}\t{tag}\n'
+
+    def predicted_tags(self, ground_truth, error_rate=0.1, seed=None):
+        """Noisy copies of the ground truth tags, one per document."""
+        rng = random.Random(self.seed + 1 if seed is None else seed)
+        res = []
+        for doc in ground_truth:
+            tags = []
+            for _, tag in doc:
+                if rng.random() < error_rate:
+                    tag = rng.choice(['O', 'B-' + rng.choice(entity_types)])
+                tags.append(tag)
+            res.append(tags)
+        return res
+
+    def predictions(self, error_rate=0.1, retokenizer=None):
+        """Mock NER predictions: the ground truth tokens retokenized
+        like turku-one with noisy tags. Returns a list of (token, tag)
+        lists, one for each document."""
+        if retokenizer is None:
+            retokenizer = Retokenizer(turku_one_rules)
+
+        ground_truth = self.ground_truth()
+        res = []
+        for doc, tags in zip(ground_truth, self.predicted_tags(ground_truth, error_rate)):
+            tokens, origins = retokenizer.retokenize_all([t for t, _ in doc])
+            predicted = []
+            previous = None
+            for token, origin in zip(tokens, origins):
+                tag = tags[origin] if origin != previous else continue_entity_label(tags[origin])
+                predicted.append((token, tag))
+                previous = origin
+            res.append(predicted)
+        return res
+
+    def result_lines(self, error_rate=0.1):
+        """Result file lines (token, gold, predicted) of a mock system."""
+        ground_truth = self.ground_truth()
+        for doc, tags in zip(ground_truth, self.predicted_tags(ground_truth, error_rate)):
+            yield '-DOCSTART-\tO\tO\n'
+            for (token, gold), pred in zip(doc, tags):
+                yield f'{token}\t{gold}\t{pred}\n'
+
+    def entity_ranges(self, documents=None):
+        """(offset, length) of the gold entities of each document, like
+        the entities in Azure responses."""
+        if documents is None:
+            documents = self.input_documents()
+
+        res = []
+        for doc, gt in zip(documents, self.ground_truth()):
+            ranges = []
+            for span, (_, tag) in zip(doc['spans'], gt):
+                end = span['offset'] + len(span['token'])
+                if tag.startswith('B-'):
+                    ranges.append([span['offset'], end - span['offset']])
+                elif tag.startswith('I-') and ranges:
+                    ranges[-1][1] = end - ranges[-1][0]
+            res.append([tuple(r) for r in ranges])
+        return res
+
+
+def sentence_text(sentence):
+    return ''.join(w.form + (' ' if w.space_after else '') for w in sentence).rstrip()
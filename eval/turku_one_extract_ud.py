@@ -1,99 +1,192 @@
-import re
-from itertools import islice
+import argparse
+import json
+import logging
 from pathlib import Path
 from .data import load_documents, load_ground_truth, write_tsv2
-from .functools import flat_map
+from .retokenize import Retokenizer, turku_one_rules
+
+
+# Rules for finding the UD documents in the turku-one data. Can be
+# overridden with a JSON file given in --rules.
+default_boundary_rules = {
+    # Number of leading tokens that identify a document
+    'ngram_length': 5,
+    # The document preceding the given document is cut after the first
+    # occurrence of the given token. In turku-one, the document before
+    # s203 is followed by law documents that are not part of UD. The
+    # last word really belonging to the document is "jäsen".
+    'truncate_previous': {
+        's203': 'jäsen',
+    },
+    # The leading tokens of the first FiNER document. The UD part of
+    # turku-one ends where this n-gram starts.
+    'end_ngram': ['Apple', 'joutumassa', 'veromyrskyn', 'silmään', ':'],
+    # How the leading tokens of the documents are retokenized to match
+    # turku-one (see retokenize.py for the rule format)
+    'retokenize': turku_one_rules,
+}
+
+# Parameters of the rolling n-gram hash
+hash_base = 1000003
+hash_modulus = (1 << 61) - 1
 
 
 def main():
-    input_path = Path('data/turku-one/data/conll/test.tsv')
-    output_path = Path('data/preprocessed/turku-one/test.tsv')
-    doc_dir = Path('data/preprocessed/documents')
+    args = parse_args()
+    input_path = args.input
+    output_path = args.output
+    doc_dir = args.documents
     output_path.parent.mkdir(parents=True, exist_ok=True)
-    n = 5
+    rules = load_boundary_rules(args.rules)
 
-    documents = load_documents(doc_dir)
+    documents = list(load_documents(doc_dir))
     tokens = next(load_ground_truth(input_path))
 
-    doc = next(documents)
-    next_document_ngram = [x['token'] for x in doc['spans'][:n]]
+    ranges = find_document_ranges(documents, [x[0] for x in tokens], rules)
 
-    current_doc = []
-    stop = False
     doc_count = 0
+    missing = []
     with open(output_path, 'w') as fp:
-        for t, win in zip(tokens, window(tokens, n)):
-            ngram = [x[0] for x in win]
-            if ngram == next_document_ngram:
-                # next document
-
-                if doc['id'] == 's203':
-                    # Remove the law documents that follow this
-                    # document in turku-one data. The last word really
-                    # belonging to this document is "jäsen".
-                    last_idx = [x[0] for x in current_doc].index('jäsen')
-                    current_doc = current_doc[:last_idx + 1]
-
-                if current_doc:
-                    write_tsv2(current_doc, fp)
-                    doc_count += 1
-
-                if stop:
-                    break
-
-                current_doc = [t]
-
-                try:
-                    doc = next(documents)
-                    next_document_ngram = [x['token'] for x in doc['spans'][:n]]
-                    next_document_ngram = flat_map(retokenize, next_document_ngram)[:n]
-                except StopIteration:
-                    # This is the last UD document. Next, look for the
-                    # start of the first Finer document and stop.
-                    next_document_ngram = ['Apple', 'joutumassa', 'veromyrskyn', 'silmään', ':'][:n]
-                    stop = True
-            else:
-                current_doc.append(t)
-
-        if current_doc and not stop:
-            write_tsv2(current_doc, fp)
-            doc_count += 1
+        for doc, next_doc in zip(documents, documents[1:] + [None]):
+            if doc['id'] not in ranges:
+                missing.append(doc['id'])
+                continue
 
-    print(f'Wrote {doc_count} documents into {output_path}')
+            start, end = ranges[doc['id']]
+            current_doc = tokens[start:end]
 
+            last_token = next_doc and rules['truncate_previous'].get(next_doc['id'])
+            if last_token is not None:
+                last_idx = [x[0] for x in current_doc].index(last_token)
+                current_doc = current_doc[:last_idx + 1]
 
-def retokenize(w):
-    """Retokenize w like turku-one has been tokenized."""
-    if ' ' in w:
-        res = w.split(' ')
-    elif '-' in w or '/' in w or ':' in w:
-        res = re.split(r'([-/:])', w)
-        res = [x for x in res if x]
-    elif w.endswith('.') or w.endswith(':'):
-        c = w[-1]
-        res = []
-        while w.endswith(c):
-            res.append(c)
-            w = w[:-1]
-        if w:
-            res.insert(0, w)
-    elif w == 'Первома́йск':
-        res = ['Первома', '́', 'йск']
-    else:
-        res = [w]
-    return res
-
-
-def window(seq, n=2):
-    "Returns a sliding window (of width n) over data from the iterable"
-    "   s -> (s0,s1,...s[n-1]), (s1,s2,...,sn), ...                   "
-    it = iter(seq)
-    result = tuple(islice(it, n))
-    if len(result) == n:
-        yield result
-    for elem in it:
-        result = result[1:] + (elem,)
-        yield result
+            write_tsv2(current_doc, fp, doc['id'])
+            doc_count += 1
+
+    print(f'Wrote {doc_count} documents into {output_path}')
+    if missing:
+        logging.error(f'{len(missing)} documents were not found in {input_path}: '
+                      f'{", ".join(missing)}. The evaluation scripts will refuse '
+                      f'to run until the boundary rules (--rules) are fixed.')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input', type=Path, default=Path('data/turku-one/data/conll/test.tsv'),
+                        help='turku-one CoNLL file')
+    parser.add_argument('--output', type=Path, default=Path('data/preprocessed/turku-one/test.tsv'),
+                        help='Output ground truth file')
+    parser.add_argument('--documents', type=Path, default=Path('data/preprocessed/documents.bin'),
+                        help='Document store or directory of the UD documents')
+    parser.add_argument('--rules', type=Path,
+                        help='JSON file overriding the default document boundary and '
+                        'retokenization rules')
+    return parser.parse_args()
+
+
+def load_boundary_rules(path):
+    rules = dict(default_boundary_rules)
+    if path is not None:
+        with open(path) as f:
+            rules.update(json.load(f))
+    return rules
+
+
+def find_document_ranges(documents, tokens, rules):
+    """Find the token range of each document in tokens.
+
+    A document starts where its leading n-gram (retokenized like
+    turku-one by rules['retokenize']) occurs. The occurrences of all
+    documents are found in one pass over tokens. If an n-gram occurs
+    several times, the first occurrence after the start of the
+    previous document is preferred, so the documents may also appear
+    in a different order than in documents. A document ends where the next document or the end
+    n-gram starts.
+
+    Returns a dict mapping document IDs to (start, end) token indices.
+    Documents that are not found are left out."""
+
+    n = rules['ngram_length']
+    retokenizer = Retokenizer(rules['retokenize'])
+    ngrams = [tuple(retokenizer.retokenize_all(x['token'] for x in doc['spans'][:n])[0][:n])
+              for doc in documents]
+    end_ngram = tuple(rules['end_ngram'][:n])
+
+    occurrences = find_ngrams(tokens, set(ngrams) | {end_ngram})
+
+    starts = {}
+    used = set()
+    previous_start = -1
+    for doc, ngram in zip(documents, ngrams):
+        candidates = [i for i in occurrences.get(ngram, []) if i not in used]
+        following = [i for i in candidates if i > previous_start]
+        if following:
+            start = following[0]
+        elif candidates:
+            start = candidates[0]
+        else:
+            logging.warning(f'Document {doc["id"]} not found')
+            continue
+
+        starts[doc['id']] = start
+        used.add(start)
+        previous_start = start
+
+    if not starts:
+        return {}
+
+    last_start = max(starts.values())
+    end_of_documents = next((i for i in occurrences.get(end_ngram, []) if i > last_start),
+                            len(tokens))
+
+    boundaries = sorted(starts.values()) + [end_of_documents]
+    if boundaries[0] > 0:
+        logging.warning(f'Ignoring {boundaries[0]} tokens before the first document')
+
+    next_boundary = dict(zip(boundaries, boundaries[1:]))
+    return {docid: (start, next_boundary[start]) for docid, start in starts.items()}
+
+
+def find_ngrams(tokens, ngrams):
+    """Find all occurrences of the given n-grams in tokens.
+
+    Uses a Rabin-Karp rolling hash over the token hashes, so the
+    running time is linear in the number of tokens for each distinct
+    n-gram length. Returns a dict mapping n-grams to sorted lists of
+    start indices."""
+
+    occurrences = {}
+    by_length = {}
+    for ngram in ngrams:
+        if ngram:
+            by_length.setdefault(len(ngram), {}).setdefault(ngram_hash(ngram), []).append(ngram)
+
+    token_hashes = [hash(t) & hash_modulus for t in tokens]
+    for n, targets in by_length.items():
+        if n > len(tokens):
+            continue
+
+        high = pow(hash_base, n - 1, hash_modulus)
+        h = 0
+        for t in token_hashes[:n]:
+            h = (h * hash_base + t) % hash_modulus
+
+        for i in range(len(tokens) - n + 1):
+            if i > 0:
+                h = ((h - token_hashes[i - 1] * high) * hash_base + token_hashes[i + n - 1]) % hash_modulus
+
+            for ngram in targets.get(h, []):
+                if tuple(tokens[i:i + n]) == ngram:
+                    occurrences.setdefault(ngram, []).append(i)
+
+    return occurrences
+
+
+def ngram_hash(ngram):
+    h = 0
+    for t in ngram:
+        h = (h * hash_base + (hash(t) & hash_modulus)) % hash_modulus
+    return h
 
 
 if __name__ == '__main__':
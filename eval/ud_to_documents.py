@@ -1,116 +1,138 @@
-# Parses test data inputs and writes plain text and span offset files
+# Parses test data inputs and writes the document texts and token
+# spans into a packed document store data/preprocessed/documents.bin
+# (see docstore.py), or optionally plain text and span offset files
 # into data/preprocessed/documents.
+#
+# The input is read in a single streaming pass. Only the current
+# document is kept in memory, so arbitrarily large CoNLL-U files can be
+# converted.
 
+import argparse
 import json
 import re
 from pathlib import Path
+from .docstore import DocumentStoreWriter
 
 sent_id_re = re.compile(r'^#\s*sent_id\s*=\s*(.+)\.(\d+)')
 
 
 def main():
-    infile = 'data/turku-ner-corpus/data/UD_Finnish-TDT/fi_tdt-ud-test.conllu'
-    outputdir = Path('data/preprocessed/documents')
-    outputdir.mkdir(parents=True, exist_ok=True)
-    
-    lines = open(infile).readlines()
-    documents = group_by_documents(lines)
-    for document, doc_id in documents:
-        text = []
-        spans = []
-        i = 0
-        for sentence in group_by_sentences(document):
-            needs_space = False
-
-            sentence = skip_multi_word_tokens(sentence)
-            for token in sentence:
-                features = token.split('\t')
-
-                if needs_space:
-                    text.append(' ')
-                    i += 1
+    args = parse_args()
+
+    with open(args.input) as f:
+        documents = read_documents(f)
+        if args.format == 'packed':
+            output_path = args.output or Path('data/preprocessed/documents.bin')
+            output_path.parent.mkdir(parents=True, exist_ok=True)
+            with DocumentStoreWriter(output_path) as writer:
+                for doc_id, text, spans in documents:
+                    writer.add(doc_id, text, spans)
+        else:
+            outputdir = args.output or Path('data/preprocessed/documents')
+            outputdir.mkdir(parents=True, exist_ok=True)
+            for doc_id, text, spans in documents:
+                write_document(outputdir, doc_id, text, spans)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input', default='data/turku-ner-corpus/data/UD_Finnish-TDT/fi_tdt-ud-test.conllu',
+                        help='CoNLL-U input file')
+    parser.add_argument('--format', choices=['packed', 'files'], default='packed',
+                        help='Write a packed document store or a directory of '
+                        '.txt and .spans files')
+    parser.add_argument('--output', type=Path,
+                        help='Output file (packed) or directory (files)')
+    return parser.parse_args()
+
+
+def read_documents(conllu_lines):
+    """Reconstruct document texts and token spans from CoNLL-U lines.
+
+    The document ID is the prefix of the sentence ID (for example, the
+    document of the sentence b101.3 is b101). Multi-word tokens are
+    output as one token and their component words are skipped.
+
+    Yields (document ID, text, spans) tuples. Lines preceding the
+    first sentence ID are ignored."""
+
+    doc_id = None
+    text = []
+    spans = []
+    i = 0                   # character offset in the current document
+    sentence_has_tokens = False
+    needs_space = False
+    skip_until = 0          # last word ID of the latest multi-word token
 
-                word = features[1]
+    for line in conllu_lines:
+        line = line.strip()
+        if not line:
+            continue
 
-                spans.append({
-                    'token': word,
-                    'offset': i,
-                })
+        if line.startswith('#'):
+            sent_id_match = sent_id_re.match(line)
+            if sent_id_match:
+                # new sentence start
+                if sentence_has_tokens:
+                    text.append('\n')
+                    i += 1
 
-                text.append(word)
-                i += len(word)
+                if sent_id_match.group(1) != doc_id:
+                    # new document start
+                    if doc_id is not None:
+                        yield (doc_id, ''.join(text), spans)
 
-                needs_space = 'SpaceAfter=No' not in features[9]
+                    doc_id = sent_id_match.group(1)
+                    text = []
+                    spans = []
+                    i = 0
 
-            text.append('\n')
-            i += 1
+                sentence_has_tokens = False
+                needs_space = False
+                skip_until = 0
 
-        with open(outputdir / f'{doc_id}.txt', 'w') as outtxt:
-            outtxt.write(''.join(text))
-        with open(outputdir / f'{doc_id}.spans', 'w') as outspans:
-            outspans.write(json.dumps(spans, indent=2, ensure_ascii=False))
+            continue
 
+        if doc_id is None:
+            continue
 
-def skip_multi_word_tokens(conllu_lines):
-    res = []
-    skip = []
-    for line in conllu_lines:
-        features = line.strip().split('\t')
+        features = line.split('\t')
         tid = features[0]
         if '-' in tid:
             start, end = tid.split('-')
-            skip = list(range(int(start), int(end) + 1))
-            res.append(line)
-        else:
-            if tid.isdigit() and int(tid) not in skip:
-                res.append(line)
-
-    return res
+            skip_until = int(end)
+        elif not tid.isdigit() or int(tid) <= skip_until:
+            continue
 
+        if needs_space:
+            text.append(' ')
+            i += 1
 
-def group_by_sentences(conllu_lines):
-    current_sentence = []
-    for line in conllu_lines:
-        line = line.strip()
-        sent_id_match = sent_id_re.match(line)
-        if sent_id_match:
-            # new sentence start
-            if current_sentence:
-                yield current_sentence
+        word = features[1]
 
-            current_sentence = []
-            continue
+        spans.append({
+            'token': word,
+            'offset': i,
+        })
 
-        elif not line or line.startswith('#'):
-            continue
+        text.append(word)
+        i += len(word)
 
-        else:
-            current_sentence.append(line)
-        
-    if current_sentence:
-        yield current_sentence
+        needs_space = 'SpaceAfter=No' not in features[9]
+        sentence_has_tokens = True
 
+    if doc_id is not None:
+        if sentence_has_tokens:
+            text.append('\n')
 
-def group_by_documents(conllu_lines):
-    current_doc = []
-    current_doc_id = None
+        yield (doc_id, ''.join(text), spans)
 
-    for line in conllu_lines:
-        line = line.strip()
-        sent_id_match = sent_id_re.match(line)
-        if sent_id_match and current_doc_id != sent_id_match.group(1):
-            # new document start
-            if current_doc:
-                yield (current_doc, current_doc_id)
-
-            current_doc = []
-            current_doc_id = sent_id_match.group(1)
-            continue
 
-        current_doc.append(line)
-        
-    if current_doc:
-        yield (current_doc, current_doc_id)
+def write_document(outputdir, doc_id, text, spans):
+    with open(outputdir / f'{doc_id}.txt', 'w') as outtxt:
+        outtxt.write(text)
+    with open(outputdir / f'{doc_id}.spans', 'w') as outspans:
+        outspans.write(json.dumps(spans, indent=2, ensure_ascii=False))
 
 
 if __name__ == '__main__':
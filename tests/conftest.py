@@ -0,0 +1,50 @@
+import argparse
+import pytest
+from eval.docstore import DocumentStoreWriter
+from eval.runner import add_runner_arguments
+from eval.synthetic import SyntheticCorpus
+
+
+class RunnerCorpus():
+    """Input documents, ground truth and mock predictions of a synthetic
+    corpus written into a directory."""
+
+    def __init__(self, directory, num_tokens=6000):
+        self.corpus = SyntheticCorpus(num_tokens, seed=2)
+        self.directory = directory
+        self.documents_path = directory / 'documents.bin'
+        self.ground_truth_path = directory / 'test.tsv'
+        self.document_ids = [docid for docid, _ in self.corpus.documents]
+        self.predictions = dict(zip(self.document_ids, self.corpus.predictions(error_rate=0.2)))
+        self.write()
+
+    def write(self, removed=()):
+        """Write the documents and the ground truth without the removed
+        document IDs."""
+        with DocumentStoreWriter(self.documents_path) as writer:
+            for doc in self.corpus.input_documents():
+                if doc['id'] not in removed:
+                    writer.add(doc['id'], doc['text'], doc['spans'])
+
+        with self.ground_truth_path.open('w') as f:
+            for docid, doc in zip(self.document_ids, self.corpus.ground_truth()):
+                if docid not in removed:
+                    f.write(f'-DOCSTART-\tO\t{docid}\n')
+                    f.writelines(f'{token}\t{tag}\n' for token, tag in doc)
+
+    def args(self, output_name, *options):
+        parser = argparse.ArgumentParser()
+        add_runner_arguments(parser, str(self.directory / output_name))
+        return parser.parse_args(['--documents', str(self.documents_path),
+                                  '--ground-truth', str(self.ground_truth_path),
+                                  '--shard-documents', '3',
+                                  *options])
+
+    def predict_all(self, documents):
+        for doc in documents:
+            yield doc, self.predictions[doc['id']]
+
+
+@pytest.fixture
+def runner_corpus(tmp_path):
+    return RunnerCorpus(tmp_path)
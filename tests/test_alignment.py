@@ -0,0 +1,93 @@
+import logging
+from eval.alignment import align_with_ground_truth, merge_ground_truth
+
+
+def labels(aligned):
+    return [label for _, label in aligned]
+
+
+def test_identical_tokens():
+    ground_truth = [['Matti', 'B-PERSON'], ['asuu', 'O'], ['Espoossa', 'B-GPE']]
+    predicted = [('Matti', 'B-PERSON'), ('asuu', 'O'), ('Espoossa', 'B-LOC')]
+
+    aligned = align_with_ground_truth('d1', predicted, ground_truth)
+
+    assert aligned == [['Matti', 'B-PERSON'], ['asuu', 'O'], ['Espoossa', 'B-LOC']]
+
+
+def test_ground_truth_splits_predicted_token():
+    # turku-one splits hyphens that the NER service keeps in the token
+    ground_truth = [['Etelä', 'B-LOC'], ['-', 'I-LOC'], ['Suomi', 'I-LOC'], ['on', 'O']]
+    predicted = [('Etelä-Suomi', 'B-LOC'), ('on', 'O')]
+
+    aligned = align_with_ground_truth('d1', predicted, ground_truth)
+
+    assert aligned == [['Etelä', 'B-LOC'], ['-', 'I-LOC'], ['Suomi', 'I-LOC'], ['on', 'O']]
+
+
+def test_prediction_splits_ground_truth_token(caplog):
+    ground_truth = [['Etelä-Suomi', 'B-LOC'], ['ja', 'O'], ['Yle-uutiset', 'B-ORG']]
+    predicted = [
+        ('Etelä', 'B-LOC'), ('-', 'I-LOC'), ('Suomi', 'I-LOC'), ('ja', 'O'),
+        ('Yle', 'B-ORG'), ('-', 'O'), ('uutiset', 'B-PRODUCT'),
+    ]
+
+    with caplog.at_level(logging.WARNING):
+        aligned = align_with_ground_truth('d1', predicted, ground_truth)
+
+    assert aligned == [['Etelä-Suomi', 'B-LOC'], ['ja', 'O'], ['Yle-uutiset', 'B-ORG']]
+    # Only the new entity inside Yle-uutiset is discarded
+    warnings = [r.getMessage() for r in caplog.records if r.levelno == logging.WARNING]
+    assert warnings[0] == 'Discarding predicted entity labels on document d1'
+    assert 'B-PRODUCT' in warnings[1]
+    assert len(warnings) == 2
+
+
+def test_empty_prediction():
+    ground_truth = [['Matti', 'B-PERSON'], ['asuu', 'O']]
+
+    aligned = align_with_ground_truth('d1', [], ground_truth)
+
+    assert aligned == [['Matti', 'O'], ['asuu', 'O']]
+
+
+def test_whitespace_inside_tokens_is_ignored():
+    ground_truth = [['New', 'B-GPE'], ['York', 'I-GPE'], ['on', 'O']]
+    predicted = [('New York', 'B-GPE'), ('on', 'O')]
+
+    assert labels(align_with_ground_truth('d1', predicted, ground_truth)) == \
+        ['B-GPE', 'I-GPE', 'O']
+
+
+def test_mismatched_character_streams(caplog):
+    # The service has normalized a character, the offsets still match
+    ground_truth = [['Ahvenanmaa', 'B-LOC'], ['–', 'O'], ['Åland', 'B-LOC']]
+    predicted = [('Ahvenanmaa', 'B-LOC'), ('-', 'O'), ('Aland', 'B-LOC')]
+
+    with caplog.at_level(logging.WARNING):
+        aligned = align_with_ground_truth('d1', predicted, ground_truth)
+
+    assert labels(aligned) == ['B-LOC', 'O', 'B-LOC']
+    assert 'texts differ on document d1 starting at character 10' in caplog.text
+
+
+def test_ground_truth_runs_past_end_of_prediction(caplog):
+    # The remaining ground truth tokens continue the last predicted label
+    ground_truth = [['Sanna', 'B-PERSON'], ['Marin', 'I-PERSON'], ['puhui', 'O'], ['.', 'O']]
+    predicted = [('Sanna', 'O'), ('Marin', 'B-PERSON')]
+
+    with caplog.at_level(logging.WARNING):
+        aligned = align_with_ground_truth('d1', predicted, ground_truth)
+
+    assert labels(aligned) == ['O', 'B-PERSON', 'I-PERSON', 'I-PERSON']
+    assert 'texts differ on document d1 starting at character 10' in caplog.text
+
+
+def test_merge_ground_truth_columns():
+    ground_truth = [['Etelä', 'B-LOC'], ['-', 'I-LOC'], ['Suomi', 'I-LOC']]
+    predicted = [('Etelä-Suomi', 'B-GPE')]
+
+    merged = merge_ground_truth('d1', predicted, ground_truth)
+
+    assert list(merged) == [('Etelä', 'B-LOC', 'B-GPE'), ('-', 'I-LOC', 'I-GPE'),
+                            ('Suomi', 'I-LOC', 'I-GPE')]
@@ -0,0 +1,37 @@
+import pytest
+from eval.conlleval import evaluate, parse_args
+from eval.synthetic import SyntheticCorpus
+
+np = pytest.importorskip('numpy')
+from eval.conlleval_numpy import evaluate as evaluate_numpy  # noqa: E402
+
+
+def counts_as_dict(counts):
+    return {key: dict(value) if isinstance(value, dict) else value
+            for key, value in vars(counts).items()}
+
+
+@pytest.mark.parametrize('error_rate', [0.0, 0.1, 0.5])
+def test_numpy_backend_matches_python(error_rate):
+    corpus = SyntheticCorpus(20000, seed=1)
+    lines = list(corpus.result_lines(error_rate))
+    options = parse_args(['--boundary=-DOCSTART-', '--delimiter=\t'])
+
+    expected = evaluate(lines, options)
+    actual = evaluate_numpy(lines, options)
+
+    assert expected.found_guessed > 0
+    assert counts_as_dict(actual) == counts_as_dict(expected)
+
+
+def test_numpy_backend_matches_python_on_mixed_tags():
+    # IOB1, IOBES and bracket tags and chunks crossing the boundaries
+    lines = [
+        'a I-PER I-PER', 'b I-PER B-PER', 'c B-PER E-PER', '-X- O O',
+        'd S-LOC I-LOC', 'e [-ORG I-ORG', 'f ]-ORG O', '', 'g I-ORG I-LOC',
+        'h O .-ORG', 'i E-ORG I-ORG',
+    ]
+    options = parse_args([])
+
+    assert counts_as_dict(evaluate_numpy(lines, options)) == \
+        counts_as_dict(evaluate(lines, options))
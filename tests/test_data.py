@@ -0,0 +1,52 @@
+import multiprocessing
+from eval.data import GroundTruthIndex, ground_truth_index_path, load_ground_truth
+from eval.synthetic import SyntheticCorpus
+
+
+def build_index(path, barrier):
+    barrier.wait()
+    GroundTruthIndex(path)
+
+
+def test_ground_truth_index_by_position_and_id(tmp_path):
+    corpus = SyntheticCorpus(3000, seed=3)
+    path = tmp_path / 'test.tsv'
+    with path.open('w') as f:
+        f.writelines(corpus.ground_truth_lines())
+
+    index = GroundTruthIndex(path)
+    expected = list(load_ground_truth(path))
+    doc_ids = [docid for docid, _ in corpus.documents]
+
+    assert index.has_ids()
+    assert index.ids() == doc_ids
+    assert [index[i] for i in range(len(index))] == expected
+    assert index[index.position(doc_ids[2])] == expected[2]
+
+    # Loaded from the index file
+    assert GroundTruthIndex(path).ids() == doc_ids
+
+
+def test_ground_truth_index_built_concurrently(tmp_path):
+    # Shard processes started together on a ground truth file that has
+    # no index yet
+    corpus = SyntheticCorpus(20000, seed=3)
+    path = tmp_path / 'test.tsv'
+    with path.open('w') as f:
+        f.writelines(corpus.ground_truth_lines())
+
+    num_processes = 8
+    for _ in range(20):
+        ground_truth_index_path(path).unlink(missing_ok=True)
+        barrier = multiprocessing.Barrier(num_processes)
+        processes = [multiprocessing.Process(target=build_index, args=(path, barrier))
+                     for _ in range(num_processes)]
+        for p in processes:
+            p.start()
+        for p in processes:
+            p.join()
+
+        assert [p.exitcode for p in processes] == [0]*num_processes
+        assert len(GroundTruthIndex(path)) == len(corpus.documents)
+
+    assert not list(tmp_path.glob('*.tmp'))
@@ -0,0 +1,111 @@
+import pytest
+
+pytest.importorskip('tqdm')
+from eval.runner import run_evaluation, shard_dir  # noqa: E402
+
+
+def evaluate(runner_corpus, output_name, *options):
+    args = runner_corpus.args(output_name, *options)
+    run_evaluation(runner_corpus.predict_all, args, include_spans=False)
+    return args.output
+
+
+def test_align_workers_output_is_identical(runner_corpus):
+    sequential = evaluate(runner_corpus, 'sequential.tsv')
+    pooled = evaluate(runner_corpus, 'pooled.tsv', '--align-workers=2', '--align-chunk-size=2')
+
+    assert sequential.stat().st_size > 0
+    assert pooled.read_bytes() == sequential.read_bytes()
+
+
+def test_pipeline_output_is_identical(runner_corpus):
+    sequential = evaluate(runner_corpus, 'sequential.tsv')
+    pipelined = evaluate(runner_corpus, 'pipelined.tsv', '--pipeline', '--align-workers=2',
+                         '--queue-size=2')
+
+    assert pipelined.read_bytes() == sequential.read_bytes()
+
+
+def test_sharded_runs_merge_into_single_run_output(runner_corpus):
+    single = evaluate(runner_corpus, 'single.tsv')
+
+    sharded = evaluate(runner_corpus, 'sharded.tsv', '--num-shards=2', '--shard-index=0')
+    assert not sharded.exists()
+    assert shard_dir(sharded).exists()
+
+    # The second process sees the shards completed by the first one
+    evaluate(runner_corpus, 'sharded.tsv', '--num-shards=2', '--shard-index=1')
+    assert sharded.read_bytes() == single.read_bytes()
+    assert not shard_dir(sharded).exists()
+
+
+def test_sharded_runs_started_together_merge(runner_corpus):
+    # Both processes load the manifest before either completes a shard,
+    # as when they are started at the same time
+    first = runner_corpus.args('sharded.tsv', '--num-shards=2', '--shard-index=0')
+    second = runner_corpus.args('sharded.tsv', '--num-shards=2', '--shard-index=1')
+
+    def predict_all(documents):
+        if predict_all.first_call:
+            predict_all.first_call = False
+            run_evaluation(runner_corpus.predict_all, second, include_spans=False)
+        yield from runner_corpus.predict_all(documents)
+    predict_all.first_call = True
+
+    run_evaluation(predict_all, first, include_spans=False)
+
+    single = evaluate(runner_corpus, 'single.tsv')
+    assert first.output.read_bytes() == single.read_bytes()
+    assert not shard_dir(first.output).exists()
+
+
+def test_process_finishing_after_merge_leaves_no_work_dir(runner_corpus):
+    # The first process merges while the second one is between its last
+    # shard and the merge
+    first = runner_corpus.args('sharded.tsv', '--num-shards=2', '--shard-index=0')
+    second = runner_corpus.args('sharded.tsv', '--num-shards=2', '--shard-index=1')
+
+    def predict_all(documents):
+        yield from runner_corpus.predict_all(documents)
+        run_evaluation(runner_corpus.predict_all, first, include_spans=False)
+
+    run_evaluation(predict_all, second, include_spans=False)
+
+    single = evaluate(runner_corpus, 'single.tsv')
+    assert second.output.read_bytes() == single.read_bytes()
+    assert not shard_dir(second.output).exists()
+
+
+def test_resume_fails_if_documents_have_changed(runner_corpus):
+    evaluate(runner_corpus, 'sharded.tsv', '--num-shards=2', '--shard-index=0')
+    runner_corpus.write(removed={runner_corpus.document_ids[1]})
+
+    with pytest.raises(ValueError, match='--restart'):
+        evaluate(runner_corpus, 'sharded.tsv', '--num-shards=2', '--shard-index=1')
+
+    restarted = evaluate(runner_corpus, 'sharded.tsv', '--restart')
+    assert restarted.exists()
+
+
+def test_merge_only_fails_on_incomplete_shards(runner_corpus):
+    evaluate(runner_corpus, 'sharded.tsv', '--num-shards=2', '--shard-index=0')
+
+    with pytest.raises(SystemExit):
+        evaluate(runner_corpus, 'sharded.tsv', '--merge-only')
+
+
+def test_document_id_requires_output(runner_corpus):
+    with pytest.raises(SystemExit):
+        evaluate(runner_corpus, 'full.tsv', f'--document-id={runner_corpus.document_ids[1]}')
+
+
+def test_selected_documents_match_full_run(runner_corpus):
+    full = evaluate(runner_corpus, 'full.tsv')
+    selected = runner_corpus.document_ids[2:4]
+    subset = runner_corpus.directory / 'subset.tsv'
+    evaluate(runner_corpus, 'full.tsv', f'--output={subset}',
+             *(f'--document-id={docid}' for docid in reversed(selected)))
+
+    documents = full.read_text().split('-DOCSTART-')[1:]
+    expected = '-DOCSTART-' + '-DOCSTART-'.join(reversed(documents[2:4]))
+    assert subset.read_text() == expected
@@ -0,0 +1,36 @@
+import json
+from eval.turku_one_extract_ud import find_document_ranges, load_boundary_rules
+
+
+def document(docid, text):
+    spans = []
+    offset = 0
+    for token in text.split():
+        offset = text.index(token, offset)
+        spans.append({'token': token, 'offset': offset})
+        offset += len(token)
+    return {'id': docid, 'text': text, 'spans': spans}
+
+
+def test_find_document_ranges_retokenizes_leading_tokens():
+    documents = [document('a1', 'Etelä-Suomi on suuri .'),
+                 document('a2', 'Kello 12:30 alkaa uutiset .')]
+    tokens = ('x y Etelä - Suomi on suuri . Kello 12 : 30 alkaa uutiset . '
+              'Apple joutumassa veromyrskyn silmään : z').split()
+
+    ranges = find_document_ranges(documents, tokens, load_boundary_rules(None))
+
+    assert ranges == {'a1': (2, 8), 'a2': (8, 15)}
+
+
+def test_retokenization_rules_from_json(tmp_path):
+    rules_path = tmp_path / 'rules.json'
+    with rules_path.open('w') as f:
+        json.dump({'ngram_length': 3,
+                   'retokenize': [{'type': 'split_keep', 'characters': '_'}]}, f)
+    documents = [document('a1', 'yksi_kaksi kolme'), document('a2', 'neljä viisi kuusi')]
+    tokens = 'yksi _ kaksi kolme neljä viisi kuusi'.split()
+
+    ranges = find_document_ranges(documents, tokens, load_boundary_rules(rules_path))
+
+    assert ranges == {'a1': (0, 4), 'a2': (4, 7)}